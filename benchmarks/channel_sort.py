@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) Brian Moe (2013-2014), Duncan Macleod (2014-)
+#
+# This file is part of LIGO CIS Core.
+#
+# LIGO CIS Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LIGO CIS Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the sorted and filtered channel queries used by the grid
+
+A synthetic channel table is created in a temporary SQLite database,
+then each sort is timed for the first page, a deep page selected with
+``OFFSET``, and the same deep page selected with a cursor, first with
+the composite ``is_current`` indexes on `Channel`, then without them.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import django
+from django.conf import settings
+
+#: the sorts used by the channel grid
+SORTS = ['name', '-name', '-created', 'datarate', '-datarate',
+         '-datarate,name', 'subsystem', 'source,-name']
+
+
+def setup(path):
+    """Configure Django to use an SQLite database at the given path
+    """
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='benchmark',
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': path}},
+        INSTALLED_APPS=['django.contrib.contenttypes',
+                        'django.contrib.auth',
+                        'reversion',
+                        'cisserver.apps.CisConfig'],
+    )
+    django.setup()
+
+
+def create_channels(n, seed=0, chunk_size=500):
+    """Create the channel tables, and fill them with ``n`` channels
+    """
+    from django.db import connection
+    from django.utils import timezone
+    from cisserver.models import (Channel, Ifo)
+
+    with connection.schema_editor() as editor:
+        editor.create_model(Ifo)
+        editor.create_model(Channel)
+
+    rng = random.Random(seed)
+    ifo = Ifo.objects.create(name='H1')
+    subsystems = ['ASC', 'LSC', 'SUS', 'PEM', 'ISI', 'PSL', 'OMC', 'CAL']
+    now = timezone.now()
+    channels = []
+    for i in range(n):
+        subsystem = rng.choice(subsystems)
+        channels.append(Channel(
+            ifo=ifo, subsystem=subsystem,
+            name='H1:%s-BENCH_%07d_OUT_DQ' % (subsystem, i),
+            gain=1., slope=1., offset=0, datatype=4, ifoid=0,
+            acquire=rng.choice([0, 3]), units='V', dcuid=i % 100,
+            datarate=rng.choice([16, 256, 2048, 16384]), chnnum=i,
+            created=now - datetime.timedelta(seconds=rng.randint(0, 10 ** 7)),
+            createdby='bench', source='h1%s' % subsystem.lower(),
+            is_current=rng.random() < .9))
+    for i in range(0, n, chunk_size):
+        Channel.objects.bulk_create(channels[i:i+chunk_size])
+
+
+def drop_indexes():
+    """Drop the composite indexes on the channel table
+    """
+    from django.db import connection
+    from cisserver.models import Channel
+
+    table = Channel._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+        for name, info in constraints.items():
+            if info['index'] and info['columns'][:1] == ['is_current']:
+                cursor.execute('DROP INDEX %s' % connection.ops.quote_name(
+                    name))
+
+
+def best_of(repeat, func, *args):
+    """Returns the result and best time of ``repeat`` calls to ``func``
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run(depth, size, repeat):
+    """Time each sort, returns a `dict` of times
+    """
+    from cisserver.models import Channel
+    from cisserver.api.views import (_encode_cursor, _seek)
+
+    times = {}
+    for sort in SORTS:
+        keys = sort.split(',')
+        if not set(k.lstrip('-') for k in keys) & set(['name', 'id']):
+            keys.append('-name' if keys[-1].startswith('-') else 'name')
+        queryset = Channel.objects.filter(is_current=True).order_by(*keys)
+        tfirst = best_of(repeat, lambda: list(queryset[:size]))[1]
+        deep, toffset = best_of(repeat,
+                                lambda: list(queryset[depth:depth+size]))
+        # cursor for the row before the deep page, ordered as in _seek
+        last = queryset[depth-1]
+        ordering = keys[:[k.lstrip('-') for k in keys].index('name') + 1]
+        opts = Channel._meta
+        token = _encode_cursor({
+            'o': ordering,
+            'v': [(opts.pk if k == 'pk' else opts.get_field(k.lstrip('-'))
+                   ).value_from_object(last) for k in ordering],
+        })
+        (page, _), tcursor = best_of(repeat, _seek, queryset, token, size)
+        if [c.pk for c in page] != [c.pk for c in deep]:
+            raise AssertionError("Cursor and offset pages differ for %s"
+                                 % sort)
+        times[sort] = (tfirst, toffset, tcursor)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nchan', type=int, default=200000,
+                        help='number of channels, default: %(default)s')
+    parser.add_argument('-s', '--page-size', type=int, default=100,
+                        help='number of channels per page, '
+                             'default: %(default)s')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of repeats, default: %(default)s')
+    args = parser.parse_args()
+    depth = int(args.nchan * .8)
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+    try:
+        setup(path)
+        create_channels(args.nchan)
+        indexed = run(depth, args.page_size, args.repeat)
+        drop_indexes()
+        plain = run(depth, args.page_size, args.repeat)
+    finally:
+        os.unlink(path)
+
+    print("%d channels, current only, %d per page, deep page at %d"
+          % (args.nchan, args.page_size, depth))
+    print("%-16s %-30s %-30s" % ('', 'with indexes', 'without indexes'))
+    print("%-16s %-30s %-30s" % ('sort', 'first  offset  cursor',
+                                 'first  offset  cursor'))
+    for sort in SORTS:
+        print("%-16s %s   %s" % (
+            sort, ' '.join('%.4f' % t for t in indexed[sort]),
+            ' '.join('%.4f' % t for t in plain[sort])))
+
+
+if __name__ == '__main__':
+    main()
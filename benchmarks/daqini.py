@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) Brian Moe (2013-2014), Duncan Macleod (2014-)
+#
+# This file is part of LIGO CIS Core.
+#
+# LIGO CIS Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LIGO CIS Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the streaming DAQ INI parser against ConfigParser
+
+If no INI files are given, a synthetic model file is generated.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from cisserver.management.daqini import (iter_daq_ini,
+                                         read_daq_ini_configparser)
+
+
+def write_model(path, nchan, seed=0):
+    """Write a synthetic DAQ INI file with ``nchan`` channels
+    """
+    rng = random.Random(seed)
+    subsystems = ['ASC', 'LSC', 'SUS', 'PEM', 'ISI', 'PSL']
+    with open(path, 'w') as fobj:
+        fobj.write('[default]\ngain=1.00\nacquire=3\ndcuid=42\nifoid=0\n'
+                   'datatype=4\ndatarate=16384\noffset=0\n'
+                   'slope=6.1028e-05\nunits=V\n\n')
+        for i in range(nchan):
+            fobj.write('[H1:%s-BENCH_%d_OUT_DQ]\n'
+                       % (rng.choice(subsystems), i))
+            if i % 3 == 0:
+                fobj.write('acquire=0\ndatarate=%d\n'
+                           % rng.choice([16, 256, 2048]))
+            fobj.write('chnnum=%d\n\n' % (40000 + i))
+
+
+def best_of(repeat, func, *args):
+    """Returns the result and best time of ``repeat`` calls to ``func``
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('inifile', nargs='*', help='DAQ INI files to read')
+    parser.add_argument('-n', '--nchan', type=int, default=100000,
+                        help='number of channels in synthetic file, '
+                             'default: %(default)s')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of repeats, default: %(default)s')
+    args = parser.parse_args()
+
+    files = args.inifile
+    if not files:
+        fd, path = tempfile.mkstemp(suffix='.ini')
+        os.close(fd)
+        write_model(path, args.nchan)
+        files = [path]
+
+    extra = {'source': 'BENCH'}
+    try:
+        for path in files:
+            ref, tref = best_of(args.repeat, read_daq_ini_configparser,
+                                path, extra)
+            new, tnew = best_of(args.repeat,
+                                lambda p: list(iter_daq_ini(p, extra)), path)
+            print("%s: %d channels" % (path, len(ref)))
+            print("    ConfigParser: %.3fs" % tref)
+            print("    iter_daq_ini: %.3fs (%.1fx)" % (tnew, tref / tnew))
+            if new != ref:
+                raise AssertionError("Results differ for %s" % path)
+            print("    results identical")
+    finally:
+        if not args.inifile:
+            os.unlink(files[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) Brian Moe (2013-2014), Duncan Macleod (2014-)
+#
+# This file is part of LIGO CIS Core.
+#
+# LIGO CIS Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LIGO CIS Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmark for the cached channel-name parser
+
+Each name is parsed once per call site (ingest, sub-names, tree, and
+descriptions), first with the bare regular expression, then with the
+cached parser, and finally with the batch API.
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+from cisserver import names as cisnames
+
+
+def make_names(n, seed=0):
+    """Generate ``n`` realistic channel names
+    """
+    rng = random.Random(seed)
+    ifos = ['H1', 'L1']
+    subsystems = ['ASC', 'LSC', 'SUS', 'PEM', 'ISI', 'PSL', 'OMC', 'CAL',
+                  'IMC', 'HPI', 'SEI', 'TCS', 'ALS', 'SQZ', 'ODC']
+    words = ['ETMX', 'ETMY', 'ITMX', 'ITMY', 'BS', 'DARM', 'CARM', 'MICH',
+             'PRCL', 'SRCL', 'L1', 'L2', 'L3', 'M0', 'OSEM', 'DAMP', 'LOCK',
+             'ISCINF', 'WIT', 'DRIVE', 'SENSOR', 'BLRMS', 'X', 'Y', 'Z',
+             'RX', 'RY', 'RZ', 'P', 'Y', 'IN1', 'IN2', 'OUT', 'OUTPUT']
+    suffixes = ['DQ', 'OUT_DQ', 'IN1_DQ', 'OUTPUT', 'MON']
+    out = set()
+    while len(out) < n:
+        parts = [rng.choice(words) for _ in range(rng.randint(1, 5))]
+        out.add('%s:%s-%s_%s' % (rng.choice(ifos), rng.choice(subsystems),
+                                 '_'.join(parts), rng.choice(suffixes)))
+    return list(out)
+
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def regex_each(names, nsites):
+    match = cisnames.RE_NAME.match
+    for name in names:
+        for _ in range(nsites):
+            m = match(name)
+            [m.group(3)] + m.group(4).split('_')
+
+
+def cached_each(names, nsites):
+    parse = cisnames.parse_channel_name
+    for name in names:
+        for _ in range(nsites):
+            parse(name).parts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--num-names', type=int, default=500000,
+                        help='number of names, default: %(default)s')
+    parser.add_argument('-s', '--num-sites', type=int, default=4,
+                        help='number of parses per name, '
+                             'default: %(default)s')
+    args = parser.parse_args()
+
+    names = make_names(args.num_names)
+    print("%d names, %d parses each" % (len(names), args.num_sites))
+    print("    regex:        %.3fs"
+          % timeit(regex_each, names, args.num_sites))
+    cisnames._cache.clear()
+    print("    cached:       %.3fs"
+          % timeit(cached_each, names, args.num_sites))
+    cisnames._cache.clear()
+    print("    batch (cold): %.3fs"
+          % timeit(cisnames.parse_channel_names, names))
+    # repeat with as many names as the cache can hold
+    chunk = names[:cisnames.CACHE_SIZE // 2]
+    cisnames._cache.clear()
+    print("%d names, batch parse" % len(chunk))
+    print("    regex:        %.3fs" % timeit(regex_each, chunk, 1))
+    print("    batch (cold): %.3fs"
+          % timeit(cisnames.parse_channel_names, chunk))
+    print("    batch (warm): %.3fs"
+          % timeit(cisnames.parse_channel_names, chunk))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,8 @@ The URLS are redirected as follows:
 - ``/channel/``: show list of all `Channels <Channel>`
 - ``/channel/<name>``: show details of a single `Channel`
 - ``/channel/<name>/descriptions``: show descriptions for a `Channel`
+- ``/complete?prefix=<prefix>``: complete a partial channel name
+- ``/facets?q=<query>``: count matching channels by IFO, subsystem, etc.
 - ``/description/``: show list of all descriptions
 - ``/description/<name>`: show details of a single `Description`
 """
@@ -32,7 +34,8 @@ from django.contrib import admin
 admin.autodiscover()
 
 from .views import (Cis, ChannelList, ChannelDetail, DescriptionList,
-                    DescriptionDetail, ChannelDescriptions)
+                    DescriptionDetail, ChannelDescriptions,
+                    ChannelCompletion, ChannelFacets)
 from .. import version
 
 __version__ = version.version
@@ -57,6 +60,14 @@ urlpatterns = patterns(
     url(r'^channel/((?P<pk>\d+)|(?P<name>[^\d][^/]+))/descriptions$',
         ChannelDescriptions.as_view(),
         name="api-channeldescriptions"),
+    # Complete a partial channel name
+    url(r'^complete/?$',
+        ChannelCompletion.as_view(),
+        name="api-complete"),
+    # Count channels in each facet
+    url(r'^facets/?$',
+        ChannelFacets.as_view(),
+        name="api-facets"),
     # View all descriptions
     url(r'^description/$',
         DescriptionList.as_view(),
@@ -19,19 +19,28 @@
 """RESTful API views for CIS
 """
 
+import base64
+import hashlib
+import json
 import logging
 import re
+from functools import reduce
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from rest_framework import (serializers, permissions, generics)
+from rest_framework.exceptions import ParseError
 
 from django.http import Http404
 from django.conf import settings
-from django.core.exceptions import PermissionDenied
+from django.core.cache import cache
+from django.core.exceptions import (FieldDoesNotExist, PermissionDenied,
+                                    ValidationError)
+from django.db.models import (Count, Q)
+from django.db.models.query import QuerySet
 
-from .. import version
+from .. import (catalogue, version)
 from ..models import (Channel, ChannelDescription as Description)
 
 logger = logging.getLogger(__name__)
@@ -77,19 +86,92 @@ class DojoJsonRestApiView(generics.ListCreateAPIView):
     # XXX Probably should target the mixin(s) whence these methods originate.
     empty_error = "Empty list and '%(class_name)s.allow_empty' is False."
 
+    #: maximum number of IDs to cache for each filtered result set,
+    #: larger result sets only have their count cached
+    result_cache_size = 50000
+
+    #: lifetime (seconds) of cached results
+    result_cache_timeout = 3600
+
+    paginate_by = 20
+    paginate_by_param = 'page_size'
+
+    #: maximum number of results per page when using a ``cursor``
+    max_page_size = 1000
+
+    def get_result_cache_key(self):
+        """Returns the cache key for the filtered results of this request
+
+        Views that return `None` (the default) don't cache their results.
+        """
+        return None
+
+    def estimate_count(self):
+        """Returns an estimate of the number of filtered results
+
+        This is used instead of an exact ``COUNT`` for result sets larger
+        than `result_cache_size`. It should err on the high side, as the
+        count is corrected once a client reaches the end of the results.
+        Views that return `None` (the default) always count exactly.
+        """
+        return None
+
+    def get_results(self, queryset, key=None):
+        """Returns the ordered IDs and count of the filtered results
+
+        The filter is evaluated once, and the results are cached under
+        ``key`` (see `get_result_cache_key`), so that each new range of
+        the same results doesn't need to ``COUNT`` the results again.
+        Small result sets are counted exactly, large ones use
+        `estimate_count` if possible.
+
+        Returns
+        -------
+        ids : `list` of `int`
+            the ordered IDs of the results, or `None` if there are more
+            than `result_cache_size` results, or they aren't cached
+        count : `int`
+            the total number of results
+        estimated : `bool`
+            `True` if ``count`` is only an estimate
+        """
+        if key is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+        object_list = self.filter_queryset(queryset)
+        if key is None or not isinstance(object_list, QuerySet):
+            return None, object_list.count(), False
+        estimate = self.estimate_count()
+        if estimate is not None and estimate > self.result_cache_size:
+            result = (None, estimate, True)
+        else:
+            ids = list(object_list.values_list('pk', flat=True)[
+                :self.result_cache_size + 1])
+            if len(ids) > self.result_cache_size:
+                result = (None, object_list.count(), False)
+            else:
+                result = (ids, len(ids), False)
+        cache.set(key, result, self.result_cache_timeout)
+        return result
+
     def list(self, request, *args, **kwargs):
+        if 'cursor' in request.GET:
+            return self.list_from_cursor(request)
+
         qrange = request.META.get("HTTP_RANGE")
         if not qrange:
             return super(DojoJsonRestApiView, self).list(
                 request, *args, **kwargs)
 
         queryset = self.get_queryset()
-        self.object_list = self.filter_queryset(queryset)
+        key = self.get_result_cache_key()
+        ids, full_count, estimated = self.get_results(queryset, key=key)
 
         # Default is to allow empty querysets.  This can be altered by setting
         # `.allow_empty = False`, to raise 404 errors on empty querysets.
         allow_empty = True#self.get_allow_empty()
-        if not allow_empty and not self.object_list:
+        if not allow_empty and not full_count:
             class_name = self.__class__.__name__
             error_msg = self.empty_error % {'class_name': class_name}
             raise Http404(error_msg)
@@ -97,14 +179,163 @@ class DojoJsonRestApiView(generics.ListCreateAPIView):
         start, end = re.match("items=(\d+)-(\d+)", qrange).groups()
         start = int(start)
         end = int(end)+1
-        full_count = self.object_list.count()
-        self.object_list = self.object_list[start:end]
+        if ids is None:
+            self.object_list = self.filter_queryset(queryset)[start:end]
+        else:
+            ids = ids[start:end]
+            objects = queryset.in_bulk(ids)
+            self.object_list = [objects[pk] for pk in ids if pk in objects]
         this_count = len(self.object_list)
         serializer = self.get_serializer(self.object_list, many=True)
 
+        # a short range means we've found the end of an estimated count
+        if estimated and this_count < end - start:
+            if this_count:
+                full_count = start + this_count
+            else:
+                full_count = self.filter_queryset(queryset).count()
+            estimated = False
+            cache.set(key, (None, full_count, False),
+                      self.result_cache_timeout)
+
         content_range = "items %s-%s/%s" % (start, start+this_count-1, full_count)
+        headers = {'Content-Range': content_range}
+        if estimated:
+            # Dojo needs a number, so flag that it is an estimate
+            headers['X-Count-Estimated'] = 'true'
 
-        return Response(serializer.data, headers={'Content-Range': content_range})
+        return Response(serializer.data, headers=headers)
+
+    def list_from_cursor(self, request):
+        """Return the page of results that follows a continuation token
+
+        Pages are found by the values of the sort columns (and ID) of the
+        last result on the previous page, rather than by an ``OFFSET``,
+        so that every page costs the same, however deep. Pass an empty
+        ``cursor`` to get the first page; each response gives the URL of
+        the ``next`` page, which is `None` after the last page.
+        """
+        try:
+            size = min(int(request.GET.get(self.paginate_by_param,
+                                           self.paginate_by)),
+                       self.max_page_size)
+        except ValueError:
+            raise ParseError("%s must be an integer" % self.paginate_by_param)
+        if size < 1:
+            raise ParseError("%s must be positive" % self.paginate_by_param)
+        token = request.GET.get('cursor') or None
+        object_list = self.filter_queryset(self.get_queryset())
+        if isinstance(object_list, QuerySet):
+            page, cursor = _seek(object_list, token, size)
+        else:  # an in-memory result, so just skip ahead
+            page, cursor = _skip(object_list, token, size)
+
+        if cursor is None:
+            next_url = None
+        else:
+            params = request.GET.copy()
+            params['cursor'] = cursor
+            next_url = request.build_absolute_uri(
+                '%s?%s' % (request.path, params.urlencode()))
+        serializer = self.get_serializer(page, many=True)
+        return Response({'next': next_url, 'results': serializer.data})
+
+
+def _encode_cursor(data):
+    """Encode the position in a result set as an opaque token
+    """
+    # keep the full precision of datetimes, so there are no ties
+    data = json.dumps(data, default=lambda x: x.isoformat()).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(token):
+    """Decode a token from `_encode_cursor`
+    """
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ParseError("Invalid cursor")
+
+
+def _seek(queryset, token, size):
+    """Find the page of a queryset that follows a cursor
+
+    Returns
+    -------
+    page : `list`
+        the objects in this page
+    cursor : `str`
+        the token for the next page, or `None` if this is the last
+    """
+    opts = queryset.model._meta
+    ordering = list(queryset.query.order_by)
+    keys = []
+    for order in ordering:
+        name = order.lstrip('-')
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            raise ParseError("Cannot use a cursor to sort by %r" % name)
+        if field.null:
+            raise ParseError("Cannot use a cursor to sort by %r, which "
+                             "may be null" % name)
+        keys.append((name, field, order.startswith('-')))
+        if field.unique:  # later keys can't change the order
+            break
+    else:  # make the order unique
+        ordering.append('pk')
+        keys.append(('pk', opts.pk, False))
+    ordering = ordering[:len(keys)]
+    queryset = queryset.order_by(*ordering)
+
+    if token is not None:
+        data = _decode_cursor(token)
+        try:
+            if data['o'] != ordering or len(data['v']) != len(keys):
+                raise ValueError
+            values = [field.to_python(value) for
+                      (_, field, _), value in zip(keys, data['v'])]
+        except (KeyError, TypeError, ValueError, ValidationError):
+            raise ParseError("Cursor does not match this query")
+        # (a, b) > (x, y) is (a > x) | (a == x & b > y)
+        after = []
+        for i, (name, _, desc) in enumerate(keys):
+            match = dict((keys[j][0], values[j]) for j in range(i))
+            match['%s__%s' % (name, 'lt' if desc else 'gt')] = values[i]
+            after.append(Q(**match))
+        # repeat the first key as a plain range, which databases can
+        # answer from an index more easily than the OR
+        first, _, desc = keys[0]
+        queryset = queryset.filter(
+            Q(**{'%s__%s' % (first, 'lte' if desc else 'gte'): values[0]}),
+            reduce(Q.__or__, after))
+
+    page = list(queryset[:size+1])
+    if len(page) <= size:
+        return page, None
+    page = page[:size]
+    return page, _encode_cursor({
+        'o': ordering,
+        'v': [field.value_from_object(page[-1]) for _, field, _ in keys],
+    })
+
+
+def _skip(object_list, token, size):
+    """Find the page of an in-memory result that follows a cursor
+    """
+    start = 0
+    if token is not None:
+        try:
+            start = int(_decode_cursor(token)['i'])
+        except (KeyError, TypeError, ValueError):
+            raise ParseError("Cursor does not match this query")
+    page = list(object_list[start:start+size+1])
+    if len(page) <= size:
+        return page, None
+    return page[:size], _encode_cursor({'i': start + size})
 
 
 class ChannelSerializer(serializers.ModelSerializer):
@@ -133,11 +364,17 @@ class ChannelSerializer(serializers.ModelSerializer):
         return obj.ifo.name
 
     def get_status(self, obj):
-        if not obj.is_current:
-            return "obsolete"
-        elif obj.acquire == 0:
-            return "testpoint"
-        return "acquired"
+        return _status(obj.is_current, obj.acquire)
+
+
+def _status(is_current, acquire):
+    """Returns the status of a channel, as shown in the grid
+    """
+    if not is_current:
+        return "obsolete"
+    elif acquire == 0:
+        return "testpoint"
+    return "acquired"
 
 
 class ChannelList(DojoJsonRestApiView):
@@ -146,9 +383,24 @@ class ChannelList(DojoJsonRestApiView):
     ### GET PARAMS
     When retrieving Channels, you may use the following query parameters:
 
-    * `q=RE` : Query on channel name against regular expression, RE.
-    * `sort=S` : Sort channels based on column, eg: -name
+    * `q=Q` : Query on channel name, space-separated terms are ANDed,
+      and `|` separates alternatives, eg: `H1: pem | H2: PSL`.
+      Terms starting `tok:` match whole name components, eg: `tok:DARM`.
+    * `q=/RE/` : Query on channel name against regular expression, RE.
+    * `current_only=0` : Include channels that are no longer current
+    * `F=V` : Only channels whose field F is V, or any of the
+      comma-separated values V, where F is one of `datarate`, `datatype`,
+      `dcuid`, `source`, `ifo`, `subsystem` (case-sensitive) or
+      `is_testpoint` (`1` or `0`), eg: `datatype=4,5`
+    * `F__gt=N`, `F__gte=N`, `F__lt=N`, `F__lte=N` : Only channels whose
+      numeric field F (`datarate`, `datatype` or `dcuid`) is greater
+      than, at least, less than, or at most N, eg: `datarate__gte=16384`
+    * `sort=S` : Sort channels based on one or more comma-separated
+      columns, eg: `-datarate,name`
     * `page_size=N`: Paginated results should have N channels per page
+    * `cursor=C` : Return the page after the continuation token C (or the
+      first page if C is empty), with the URL of the `next` page, this
+      costs the same for every page, however deep
 
     This resource also conforms to Dojo's dojo.store.JsonRest API with
     respect to partial retrievals specified via `Range:` request headers.
@@ -172,24 +424,123 @@ class ChannelList(DojoJsonRestApiView):
     def pre_save(self, obj):
         obj.createdby = self.request.user.username
 
-    def filter_queryset(self, queryset):
+    def search_params(self):
+        """Returns the normalised search parameters for this request
+
+        Returns
+        -------
+        query : `str`
+            the channel name query, with case and spacing normalised
+            (except for regular expressions)
+        current_only : `bool`
+            whether to only return current channels
+        sort : `str`
+            the comma-separated sort fields
+        filters : `list` of `tuple`
+            the sorted ``(key, value)`` field filters, see
+            `Channel.field_query`
+        """
         request = self.request
 
-        query = request.GET.get('q', '')
+        query = request.GET.get('q', '').strip()
+        if not (len(query) > 1 and query[0] == query[-1] == '/'):
+            query = ' | '.join(' '.join(term.split()) for
+                               term in query.lower().split('|'))
         current_only = request.GET.get('current_only', "1") == "1"
-        queryset = queryset.filter(Channel.user_query(query))
+        sort = request.GET.get('sort', '')
+        # Some fields are named slightly differently in our grid.
+        # XXX this is not general.
+        sort = sort.replace("_item", "name").replace("modified", "created")
+        keys = []
+        for key in sort.split(','):
+            # Need strip() as Dojo forgets to encode the '+'
+            # by the time it gets here,  it is decoded as ' '
+            key = key.strip().lstrip('+')
+            if not key:
+                continue
+            if key.lstrip('-') not in Channel.SORT_FIELDS:
+                raise ParseError("Cannot sort by %r, choose from: %s"
+                                 % (key, ', '.join(Channel.SORT_FIELDS)))
+            keys.append(key)
+        filters = sorted((key, value) for key in request.GET for
+                         value in request.GET.getlist(key) if
+                         key.partition('__')[0] in Channel.FILTER_FIELDS)
+        return query, current_only, ','.join(keys), filters
+
+    def get_result_cache_key(self):
+        """Cache results for each set of search parameters, until the
+        next ingest
+        """
+        params = json.dumps(self.search_params())
+        return 'channels-%d-%s' % (
+            catalogue.generation(),
+            hashlib.sha1(params.encode('utf-8')).hexdigest())
+
+    def estimate_count(self):
+        """Estimate the number of results from the channel catalogue
+
+        The catalogue only holds names, so field filters are always
+        counted exactly.
+        """
+        query, current_only, _, filters = self.search_params()
+        if filters:
+            return None
+        return catalogue.get_catalogue().estimate_count(
+            query, current_only=current_only)
+
+    def search_queryset(self, queryset, query, current_only, filters=()):
+        """Filter a queryset by the (normalised) search parameters
+
+        Unlike `filter_queryset`, this always returns a `QuerySet`,
+        and doesn't sort it.
+        """
+        try:
+            queryset = queryset.filter(Channel.field_query(filters))
+        except ValueError as exc:
+            raise ParseError(str(exc))
+        if len(query) > 1 and query[0] == query[-1] == '/':
+            # match in Python, as the database's regular expressions
+            # differ, and let the database sort or group the matches
+            # (large results are matched by the database)
+            try:
+                regex = catalogue.compile_pattern(query[1:-1])
+            except ValueError as exc:
+                raise ParseError(str(exc))
+            queryset = catalogue.get_catalogue().search(
+                regex, current_only=current_only).filter(queryset)
+        else:
+            queryset = queryset.filter(Channel.user_query(query))
         if current_only:
             queryset = queryset.filter(is_current=1)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        query, current_only, sort, filters = self.search_params()
+
+        # /RE/ is a regular expression, which is matched against the
+        # in-memory catalogue of channel names, results that are to be
+        # sorted or filtered by something other than the name are then
+        # found in the database (see search_queryset)
+        if (sort in ('', 'name') and not filters and len(query) > 1 and
+                query[0] == query[-1] == '/'):
+            try:
+                regex = catalogue.compile_pattern(query[1:-1])
+            except ValueError as exc:
+                raise ParseError(str(exc))
+            return catalogue.get_catalogue().search(
+                regex, current_only=current_only)
+        queryset = self.search_queryset(queryset, query, current_only,
+                                        filters)
 
-        sort = request.GET.get('sort', '')
         if sort:
-            # Some fields are named slightly differently in our grid.
-            # XXX this is not general.
-            sort = sort.replace("_item", "name").replace("modified", "created")
-            for s in sort.split(','):
-                # Need strip() as Dojo forgets to encode the '+'
-                # by the time it gets here,  it is decoded as ' '
-                queryset = queryset.order_by(s.strip())
+            keys = sort.split(',')
+            # break ties by name, so that pages don't overlap, and
+            # each sort can use an index (see Channel.Meta), in the
+            # direction of the last key, so the index can be read
+            # backwards for descending sorts
+            if not set(k.lstrip('-') for k in keys) & set(['name', 'id']):
+                keys.append('-name' if keys[-1].startswith('-') else 'name')
+            queryset = queryset.order_by(*keys)
 
         return queryset
 
@@ -216,9 +567,122 @@ class Cis(APIView):
             'channels': reverse('api-channels', request=request, format=format),
             'descriptions': reverse('api-descriptions', request=request,
                                     format=format),
+            'complete': reverse('api-complete', request=request,
+                                format=format),
+            'facets': reverse('api-facets', request=request,
+                              format=format),
         })
 
 
+class ChannelCompletion(APIView):
+    """Complete a partial channel name
+
+    ### GET PARAMS
+
+    * `prefix=P` : the start of the channel name (case-insensitive)
+    * `limit=N` : return at most N completions (default: 10, max: 100)
+    * `current_only=0` : Include channels that are no longer current
+
+    The response gives the first `limit` names that start with the
+    prefix, the `count` of all such names, and the `branches` that
+    follow the prefix: one for each distinct next character, with the
+    extended prefix, and the number of names that start with it.
+    """
+    permission_classes = (CisApiPermission,)
+
+    max_limit = 100
+
+    def get(self, request, format=None):
+        prefix = request.GET.get('prefix', '')
+        try:
+            limit = min(int(request.GET.get('limit', 10)), self.max_limit)
+        except ValueError:
+            raise ParseError("limit must be an integer")
+        current_only = request.GET.get('current_only', "1") == "1"
+
+        names = catalogue.get_catalogue()
+        completions, branches, count = names.complete(
+            prefix, limit=limit, current_only=current_only)
+        # the catalogue is lower-case, so get the real names
+        ids = ([names.ids[i] for i in completions] +
+               [names.ids[i] for i, _ in branches])
+        real = dict(Channel.objects.filter(id__in=ids).values_list(
+            'id', 'name'))
+        n = len(prefix)
+        return Response({
+            'prefix': prefix,
+            'count': count,
+            'completions': [real[names.ids[i]] for i in completions if
+                            names.ids[i] in real],
+            'branches': [{'prefix': real[names.ids[i]][:n+1], 'count': c}
+                         for i, c in branches if names.ids[i] in real],
+        })
+
+
+class ChannelFacets(ChannelList):
+    """Count channels by IFO, subsystem, status, datarate and datatype
+
+    ### GET PARAMS
+
+    * `q=Q` : Count only channels matching the query, as for the
+      channel list, including `q=/RE/` regular expressions
+    * `current_only=0` : Include channels that are no longer current
+    * field filters, eg: `datarate__gte=16384`, as for the channel list
+
+    The response gives the total `count` of matching channels, and,
+    for each facet, a list of `{"value": V, "count": N}` pairs, in
+    order of value.
+    Counts are cached until the next ingest.
+    """
+    #: the facets, in the order they are grouped
+    FACETS = ('ifo', 'subsystem', 'status', 'datarate', 'datatype')
+
+    def get(self, request, format=None):
+        query, current_only, _, filters = self.search_params()
+        params = json.dumps([query, current_only, filters])
+        key = 'facets-%d-%s' % (
+            catalogue.generation(),
+            hashlib.sha1(params.encode('utf-8')).hexdigest())
+        data = cache.get(key)
+        if data is None:
+            data = self.get_facets(query, current_only, filters)
+            cache.set(key, data, self.result_cache_timeout)
+        return Response(data)
+
+    def get_facets(self, query, current_only, filters=()):
+        """Count the matching channels in each facet
+
+        All facets are counted from a single ``GROUP BY`` over the
+        combination of facet columns, which has few enough rows to
+        be summed here.
+        """
+        queryset = self.search_queryset(Channel.objects.all(), query,
+                                        current_only, filters)
+        groups = queryset.order_by().values(
+            'ifo__name', 'subsystem', 'is_current', 'acquire', 'datarate',
+            'datatype').annotate(count=Count('id'))
+
+        total = 0
+        counts = dict((facet, {}) for facet in self.FACETS)
+        for row in groups:
+            n = row['count']
+            total += n
+            for facet, value in (
+                    ('ifo', row['ifo__name']),
+                    ('subsystem', row['subsystem']),
+                    ('status', _status(row['is_current'], row['acquire'])),
+                    ('datarate', row['datarate']),
+                    ('datatype', row['datatype'])):
+                counts[facet][value] = counts[facet].get(value, 0) + n
+
+        facets = dict((facet, [{'value': value, 'count': n} for
+                               value, n in sorted(counts[facet].items())])
+                      for facet in self.FACETS)
+        for item in facets['datatype']:
+            item['name'] = Channel.DATATYPE.get(item['value'], 'Unknown')
+        return {'query': query, 'count': total, 'facets': facets}
+
+
 class DescriptionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Description
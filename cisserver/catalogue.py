@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Brian Moe (2013-2014), Duncan Macleod (2014-)
+#
+# This file is part of LIGO CIS Core.
+#
+# LIGO CIS Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LIGO CIS Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory catalogue of channel names for searches and completion
+
+Databases don't agree on a regular expression syntax, and can't use an
+index for most patterns, so regular expressions are matched in Python
+against a `Catalogue` of every channel name. The catalogue holds the
+(lower-case) names in order as a single newline-separated string, with
+`array` columns for the IDs and status of each channel, which keeps it
+small enough to hold a million names in each server process. As the
+names are sorted, the catalogue also serves prefix completions.
+
+The catalogue is refreshed when ingest starts a new `Generation` of the
+channel table, see `bump`.
+"""
+
+import re
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import timedelta
+from itertools import (chain, compress, count, islice)
+
+try:
+    from itertools import imap
+except ImportError:  # python3
+    imap = map
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+try:
+    unichr
+except NameError:  # python3
+    unichr = chr
+
+from django.db import connections
+from django.utils import timezone
+
+from . import version
+from .models import (Channel, ChannelToken, Generation)
+from .names import LRUCache
+
+__version__ = version.version
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__credits__ = 'The LIGO Scientific Collaboration, The LIGO Laboratory'
+
+#: name of the `Generation` of the channel table
+GENERATION = 'catalogue'
+
+#: number of search results to keep for each catalogue
+CACHE_SIZE = 64
+
+#: number of matches stored by each search result, later pages are
+#: found by searching again, so that the cache stays small
+RESULT_SIZE = 10000
+
+#: most matches to select by ID in `SearchResult.filter`
+FILTER_SIZE = 2000
+
+#: number of names split from the text at a time by a full scan
+SCAN_BLOCK = 1000
+
+#: how far back to look for channels modified during the last load
+REFRESH_OVERLAP = timedelta(hours=1)
+
+# use the literal pre-filter only if it rejects most names
+LITERAL_MIN_LENGTH = 3
+LITERAL_MAX_FRACTION = 8
+
+_LITERAL = sre_parse.LITERAL
+_AT = sre_parse.AT
+_AT_BEGINNING = (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING)
+_SUBPATTERN = sre_parse.SUBPATTERN
+
+
+def generation():
+    """Returns the current generation number of the channel table
+    """
+    return Generation.current(GENERATION)
+
+
+def bump():
+    """Start a new generation of the channel table, call after ingest
+    """
+    return Generation.bump(GENERATION)
+
+
+def compile_pattern(pattern):
+    """Compile a user regular expression
+
+    Patterns are always matched case-insensitively, in the same way as
+    other channel searches.
+
+    Raises
+    ------
+    ValueError
+        if the pattern cannot be compiled
+    """
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except (re.error, OverflowError, RuntimeError) as exc:
+        raise ValueError("Invalid regular expression %r: %s"
+                         % (pattern, exc))
+
+
+def literals(regex):
+    """Find the literal text that any match of a pattern must contain
+
+    Parameters
+    ----------
+    regex : `re.RegexObject`
+        the compiled pattern
+
+    Returns
+    -------
+    prefix : `str`
+        the lower-case text that every match must start with, if the
+        pattern is anchored to the start of the name, otherwise ``''``
+    literals : `list` of `str`
+        the lower-case pieces of text that every match must contain
+    """
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:  # can't parse, so no literals
+        return '', []
+    items = list(_iter_sequence(parsed))
+    prefix = ''
+    if items and items[0][0] == _AT and items[0][1] in _AT_BEGINNING:
+        prefix = _literal_run(items[1:])
+    runs = []
+    run = []
+    for op, av in items + [(None, None)]:
+        if op == _LITERAL:
+            run.append(av)
+        elif run:
+            runs.append(_chars(run))
+            run = []
+    return prefix, runs
+
+
+def _iter_sequence(parsed):
+    """Flatten un-quantified groups into the top-level pattern sequence
+    """
+    for op, av in parsed:
+        if op == _SUBPATTERN:
+            # av is (group, [add_flags, del_flags,] subpattern)
+            sub = av[-1]
+            for item in _iter_sequence(sub):
+                yield item
+        else:
+            yield op, av
+
+
+def _literal_run(items):
+    run = []
+    for op, av in items:
+        if op != _LITERAL:
+            break
+        run.append(av)
+    return _chars(run)
+
+
+def _chars(codes):
+    return ''.join(map(unichr, codes)).lower()
+
+
+class Catalogue(object):
+    """A compact, read-only list of every channel name
+
+    Parameters
+    ----------
+    rows : `iterable` of `tuple`
+        ``(id, name, is_current)`` for each channel
+    generation : `int`, optional
+        the `Generation` of the channel table these rows came from
+    loaded : `datetime.datetime`, optional
+        the time these rows were read from the database
+    """
+    def __init__(self, rows, generation=0, loaded=None):
+        self.generation = generation
+        self.loaded = loaded
+        self._build(sorted((name.lower(), id_, bool(current)) for
+                           id_, name, current in rows))
+
+    def _build(self, entries):
+        """Fill the columns from sorted ``(name, id, current)`` entries
+        """
+        self.ids = array('l', (row[1] for row in entries))
+        self.current = array('b', (row[2] for row in entries))
+        self.ncurrent = sum(self.current)
+        # offset of each name in the text, and the end of the last
+        self.offsets = array('l', [0])
+        pos = 0
+        for row in entries:
+            pos += len(row[0]) + 1
+            self.offsets.append(pos)
+        self.text = ''.join(row[0] + '\n' for row in entries)
+        self._results = LRUCache(CACHE_SIZE)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_db(cls, gen=None):
+        """Load the catalogue from the database
+        """
+        if gen is None:
+            gen = generation()
+        loaded = timezone.now()
+        rows = Channel.objects.values_list(
+            'id', 'name', 'is_current').iterator()
+        return cls(rows, generation=gen, loaded=loaded)
+
+    def refresh(self, gen=None):
+        """Returns a copy of this catalogue, updated from the database
+
+        Only the channels modified by ingest since this catalogue was
+        loaded are read from the database. If any channels were renamed
+        or deleted, the whole catalogue is loaded again.
+
+        Returns
+        -------
+        catalogue : `Catalogue`
+            the updated catalogue
+        """
+        if gen is None:
+            gen = generation()
+        if self.loaded is None:
+            return self.from_db(gen)
+        loaded = timezone.now()
+        changed = Channel.objects.filter(
+            created__gte=self.loaded - REFRESH_OVERLAP).values_list(
+            'id', 'name', 'is_current')
+        current = array('b', self.current)
+        new = []
+        for id_, name, is_current in changed.iterator():
+            name = name.lower()
+            i = self._bisect(name)
+            if i < len(self) and self.ids[i] == id_ and self.name(i) == name:
+                current[i] = bool(is_current)
+            else:
+                new.append((name, id_, bool(is_current)))
+        if len(self) + len(new) != Channel.objects.count():
+            return self.from_db(gen)
+
+        copy = object.__new__(type(self))
+        copy.generation = gen
+        copy.loaded = loaded
+        if new:
+            names = self.text.split('\n')
+            names.pop()  # text ends with a newline
+            copy._build(sorted(chain(zip(names, self.ids, current), new)))
+        else:  # only the status of some channels changed
+            copy.ids = self.ids
+            copy.offsets = self.offsets
+            copy.text = self.text
+            copy.current = current
+            copy.ncurrent = sum(current)
+            copy._results = LRUCache(CACHE_SIZE)
+            copy._lock = threading.Lock()
+        return copy
+
+    def __len__(self):
+        return len(self.ids)
+
+    def name(self, index):
+        """Returns the (lower-case) name at the given index
+        """
+        return self.text[self.offsets[index]:self.offsets[index+1]-1]
+
+    def prefix_range(self, prefix):
+        """Returns the range of indices of names with the given prefix
+
+        Returns
+        -------
+        lo, hi : `int`
+            the first index, and one past the last
+        """
+        prefix = prefix.lower()
+        lo = self._bisect(prefix)
+        return lo, self._bisect(prefix, right=True, lo=lo)
+
+    def complete(self, prefix, limit=10, current_only=False):
+        """Complete a partial channel name
+
+        Parameters
+        ----------
+        prefix : `str`
+            the start of the channel name
+        limit : `int`, optional, default: `10`
+            the maximum number of completions to return
+        current_only : `bool`, optional, default: `False`
+            only complete the names of current channels
+
+        Returns
+        -------
+        completions : `list` of `int`
+            the indices of the first ``limit`` names with this prefix
+        branches : `list` of `tuple`
+            ``(index, count)`` for each distinct character that follows
+            the prefix, giving the first name of each branch, and the
+            number of names in it
+        total : `int`
+            the number of names with this prefix
+        """
+        lo, hi = self.prefix_range(prefix)
+        current = self.current
+        if current_only:
+            def size(i, j):
+                return sum(current[i:j])
+        else:
+            def size(i, j):
+                return j - i
+        completions = []
+        i = lo
+        while i < hi and len(completions) < limit:
+            if current[i] or not current_only:
+                completions.append(i)
+            i += 1
+        # jump from one branch to the next, rather than looking at
+        # every name, so this only takes a few bisections per branch
+        n = len(prefix)
+        branches = []
+        i = lo
+        while i < hi:
+            name = self.name(i)
+            if len(name) == n:  # the prefix is a whole name
+                i += 1
+                continue
+            j = self._bisect(name[:n+1], right=True, lo=i, hi=hi)
+            nbranch = size(i, j)
+            if nbranch:
+                branches.append((i, nbranch))
+            i = j
+        return completions, branches, size(lo, hi)
+
+    def estimate_count(self, query, current_only=False):
+        """Estimate the number of channels matching a query
+
+        This counts the occurrences of each term of a
+        `Channel.user_query` query in the catalogue, using the rarest
+        term of each alternative, so is usually an over-estimate.
+
+        Parameters
+        ----------
+        query : `str`
+            the user query
+        current_only : `bool`, optional, default: `False`
+            only count current channels
+
+        Returns
+        -------
+        count : `int`
+            the estimated number of matching channels
+        """
+        if not len(self):
+            return 0
+        total = 0
+        for term in query.lower().split('|'):
+            counts = []
+            for aterm in term.split():
+                if aterm.startswith(ChannelToken.PREFIX):
+                    aterm = aterm[len(ChannelToken.PREFIX):]
+                counts.append(self.text.count(aterm))
+            total += min(counts) if counts else len(self)
+        # matches needn't be spread evenly over current and retired
+        # channels, so the count isn't scaled down for current_only
+        return min(total, self.ncurrent if current_only else len(self))
+
+    def _bisect(self, prefix, right=False, lo=0, hi=None):
+        """Find the first name that is not before the prefix
+
+        With ``right=True``, find the first name after all the names
+        that start with the prefix.
+        """
+        if hi is None:
+            hi = len(self)
+        n = len(prefix)
+        name = self.name
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = name(mid)[:n]
+            if start < prefix or (right and start == prefix):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def search(self, regex, current_only=False):
+        """Find the channels whose names match a regular expression
+
+        Results are cached, so that each page of a result set can be
+        requested in turn without searching the catalogue again.
+
+        Parameters
+        ----------
+        regex : `str`, `re.RegexObject`
+            the pattern to search for anywhere in the name
+        current_only : `bool`, optional, default: `False`
+            only return current channels
+
+        Returns
+        -------
+        result : `SearchResult`
+            the lazy list of matching channels, in name order
+
+        Raises
+        ------
+        ValueError
+            if ``regex`` is not a valid regular expression
+        """
+        if not hasattr(regex, 'search'):
+            regex = compile_pattern(regex)
+        key = (regex.pattern, bool(current_only))
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                result = SearchResult(self, regex, current_only=current_only)
+                self._results.set(key, result)
+        return result
+
+    def _iter_matches(self, regex, current_only=False):
+        """Yield the index of each matching name, in order
+        """
+        prefix, runs = literals(regex)
+        # pick the rarest literal, if it is rare enough to be useful
+        counts = [] if prefix else sorted(
+            (self.text.count(run), run) for
+            run in runs if len(run) >= LITERAL_MIN_LENGTH)
+        if prefix:
+            indices = self._iter_prefix(regex, prefix)
+        elif counts and counts[0][0] * LITERAL_MAX_FRACTION < len(self):
+            indices = self._iter_literal(regex, counts[0][1])
+        else:
+            indices = self._iter_scan(regex)
+        if current_only:
+            current = self.current
+            return (i for i in indices if current[i])
+        return indices
+
+    def _iter_scan(self, regex):
+        """Test every name, at C speed
+
+        Names are split from the text a block at a time, so that a
+        partly read search only holds one block.
+        """
+        text = self.text
+        offsets = self.offsets
+        search = regex.search
+        n = len(self)
+        for lo in range(0, n, SCAN_BLOCK):
+            hi = min(lo + SCAN_BLOCK, n)
+            names = text[offsets[lo]:offsets[hi]-1].split('\n')
+            for i in compress(count(lo), imap(search, names)):
+                yield i
+
+    def _iter_prefix(self, regex, prefix):
+        """Test only the names that start with the given prefix
+        """
+        name = self.name
+        search = regex.search
+        i, hi = self.prefix_range(prefix)
+        while i < hi:
+            if search(name(i)):
+                yield i
+            i += 1
+
+    def _iter_literal(self, regex, literal):
+        """Test only the names that contain the given literal text
+        """
+        text = self.text
+        offsets = self.offsets
+        search = regex.search
+        find = text.find
+        pos = find(literal)
+        lo = 0
+        while pos != -1:
+            i = bisect_right(offsets, pos, lo) - 1
+            end = offsets[i+1]
+            # search a copy of the name, so that anchors and look-behinds
+            # can't see the neighbouring names
+            if search(text[offsets[i]:end-1]):
+                yield i
+            lo = i + 1
+            pos = find(literal, end)
+
+
+class SearchResult(object):
+    """The channels matching a regular expression, found on demand
+
+    This behaves enough like a `~django.db.models.query.QuerySet` to be
+    counted, sliced, and paginated. Slicing only searches as far through
+    the catalogue as needed to fill the slice, and the full `count` is
+    only found when asked for. Only the first ``keep`` matches are
+    stored, slices beyond those search the catalogue again.
+    """
+    def __init__(self, catalogue, regex, current_only=False,
+                 keep=RESULT_SIZE):
+        self.catalogue = catalogue
+        self.regex = regex
+        self.current_only = current_only
+        self.keep = keep
+        self._matches = catalogue._iter_matches(regex,
+                                                current_only=current_only)
+        self._found = array('l')
+        self._count = None
+        self._lock = threading.Lock()
+
+    def _fill(self, stop=None):
+        """Search until ``stop`` matches are found, or to the end
+        """
+        with self._lock:
+            found = self._found
+            if self._count is not None or (stop is not None and
+                                           len(found) >= stop):
+                return
+            limit = self.keep if stop is None else min(stop, self.keep)
+            if len(found) < limit:
+                for i in self._matches:
+                    found.append(i)
+                    if len(found) >= limit:
+                        break
+                else:
+                    self._count = len(found)
+                    self._matches = None
+                    return
+            if stop is None:  # count the rest without storing them
+                self._count = len(found) + sum(1 for _ in self._matches)
+                self._matches = None
+
+    def count(self):
+        """Returns the total number of matching channels
+        """
+        self._fill()
+        return self._count
+
+    __len__ = count
+
+    def ids(self, start=0, stop=None):
+        """Returns the IDs of the matching channels in the given range
+        """
+        self._fill(stop)
+        found = self._found
+        if self._count == len(found) or (stop is not None and
+                                         stop <= len(found)):
+            indices = found[start:stop]
+        else:  # beyond the stored matches
+            indices = islice(self.catalogue._iter_matches(
+                self.regex, current_only=self.current_only), start, stop)
+        ids = self.catalogue.ids
+        return [ids[i] for i in indices]
+
+    def filter(self, queryset):
+        """Restrict a `Channel` queryset to the matching channels
+
+        This lets the database sort or group the channels matched by
+        the catalogue. Results of up to `FILTER_SIZE` channels are
+        selected by ID. Larger results would need too large a query,
+        so they are matched by the database's own regular expressions
+        (``name__iregex``) instead, whose syntax may differ slightly.
+        With ``current_only``, the caller should also filter the
+        queryset on ``is_current``.
+
+        Returns
+        -------
+        queryset : `~django.db.models.query.QuerySet`
+            the filtered queryset
+        """
+        limit = min(FILTER_SIZE, connections[queryset.db].ops
+                    .bulk_batch_size(['pk'], range(FILTER_SIZE)))
+        ids = self.ids(0, limit + 1)
+        if len(ids) <= limit:
+            return queryset.filter(pk__in=ids)
+        total = (self.catalogue.ncurrent if self.current_only else
+                 len(self.catalogue))
+        if self.count() == total:  # everything matches
+            return queryset
+        return queryset.filter(name__iregex=self.regex.pattern)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1) or (key.start or 0) < 0 or (
+                    key.stop is not None and key.stop < 0):
+                raise ValueError("Only positive, contiguous slices "
+                                 "are supported")
+            ids = self.ids(key.start or 0, key.stop)
+            channels = Channel.objects.select_related('ifo').in_bulk(ids)
+            return [channels[id_] for id_ in ids if id_ in channels]
+        channels = self[key:key+1]
+        if not channels:
+            raise IndexError(key)
+        return channels[0]
+
+    def __iter__(self):
+        return iter(self[0:None])
+
+
+_catalogue = None
+_lock = threading.Lock()
+
+
+def get_catalogue():
+    """Returns the catalogue for the current generation of channels
+
+    The catalogue is shared by every request handled by this process,
+    and is refreshed from the database after each ingest.
+    """
+    global _catalogue
+    gen = generation()
+    with _lock:
+        if _catalogue is None:
+            _catalogue = Catalogue.from_db(gen)
+        elif _catalogue.generation != gen:
+            _catalogue = _catalogue.refresh(gen)
+        return _catalogue
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Brian Moe (2013-2014), Duncan Macleod (2014-)
+#
+# This file is part of LIGO CIS Core.
+#
+# LIGO CIS Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LIGO CIS Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ...models import (Channel, ChannelToken, ChannelTrigram)
+from ... import version
+
+__version__ = version.version
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__credits__ = 'The LIGO Scientific Collaboration, The LIGO Laboratory'
+
+
+def create_trigram_index():
+    """Create a ``pg_trgm`` index of channel names on PostgreSQL
+
+    PostgreSQL uses this index for ``name__icontains`` lookups (which it
+    runs as ``UPPER(name) LIKE UPPER(...)``) directly, so searches are
+    unchanged. Other databases use the portable `ChannelTrigram` table
+    instead.
+
+    Returns
+    -------
+    created : `bool`
+        `True` if the index was created
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    table = Channel._meta.db_table
+    index = '%s_name_trgm' % table
+    with connection.cursor() as cursor:
+        # CREATE INDEX IF NOT EXISTS needs PostgreSQL 9.5
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s "
+                       "AND relkind = 'i'", [index])
+        if cursor.fetchone():
+            return False
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cursor.execute('CREATE INDEX %s ON %s USING gin '
+                       '(UPPER(name) gin_trgm_ops)' % (index, table))
+    return True
+
+
+class Command(BaseCommand):
+    """Build the indexes of channel names used to answer searches
+    """
+    help = __doc__.rstrip('\n ')
+
+    def handle(self, *args, **kwargs):
+        """Rebuild the search indexes for all channels
+        """
+        ChannelToken.build_index()
+        ChannelTrigram.build_index()
+        create_trigram_index()
@@ -28,7 +28,7 @@ from reversion import revisions as reversion
 
 import ligo.org
 
-from ... import version
+from ... import (catalogue, tree as channel_tree, version)
 from .. import functions
 
 __version__ = version.version
@@ -43,7 +43,7 @@ DAQURLS = [
 
 class Command(BaseCommand):
     """Update the CIS database by downloading and parsing DAQ INI files
-    from the given URLs
+    from the given URLs, or reading them from local directories or archives
     """
     help = __doc__.rstrip('\n ')
 
@@ -54,7 +54,8 @@ class Command(BaseCommand):
         """
         parser.add_argument(
             'url', nargs='*', default=DAQURLS,
-            help='URL to query for DAQ INI files, default: %(default)s')
+            help='URL to query for DAQ INI files, or a local directory, or '
+                 'tar or zip archive of INI files, default: %(default)s')
         parser.add_argument('-i', '--ifo',
                             help='only process model files for this IFO')
         parser.add_argument(
@@ -64,32 +65,118 @@ class Command(BaseCommand):
             '-t', '--skip-update-tree-nodes', action='store_true',
             default=False, help='do not update tree nodes database after '
                                 'update channels, default: %(default)s')
+        parser.add_argument(
+            '--rebuild-tree', action='store_true', default=False,
+            help='check every current channel against the tree nodes '
+                 'database, rather than only adding and removing the '
+                 'channels changed by this update, default: %(default)s')
+        parser.add_argument(
+            '-b', '--bulk', action='store_true', default=False,
+            help='load and write channels for each model, and the channel '
+                 'tree, in bulk, rather than one at a time, '
+                 'default: %(default)s')
+        parser.add_argument(
+            '-j', '--threads', type=int, default=8,
+            help='number of INI files to download in parallel, '
+                 'default: %(default)s')
+        parser.add_argument(
+            '--max-per-host', type=int, default=4,
+            help='maximum number of parallel downloads from a single '
+                 'host, default: %(default)s')
+        parser.add_argument(
+            '-f', '--force', action='store_true', default=False,
+            help='process all INI files, even those that have not changed '
+                 'since the last update, default: %(default)s')
+        parser.add_argument(
+            '-w', '--workers', type=int, default=1,
+            help='number of processes to use to parse INI files, '
+                 'default: %(default)s')
+        parser.add_argument(
+            '--history', choices=['reversion', 'changeset'],
+            default='reversion',
+            help='how to record channel changes, either a full revision of '
+                 'each channel, or a single change-set of changed fields '
+                 'for the whole run, default: %(default)s')
 
-    def handle(self, url=[], ifo=None, keytab=None, **kwargs):
+    def handle(self, url=[], ifo=None, keytab=None, bulk=False, threads=8,
+               max_per_host=4, force=False, history='reversion', workers=1,
+               rebuild_tree=False, **kwargs):
         """Update the CIS database from DAQ INI files in the given directories
         """
         verbose = kwargs.get('verbosity', 0)
         if isinstance(url, str):
             url = url.split(',')
         # authenticate with LIGO.ORG credentials
-        try:
-            ligo.org.klist(keytab=keytab)
-        except ligo.org.KerberosError:
-            ligo.org.kinit(keytab=keytab)
-        # loop over each URL, download the INI file and update the channels
-        for u in url:
-            if verbose:
-                print("Querying %s:" % u)
-            for f, conf in functions.iterate_daq_ini_files(u):
-                if ifo is not None and not f.lower().startswith(ifo.lower()):
-                    continue
-                mifo = ifo or os.path.basename(f[:2])
-                if mifo.lower() in ['virgo', 'v0', 'v1']:
-                    update_model = functions.update_virgo_model
-                else:
-                    update_model = functions.update_ligo_model
-                update_model(conf, f, verbose=verbose, created_by='CDS')
-                reset_queries()
+        if any(map(functions.is_remote, url)):
+            try:
+                ligo.org.klist(keytab=keytab)
+            except ligo.org.KerberosError:
+                ligo.org.kinit(keytab=keytab)
+        # only download model files for the requested IFO
+        if ifo is not None:
+            def select(f):
+                return f.lower().startswith(ifo.lower())
+        else:
+            select = None
+        # download the INI files from all URLs and update the channels
+        if verbose:
+            print("Querying %s:" % ', '.join(url))
+        cache = functions.DaqFileCache(force=force)
+        registry = functions.IfoSubsystemRegistry()
+        if history == 'changeset':
+            changeset = functions.ChangeSetRecorder(
+                comment='update_from_daq', createdby='CDS')
+        else:
+            changeset = None
+        tree = functions.TreeChanges()
+        if workers > 1:
+            files = functions.iterate_parsed_daq_ini_files(
+                url, workers, nthreads=threads, max_per_host=max_per_host,
+                select=select, cache=cache, created_by='CDS')
+        else:
+            files = ((f, conf, None) for f, conf in
+                     functions.iterate_daq_ini_files(
+                         url, nthreads=threads, max_per_host=max_per_host,
+                         select=select, cache=cache))
+        seen = set()
+        nfiles = 0
+        for f, conf, parsed in files:
+            nfiles += 1
+            mifo = ifo or os.path.basename(f[:2])
+            if mifo.lower() in ['virgo', 'v0', 'v1']:
+                functions.update_virgo_model(conf, f, verbose=verbose)
+            else:
+                # the parsed channels were compared against the database
+                # as it was before this run, so if a channel was in an
+                # earlier file, parse this one again to get the changes
+                if parsed is not None:
+                    names = parsed.names
+                    if not seen.isdisjoint(names):
+                        parsed = None
+                    seen.update(names)
+                functions.update_ligo_model(conf, f, verbose=verbose,
+                                            created_by='CDS', bulk=bulk,
+                                            registry=registry,
+                                            changeset=changeset,
+                                            parsed=parsed, tree=tree)
+            reset_queries()
+        if changeset is not None:
+            changeset.flush()
+        # start a new generation of the in-memory channel catalogue
+        if nfiles:
+            catalogue.bump()
+        if verbose:
+            print(cache.summary())
+            if changeset is not None:
+                print("Recorded %d channel changes" % changeset.count)
         # now update the tree_node database for new channels
-        if not kwargs.pop('skip_update_tree_nodes', False):
-            functions.update_tree_nodes(verbose=verbose)
+        if kwargs.pop('skip_update_tree_nodes', False):
+            return
+        gen = channel_tree.generation()
+        if rebuild_tree:
+            functions.update_tree_nodes(verbose=verbose, bulk=bulk)
+        else:
+            functions.update_tree(tree, verbose=verbose)
+        # render the top of the new tree, for a shared cache
+        if channel_tree.generation() != gen:
+            channel_tree.precompute()
@@ -19,7 +19,7 @@
 from django.core.management.base import BaseCommand
 
 from ..functions import update_tree_nodes
-from ... import version
+from ... import (tree as channel_tree, version)
 
 __version__ = version.version
 __author__ = 'Brian Moe, Duncan.macleod <duncan.macleod@ligo.org>'
@@ -31,7 +31,21 @@ class Command(BaseCommand):
     """
     help = __doc__.rstrip('\n ')
 
+    def add_arguments(self, parser):
+        """Add arguments to the command-line parser
+
+        This function is only used for Django >= 1.8
+        """
+        parser.add_argument(
+            '-b', '--bulk', action='store_true', default=False,
+            help='build the tree in memory and insert new nodes in bulk, '
+                 'rather than adding one channel at a time, '
+                 'default: %(default)s')
+
     def handle(self, *args, **kwargs):
         """Update tree nodes across the entire database
         """
-        update_tree_nodes(verbose=kwargs.get('verbosity', 1))
+        update_tree_nodes(verbose=kwargs.get('verbosity', 1),
+                          bulk=kwargs.get('bulk', False))
+        # render the top of the new tree, for a shared cache
+        channel_tree.precompute()
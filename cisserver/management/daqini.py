@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Brian Moe (2013-2014), Duncan Macleod (2014-)
+#
+# This file is part of LIGO CIS Core.
+#
+# LIGO CIS Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LIGO CIS Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming parser for DAQ INI files
+
+DAQ INI files written by the front-end model builds contain a single
+lowercase ``[default]`` section, followed by one section per channel.
+The `iter_daq_ini` parser reads these one line at a time, holding only
+the current section in memory, and gives the same results as reading the
+whole file with `ConfigParser` (see `read_daq_ini_configparser`).
+"""
+
+import mmap
+import re
+
+try:
+    from ConfigParser import (ConfigParser, MissingSectionHeaderError,
+                              ParsingError, InterpolationDepthError,
+                              InterpolationMissingOptionError,
+                              MAX_INTERPOLATION_DEPTH)
+except ImportError:
+    from configparser import (ConfigParser, MissingSectionHeaderError,
+                              ParsingError, InterpolationDepthError,
+                              InterpolationMissingOptionError,
+                              MAX_INTERPOLATION_DEPTH)
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from .. import version
+
+__version__ = version.version
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__credits__ = 'The LIGO Scientific Collaboration, The LIGO Laboratory'
+
+# same patterns as ConfigParser
+SECTCRE = re.compile(r'\[(?P<header>[^]]+)\]')
+OPTCRE = re.compile(r'(?P<option>[^:=\s][^:=]*)\s*(?P<vi>[:=])\s*'
+                    r'(?P<value>.*)$')
+KEYCRE = re.compile(r"%\(([^)]*)\)s|.")
+# SECTCRE for each line (but the first) of a memory-mapped buffer
+HEADERCRE = re.compile(br'\n\[([^]\n]+)\]')
+
+try:
+    string_types = basestring
+except NameError:  # python3
+    string_types = str
+
+DEFAULT_SECTIONS = ('default', 'DEFAULT')
+
+
+def iter_daq_ini(source, extra=None):
+    """Iterate over the channels defined in a DAQ INI file
+
+    Parameters
+    ----------
+    source : `str`, `file`, `mmap.mmap`
+        path of file to read (which will be memory-mapped), an open
+        file, or a memory-mapped buffer
+    extra : `dict`, optional
+        additional defaults for every channel, these override the values
+        in the ``[default]`` section of the file, but not those given
+        for individual channels
+
+    Yields
+    ------
+    (`str`, `dict`)
+        the name and parameters of each channel, with defaults applied
+
+    Notes
+    -----
+    `ConfigParser` merges sections that appear more than once, and
+    applies a ``[default]`` section to every channel, wherever it
+    appears, so neither can be streamed. The section headers are
+    scanned first, and files with either are read with
+    `read_daq_ini_configparser` instead.
+
+    Raises
+    ------
+    MissingSectionHeaderError, ParsingError, InterpolationError
+        as for `ConfigParser`
+    """
+    if isinstance(source, string_types):
+        with open(source, 'rb') as fobj:
+            try:
+                buf = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # cannot map an empty file
+                return
+            try:
+                for item in iter_daq_ini(buf, extra=extra):
+                    yield item
+            finally:
+                buf.close()
+        return
+    if not hasattr(source, 'seek'):
+        source = StringIO(''.join(_iter_lines(source)))
+    if not _can_stream(source):
+        for item in read_daq_ini_configparser(
+                StringIO(''.join(_iter_lines(source))), extra=extra):
+            yield item
+        return
+
+    defaults = {}
+    name = section = optname = None
+    nchannels = 0
+    errors = None
+
+    for lineno, line in enumerate(_iter_lines(source), 1):
+        # comment or blank line?
+        if line.strip() == '' or line[0] in '#;':
+            continue
+        if line[0] in 'rR' and line.split(None, 1)[0].lower() == 'rem':
+            continue
+        # continuation line?
+        if line[0].isspace() and section is not None and optname:
+            value = line.strip()
+            if value:
+                section[optname].append(value)
+            continue
+        # section header?
+        match = SECTCRE.match(line)
+        if match:
+            if name is not None:
+                yield name, _channel_params(name, section, defaults)
+            name = match.group('header')
+            optname = None
+            if name in DEFAULT_SECTIONS:  # only before channels
+                section = defaults
+                name = None
+            else:
+                section = {}
+                nchannels += 1
+                if nchannels == 1:  # first channel, so finalise defaults
+                    defaults = _resolve_defaults(defaults, extra)
+            continue
+        if section is None:
+            raise MissingSectionHeaderError(getattr(source, 'name', '<???>'),
+                                            lineno, line)
+        # option line?
+        match = OPTCRE.match(line)
+        if match:
+            optname, vi, optval = match.group('option', 'vi', 'value')
+            optname = optname.rstrip().lower()
+            # ';' is a comment delimiter only if it follows a space
+            if ';' in optval:
+                pos = optval.find(';')
+                if pos != -1 and optval[pos-1].isspace():
+                    optval = optval[:pos]
+            optval = optval.strip()
+            if optval == '""':
+                optval = ''
+            section[optname] = [optval]
+        else:
+            if errors is None:
+                errors = ParsingError(getattr(source, 'name', '<???>'))
+            errors.append(lineno, repr(line))
+
+    if errors is not None:
+        raise errors
+    if name is not None:
+        yield name, _channel_params(name, section, defaults)
+
+
+def _can_stream(source):
+    """Returns `True` if a file has no repeated sections, and no
+    ``[default]`` section after the first channel
+
+    The position of the ``source`` is restored after reading.
+    """
+    pos = source.tell()
+    if isinstance(source, mmap.mmap):
+        headers = (HEADERCRE.findall(b'\n' + source.readline()) +
+                   HEADERCRE.findall(source))
+        if str is not bytes:  # python3
+            headers = [h.decode('utf-8') for h in headers]
+    else:
+        headers = [m.group('header') for m in
+                   map(SECTCRE.match, _iter_lines(source)) if m]
+    source.seek(pos)
+    seen = set()
+    for name in headers:
+        if name in DEFAULT_SECTIONS:
+            if seen:
+                return False
+        elif name in seen:
+            return False
+        else:
+            seen.add(name)
+    return True
+
+
+def _iter_lines(source):
+    """Iterate over the lines in a file, or memory-mapped buffer
+    """
+    if isinstance(source, mmap.mmap):
+        lines = iter(source.readline, b'')
+    else:
+        lines = source
+    if str is bytes:  # python2
+        for line in lines:
+            yield line
+    else:
+        for line in lines:
+            yield line.decode('utf-8') if isinstance(line, bytes) else line
+
+
+def _join(section):
+    """Join multi-line option values
+    """
+    return dict((key, '\n'.join(val) if isinstance(val, list) else val)
+                for key, val in section.items())
+
+
+def _resolve_defaults(defaults, extra=None):
+    """Interpolate the ``[default]`` section and apply the extra defaults
+    """
+    defaults = _join(defaults)
+    defaults = dict((key, _interpolate(key, val, defaults)) for
+                    key, val in defaults.items())
+    if extra:
+        defaults.update(extra)
+    return defaults
+
+
+def _channel_params(name, section, defaults):
+    """Build the full parameter `dict` for a channel
+    """
+    params = defaults.copy()
+    for key, val in section.items():
+        params[key] = '\n'.join(val)
+    for key, val in params.items():
+        if isinstance(val, string_types) and '%(' in val:
+            params[key] = _interpolate(key, val, params, section=name)
+    return params
+
+
+def _interpolate(option, value, params, section='default'):
+    """Interpolate ``%(name)s`` references in the same way as `ConfigParser`
+    """
+    rawval = value
+    depth = MAX_INTERPOLATION_DEPTH
+    while depth:
+        depth -= 1
+        if value and '%(' in value:
+            try:
+                value = KEYCRE.sub(_interpolation_replace, value) % params
+            except KeyError as e:
+                raise InterpolationMissingOptionError(option, section,
+                                                      rawval, e.args[0])
+        else:
+            break
+    if value and '%(' in value:
+        raise InterpolationDepthError(option, section, rawval)
+    return value
+
+
+def _interpolation_replace(match):
+    key = match.group(1)
+    if key is None:
+        return match.group()
+    return '%%(%s)s' % key.lower()
+
+
+def read_daq_ini_configparser(source, extra=None):
+    """Read all channels from a DAQ INI file using `ConfigParser`
+
+    This is the reference implementation for `iter_daq_ini`, which holds
+    the whole parsed document in memory.
+
+    Parameters
+    ----------
+    source : `str`, `file`
+        path of file to read, or an open file
+    extra : `dict`, optional
+        additional defaults for every channel
+
+    Returns
+    -------
+    channels : `list` of `tuple`
+        ``(name, params)`` pairs for each channel in the file
+    """
+    cp = ConfigParser()
+    if isinstance(source, string_types):
+        cp.read(source)
+    else:
+        cp.readfp(source)
+    # DEFAULT section is probably not capitalized.
+    # Find uncapitalized DEFAULT section and include its values.
+    # (Python will not see uncapitalized default section)
+    if 'default' in cp.sections():
+        cp.defaults().update(dict(cp.items('default')))
+        cp._sections.pop('default')
+    if extra:
+        cp.defaults().update(extra)
+    return [(name, dict(cp.items(name))) for name in cp.sections()]
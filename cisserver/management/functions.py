@@ -20,23 +20,45 @@
 """
 
 from __future__ import print_function
+import hashlib
+import json
+import os
+import tarfile
+import zipfile
 import warnings
 import sys
 import re
+from collections import (OrderedDict, defaultdict, deque, namedtuple)
+from itertools import chain
+from multiprocessing import Pool
 from os.path import (basename, splitext, join)
+from threading import (BoundedSemaphore, Event, Thread)
 
 try:
-    from urllib2 import HTTPError
+    from Queue import (Queue, Empty, Full)
 except ImportError:
-    from urllib.error import HTTPError
+    from queue import (Queue, Empty, Full)
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 try:
-    from ConfigParser import ConfigParser
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+try:
+    from urllib2 import HTTPError
 except ImportError:
-    from configparser import ConfigParser
+    from urllib.error import HTTPError
 
+from django.core.exceptions import (FieldDoesNotExist, ValidationError)
 from django.db.utils import IntegrityError
-from django.db import reset_queries
+from django.db import (connections, reset_queries, transaction)
+from django.db.models import (Case, F, Value, When)
+from django.utils import timezone
 
 from reversion import revisions as reversion
 
@@ -44,15 +66,81 @@ import ligo.org
 
 from bs4 import BeautifulSoup
 
-from ..models import (Channel, Ifo, Subsystem, TreeNode)
+from .daqini import (iter_daq_ini, string_types)
+from ..models import (Channel, Ifo, Subsystem, TreeNode, DaqFile,
+                      ChangeSet, ChannelChange, ChannelToken,
+                      ChannelTrigram, bulk_saved)
+from ..names import (parse_channel_name, parse_channel_names)
+from .. import tree as channel_tree
 from .. import version
 
 __version__ = version.version
 __author__ = 'Brian Moe, Duncan.macleod <duncan.macleod@ligo.org>'
 __credits__ = 'The LIGO Scientific Collaboration, The LIGO Laboratory'
 
+#: number of rows written or selected per query in bulk mode
+BULK_CHUNK_SIZE = 500
+
+
+class IfoSubsystemRegistry(object):
+    """Run-scoped cache of `Ifo` and `Subsystem` records
+
+    Both tables are loaded once when the registry is created, and any
+    missing records are created on demand, so that ingesting a model file
+    doesn't need to query for the `Ifo` and `Subsystem` of every channel.
+    """
+    def __init__(self):
+        self.ifos = dict((ifo.name, ifo) for ifo in Ifo.objects.all())
+        self.subsystems = set(Subsystem.objects.values_list('name',
+                                                            flat=True))
+
+    def get_ifo(self, name, verbose=0):
+        """Find or create the `Ifo` with the given name
+        """
+        try:
+            return self.ifos[name]
+        except KeyError:
+            ifo = self.ifos[name] = Ifo(name=name)
+            ifo.save()
+            if verbose > 1:
+                print('    Created IFO %s [%d]' % (ifo.name, ifo.id))
+            return ifo
 
-def create_ifo_and_subsystem(channel, modelname, verbose=0):
+    def get_subsystem(self, name, verbose=0):
+        """Find or create the `Subsystem` with the given name
+
+        Returns
+        -------
+        name : `str`
+            the name of the subsystem
+        """
+        if name not in self.subsystems:
+            Subsystem(name=name).save()
+            self.subsystems.add(name)
+            if verbose > 1:
+                print('    Created subsystem %s' % name)
+        return name
+
+
+def create_ifo_and_subsystem(channel, modelname, verbose=0, registry=None):
+    """Set the `Ifo` and subsystem for a channel, if they aren't set
+
+    Parameters
+    ----------
+    channel : `Channel`
+        the channel to update
+    modelname : `str`
+        the name of the front-end model, used to find the IFO for channels
+        without an IFO prefix
+    registry : `IfoSubsystemRegistry`, optional
+        the cache to use when finding or creating records, if not given
+        a new one is loaded
+
+    Returns
+    -------
+    modified : `bool`
+        `True` if the `channel` was modified
+    """
     try:
         channel.ifo
     except AttributeError:
@@ -65,48 +153,33 @@ def create_ifo_and_subsystem(channel, modelname, verbose=0):
         newsubsystem = True
     else:
         newsubsystem = not channel.subsystem
-    # parse name
-    if newifo or newsubsystem:
-        name = channel.name
-        # parse channel name
-        try:
-            match = Channel.re_name.match(name).groupdict()
-        except AttributeError as e:
-            e.args = ('Cannot parse IFO and subsystem from channel name %r'
-                      % name,)
-            raise
-        ifo = match['ifo'] or modelname[:2]
+    if not (newifo or newsubsystem):
+        return False
+    # parse channel name
+    parsed = parse_channel_name(channel.name)
+    if parsed is None:
+        raise AttributeError('Cannot parse IFO and subsystem from channel '
+                             'name %r' % channel.name)
+    ifo = parsed.ifo or modelname[:2]
+    if registry is None:
+        registry = IfoSubsystemRegistry()
     modified = False
     # find/create IFO
     if newifo and ifo is not None:
-        try:
-            channel.ifo = Ifo.objects.get(name=ifo)
-        except Ifo.DoesNotExist:
-            ifo = Ifo(name=ifo)
-            ifo.save()
-            channel.ifo = ifo
-            if verbose > 1:
-                print('    Created IFO %s [%d]'
-                      % (channel.ifo.name, channel.ifo.id))
+        channel.ifo = registry.get_ifo(ifo, verbose=verbose)
         modified = True
     # find/create Subsystem
-    if newsubsystem and match.get('subsystem') is not None:
-        try:
-            channel.subsystem = Subsystem.objects.get(
-                name=match['subsystem']).name
-        except Subsystem.DoesNotExist:
-            subsystem = Subsystem(name=match['subsystem'])
-            subsystem.save()
-            channel.subsystem = subsystem.name
-            if verbose > 1:
-                print('    Created subsystem %s'
-                      % channel.subsystem.name)
+    if newsubsystem and parsed.subsystem is not None:
+        channel.subsystem = registry.get_subsystem(parsed.subsystem,
+                                                   verbose=verbose)
         modified = True
     return modified
 
 
-@reversion.create_revision()
-def update_ligo_model(inifile, modelname=None, verbose=False, created_by=None):
+def update_ligo_model(inifile, modelname=None, verbose=False, created_by=None,
+                      bulk=False, chunk_size=BULK_CHUNK_SIZE, retire=True,
+                      registry=None, changeset=None, parsed=None,
+                      tree=None):
     """Update the LIGO channels from the given INI file
 
     Parameters
@@ -116,40 +189,141 @@ def update_ligo_model(inifile, modelname=None, verbose=False, created_by=None):
     modelname : `str`
         the name of the front-end model. Only required if `inifile` is
         given as an open file
+    bulk : `bool`, optional, default: `False`
+        load all existing channels for this model in a single query and
+        write the differences with bulk inserts and updates, rather than
+        reading and saving each channel individually
+    chunk_size : `int`, optional
+        number of rows per query when using `bulk=True`
+    retire : `bool`, optional, default: `True`
+        mark current channels for this model that are no longer in the
+        INI file as not current
+    registry : `IfoSubsystemRegistry`, optional
+        cache of `Ifo` and `Subsystem` records, pass the same registry
+        when updating many models in a single run
+    changeset : `ChangeSetRecorder`, optional
+        record only the changed fields of each channel in this change-set,
+        rather than a full `reversion` revision of each changed channel
+    parsed : `ParsedModel`, optional
+        the channels from this file, already parsed and compared against
+        the database by `iterate_parsed_daq_ini_files`, in which case
+        `inifile` is not read
+    tree : `TreeChanges`, optional
+        record of channels added to or removed from the current set, to
+        pass to `update_tree` at the end of the run
     """
-    cp = ConfigParser()
-    # read file-like object
-    try:
-        if not modelname:
-            try:
-                modelname = inifile.name
-            except AttributeError as e:
-                e.args = ("Cannot parse model name from file-like object, "
-                          "please pass modelname=<str>",)
-                raise
-        cp.readfp(inifile)
-    # or read str pointing to file
-    except AttributeError:
-        modelname = inifile
-        cp.read(inifile)
-    modelname = splitext(basename(modelname))[0].upper()
-    reversion.set_comment(modelname)
-
-    # DEFAULT section is probably not capitalized.
-    # Find uncapitalized DEFAULT section and include its values.
-    # (Python will not see uncapitalized default section)
-    if 'default' in cp.sections():
-        cp.defaults().update(dict(cp.items('default')))
-        cp._sections.pop('default')
-    cp.defaults().update(source=modelname)
+    if parsed is not None:
+        modelname = parsed.modelname
+    else:
+        modelname = _model_name(inifile, modelname)
 
     if verbose > 1:
         print("Updating %s:" % modelname)
     elif verbose:
         print("Updating %s:" % modelname, end='\r')
-    n = len(cp._sections.keys())
 
-    for i, name in enumerate(cp.sections()):
+    if registry is None:
+        registry = IfoSubsystemRegistry()
+    history = RevisionHistory() if changeset is None else changeset
+    if tree is not None:
+        history = _Recorders([history, tree])
+    if parsed is not None:
+        names = parsed.names
+        channels = parsed.channels
+    else:
+        names = []
+        channels = _iter_params(inifile, modelname, created_by=created_by,
+                                names=names)
+
+    # with a change-set, channels saved one at a time must not also be
+    # recorded in full by the reversion signal handlers
+    with reversion.create_revision(manage_manually=changeset is not None):
+        reversion.set_comment(modelname)
+        if bulk:
+            _bulk_update_channels(channels, modelname, registry,
+                                  history, verbose=verbose,
+                                  chunk_size=chunk_size)
+        else:
+            _update_channels(channels, modelname, registry, history,
+                             verbose=verbose)
+        # an empty file is more likely a broken download than a dead model
+        if retire and names:
+            retire_channels(modelname, names, verbose=verbose,
+                            chunk_size=chunk_size, history=history)
+
+
+def _model_name(inifile, modelname=None):
+    """Returns the front-end model name for an INI file
+    """
+    if not modelname:
+        modelname = getattr(inifile, 'name', inifile)
+    try:
+        return splitext(basename(modelname))[0].upper()
+    except (AttributeError, TypeError) as e:
+        e.args = ("Cannot parse model name from file-like object, "
+                  "please pass modelname=<str>",)
+        raise
+
+
+def _iter_params(inifile, modelname, created_by=None, names=None):
+    """Iterate over the new `Channel` parameters from an INI file
+
+    If ``names`` is given, the name of each channel is appended to it.
+    """
+    for name, params in iter_daq_ini(inifile, extra={'source': modelname}):
+        if names is not None:
+            names.append(name)
+        params['is_current'] = params.get('acquire', 0) > 0
+        if created_by is not None:
+            params['createdby'] = created_by
+        yield name, params
+
+
+def _apply_params(channel, params, modelname, registry, created=False,
+                  verbose=False):
+    """Apply the parameters from an INI file to a `Channel`
+
+    Returns
+    -------
+    modified : `bool`
+        `True` if the `channel` was modified
+    delta : `dict`
+        the new value of each modified field, or of every field if
+        ``created=True``
+    """
+    before = dict((attr, getattr(channel, attr, None)) for attr in params)
+    modified = create_ifo_and_subsystem(channel, modelname, verbose=verbose,
+                                        registry=registry)
+    # record ifo and subsystem separately, they are only set if missing
+    delta = {}
+    if modified or created:
+        delta.update(ifo=getattr(channel, 'ifo', None),
+                     subsystem=getattr(channel, 'subsystem', None))
+    if channel.update_vals(params.iteritems()):
+        modified = True
+    if created:
+        delta.update((attr, getattr(channel, attr)) for attr in params)
+    elif modified:
+        # update_vals doesn't cast values after the first change
+        delta.update((attr, getattr(channel, attr)) for attr in params if
+                     _to_python(attr, getattr(channel, attr)) != before[attr])
+    return modified, delta
+
+
+def _to_python(attr, value):
+    """Cast a new value for a `Channel` attribute to its field type
+    """
+    try:
+        return Channel._meta.get_field(attr).to_python(value)
+    except (FieldDoesNotExist, ValidationError):
+        return value
+
+
+def _update_channels(channels, modelname, registry, history, verbose=False):
+    """Create or update each channel with its own query and `save()`
+    """
+    n = 0
+    for n, (name, params) in enumerate(channels, 1):
         # find/create Channel
         try:
             channel = Channel.objects.get(name=name)
@@ -158,24 +332,272 @@ def update_ligo_model(inifile, modelname=None, verbose=False, created_by=None):
             created = True
         else:
             created = False
-        finally:
-            changed = create_ifo_and_subsystem(channel, modelname,
-                                               verbose=verbose)
-        params = dict(cp.items(name))
-        params['is_current'] = params.get('acquire', 0) > 0
-        if created_by is not None:
-            params['createdby'] = created_by
-        changed |= channel.update_vals(params.iteritems())
+        changed, delta = _apply_params(channel, params, modelname, registry,
+                                       created=created, verbose=verbose)
         if changed or created:
             channel.save()
+            history.add(channel, delta, created=created)
             if created and verbose > 1:
                 print("    Created %s" % channel.name)
             elif changed and verbose > 1:
                 print("    Updated %s" % channel.name)
+        if verbose == 1:
+            print("Updating %s: %d" % (modelname, n), end='\r')
+    if verbose == 1:
+        print("Updating %s: %d/%d" % (modelname, n, n))
+
+
+def _chunks(seq, size):
+    """Yield successive slices of length ``size`` from ``seq``
+    """
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+
+def _bulk_update_channels(channels, modelname, registry, history,
+                          verbose=False, chunk_size=BULK_CHUNK_SIZE):
+    """Create or update all channels for a model in bulk
+
+    The existing channels for ``modelname`` are loaded in one query and
+    each new section is compared against them in memory using the same
+    rules as `Channel.update_vals`. New channels are then written with
+    `~django.db.models.query.QuerySet.bulk_create`, while changed channels
+    are grouped by the set of fields that changed, and written with one
+    ``UPDATE`` per group and chunk, using ``CASE`` to set the values that
+    differ between channels.
+
+    Parameters
+    ----------
+    channels : `iterable` of `tuple`
+        ``(name, params)`` pairs for each channel in the model
+    modelname : `str`
+        the name of the front-end model (the `Channel.source`)
+    registry : `IfoSubsystemRegistry`
+        cache of `Ifo` and `Subsystem` records
+    history : `RevisionHistory`, `ChangeSetRecorder`
+        where to record the changes
+    """
+    channels = list(channels)
+    n = len(channels)
+    existing = dict((c.name, c) for c in
+                    Channel.objects.filter(source=modelname)
+                                   .select_related('ifo'))
+    # channels may have moved from another model, so find those too
+    moved = [name for name, _ in channels if name not in existing]
+    for chunk in _chunks(moved, chunk_size):
+        existing.update((c.name, c) for c in
+                        Channel.objects.filter(name__in=chunk)
+                                       .select_related('ifo'))
+
+    now = timezone.now()
+    new = []
+    updates = defaultdict(list)  # (channel, delta) keyed by changed fields
+    for i, (name, params) in enumerate(channels):
+        try:
+            channel = existing[name]
+        except KeyError:
+            channel = Channel(name=name)
+            created = True
+        else:
+            created = False
+        _, delta = _apply_params(channel, params, modelname, registry,
+                                 created=created, verbose=verbose)
+        if created:
+            new.append((channel, delta))
+            if verbose > 1:
+                print("    Created %s" % channel.name)
+        elif delta:
+            channel.created = delta['created'] = now
+            updates[tuple(sorted(delta))].append((channel, delta))
+            if verbose > 1:
+                print("    Updated %s" % channel.name)
         if verbose == 1:
             print("Updating %s: %d/%d" % (modelname, i+1, n), end='\r')
+
+    with transaction.atomic():
+        for chunk in _chunks(new, chunk_size):
+            Channel.objects.bulk_create([c for c, _ in chunk])
+            # not all databases return primary keys from bulk_create
+            ids = dict(Channel.objects.filter(
+                name__in=[c.name for c, _ in chunk]).values_list('name', 'id'))
+            for channel, _ in chunk:
+                channel.pk = ids[channel.name]
+        # bulk_create doesn't send post_save, so index the new names here
+        if new:
+            ChannelToken.add_channels(((c.pk, c.name) for c, _ in new),
+                                      chunk_size=chunk_size)
+        if new and ChannelTrigram.is_available():
+            ChannelTrigram.add_channels(((c.pk, c.name) for c, _ in new),
+                                        chunk_size=chunk_size)
+        for attrs, group in updates.items():
+            _bulk_update(Channel, [c for c, _ in group], attrs,
+                         chunk_size=chunk_size)
+
+    for channel, delta in new:
+        history.add(channel, delta, created=True)
+    for group in updates.values():
+        for channel, delta in group:
+            history.add(channel, delta)
+
     if verbose == 1:
         print("Updating %s: %d/%d" % (modelname, n, n))
+    elif verbose > 1:
+        print("    %d created, %d updated"
+              % (len(new), sum(map(len, updates.values()))))
+
+
+def _bulk_update(model, objects, attrs, chunk_size=BULK_CHUNK_SIZE):
+    """Write the current values of some fields for many objects
+
+    Each chunk of objects is written with a single ``UPDATE``, fields
+    whose value is the same for every object in the chunk are set
+    directly, the others with a ``CASE`` on the primary key.
+
+    Parameters
+    ----------
+    model : `type`
+        the model class
+    objects : `list`
+        the model instances to write
+    attrs : `list` of `str`
+        the names of the fields to write
+    """
+    fields = [model._meta.get_field(attr) for attr in attrs]
+    # each object takes two parameters (WHEN pk THEN value) for every
+    # field, and one in the filter on pk
+    chunk_size = min(chunk_size, connections[model.objects.db].ops
+                     .bulk_batch_size(['pk'] + fields * 2, objects))
+    for chunk in _chunks(objects, max(chunk_size, 1)):
+        values = {}
+        for field in fields:
+            column = [(obj.pk, field.to_python(getattr(obj, field.attname)))
+                      for obj in chunk]
+            if len(set(value for _, value in column)) == 1:
+                values[field.name] = column[0][1]
+            else:
+                values[field.name] = Case(
+                    *[When(pk=pk, then=Value(value)) for pk, value in column],
+                    output_field=field)
+        model.objects.filter(pk__in=[obj.pk for obj in chunk]).update(
+            **values)
+
+
+def retire_channels(source, names, verbose=False, chunk_size=BULK_CHUNK_SIZE,
+                    history=None):
+    """Mark channels that have been removed from a model as not current
+
+    Parameters
+    ----------
+    source : `str`
+        the name of the front-end model
+    names : `iterable` of `str`
+        the names of all channels now defined by the model
+    history : `RevisionHistory`, `ChangeSetRecorder`, optional
+        where to record the changes, defaults to the active revision
+
+    Returns
+    -------
+    retired : `list` of `Channel`
+        the channels that were marked as not current
+    """
+    if history is None:
+        history = RevisionHistory()
+    names = set(names)
+    retired = [c for c in Channel.objects.filter(source=source,
+                                                 is_current=True)
+               if c.name not in names]
+    now = timezone.now()
+    with transaction.atomic():
+        for chunk in _chunks(retired, chunk_size):
+            Channel.objects.filter(pk__in=[c.pk for c in chunk]).update(
+                is_current=False, created=now)
+    for channel in retired:
+        channel.is_current = False
+        channel.created = now
+        history.add(channel, {'is_current': False}, retired=True)
+        if verbose > 1:
+            print("    Retired %s" % channel.name)
+    return retired
+
+
+class RevisionHistory(object):
+    """Record changed channels as full revisions with `reversion`
+
+    Channels written with bulk queries don't send `post_save`, so
+    `bulk_saved` is sent instead, which `reversion` also listens for,
+    to add them to the active revision, if any.
+    """
+    def add(self, channel, delta, created=False, retired=False):
+        """Add a changed channel to the active revision, if any
+        """
+        bulk_saved.send(sender=Channel, instance=channel)
+
+
+class ChangeSetRecorder(object):
+    """Record changed channels as compact field-level deltas
+
+    All changes recorded by one `ChangeSetRecorder` are stored in a single
+    `ChangeSet`, with one `ChannelChange` per changed channel holding only
+    the fields that changed. Changes are buffered and written in bulk, so
+    `flush` must be called at the end of the run.
+
+    Parameters
+    ----------
+    comment : `str`, optional
+        comment for the change-set
+    createdby : `str`, optional
+        the user or process making the changes
+    chunk_size : `int`, optional
+        number of changes to buffer before writing to the database
+    """
+    def __init__(self, comment='', createdby='', chunk_size=BULK_CHUNK_SIZE):
+        self.comment = comment
+        self.createdby = createdby
+        self.chunk_size = chunk_size
+        self.changeset = None
+        self.count = 0
+        self._pending = []
+
+    def add(self, channel, delta, created=False, retired=False):
+        """Record the changed fields for a channel
+        """
+        if created:
+            action = ChannelChange.CREATED
+        elif retired:
+            action = ChannelChange.RETIRED
+        else:
+            action = ChannelChange.UPDATED
+        fields = dict((attr, _json_value(attr, value)) for
+                      attr, value in delta.items() if attr != 'created')
+        self._pending.append(ChannelChange(
+            channel_id=channel.pk, action=action,
+            fields=json.dumps(fields, sort_keys=True)))
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered changes to the database
+        """
+        if not self._pending:
+            return
+        if self.changeset is None:
+            self.changeset = ChangeSet.objects.create(
+                comment=self.comment[:100], createdby=self.createdby[:30])
+        for change in self._pending:
+            change.changeset = self.changeset
+        ChannelChange.objects.bulk_create(self._pending)
+        self.count += len(self._pending)
+        self._pending = []
+
+
+def _json_value(attr, value):
+    """Convert a `Channel` field value into something `json` can store
+    """
+    if value is None:
+        return None
+    if attr in ('ifo', 'subsystem'):
+        return getattr(value, 'name', value)
+    return _to_python(attr, value)
 
 
 @reversion.create_revision()
@@ -194,9 +616,25 @@ def update_virgo_model(inifile, modelname=None, verbose=False):
                               "not been implemented yet.")
 
 
-def update_tree_nodes(verbose=False):
+def update_tree_nodes(verbose=False, bulk=False, chunk_size=BULK_CHUNK_SIZE):
     """Update the `TreeNode` database give a new set of channels
+
+    Parameters
+    ----------
+    bulk : `bool`, optional, default: `False`
+        build the tree for all current channels in memory, and insert
+        the missing nodes with bulk inserts, rather than adding each
+        channel with `TreeNode.add_channel`
+    chunk_size : `int`, optional
+        number of rows per query when using `bulk=True`
     """
+    # nodes stored before the counts were added must be counted before
+    # they can be updated
+    channel_tree.ensure_counts()
+    if bulk:
+        _bulk_update_tree_nodes(verbose=verbose, chunk_size=chunk_size)
+        channel_tree.bump()
+        return
     current = Channel.objects.filter(is_current=True)
     n = current.count()
     if verbose:
@@ -209,25 +647,779 @@ def update_tree_nodes(verbose=False):
             print("Checking channels: [%d/%d]" % (i+1, n), end='\r')
     if verbose:
         print("Checking channels: [%d/%d]" % (n, n))
+    channel_tree.bump()
+
+
+def _bulk_update_tree_nodes(verbose=False, chunk_size=BULK_CHUNK_SIZE):
+    """Add all current channels to the `TreeNode` database in bulk
+
+    Leaves for channels that are no longer current are removed. Then
+    the names of all current channels without a leaf node are loaded
+    along with the ``namepath`` of every existing branch node, and the
+    missing nodes are added with `_add_tree_leaves`. All counts are then
+    recomputed with `TreeNode.update_counts`.
+    """
+    if verbose:
+        print("Checking channels:", end='\r')
+    leaves = set(TreeNode.objects.filter(channel__isnull=False)
+                                 .values_list('channel_id', flat=True))
+    channels = [(id_, name) for id_, name in
+                Channel.objects.filter(is_current=True)
+                               .values_list('id', 'name').iterator()
+                if id_ not in leaves]
+    del leaves
+    # channels that are no longer current are removed from the tree
+    retired = list(TreeNode.objects.filter(channel__is_current=False)
+                                   .values_list('channel_id', flat=True))
+    with transaction.atomic():
+        _remove_tree_leaves(retired, chunk_size=chunk_size)
+        nodes = dict(TreeNode.objects.filter(namepath__isnull=False)
+                                     .values_list('namepath', 'id')
+                                     .iterator())
+        branches, new = _add_tree_leaves(channels, nodes,
+                                         chunk_size=chunk_size)
+    TreeNode.update_counts(chunk_size=chunk_size)
+    if verbose:
+        print("Checking channels: %d branches and %d leaves created"
+              % (len(branches), len(new)))
+
+
+def _add_tree_leaves(channels, nodes, chunk_size=BULK_CHUNK_SIZE):
+    """Create leaf nodes for some channels, and any missing branches
+
+    The missing branches are found in memory, and created one level of
+    the tree at a time, so that each level can refer to the IDs of its
+    parents, before the leaf nodes are created. The counts of existing
+    nodes are not updated.
+
+    Parameters
+    ----------
+    channels : `list` of `tuple`
+        ``(id, name)`` of each channel to add
+    nodes : `dict`
+        ``(namepath, id)`` of (at least) the existing branches above the
+        new channels, see `_load_branches`, new branches are added to
+        this `dict`
+
+    Returns
+    -------
+    branches : `list`
+        ``(namepath, parent namepath)`` of each new branch
+    leaves : `list`
+        ``(channel id, name, parent namepath)`` of each new leaf
+    """
+    # find the branch path for each new leaf, channels that don't parse,
+    # like vacuum channels, are ignored
+    leaves = []
+    for (id_, name), parsed in zip(channels, parse_channel_names(
+            name for _, name in channels)):
+        if parsed and parsed.parts and None not in parsed.parts:
+            leaves.append((id_, name, parsed.parts))
+
+    # find the missing branches as (parent path, name) keyed by the
+    # namepath, for each level
+    missing = defaultdict(dict)
+    for i, (id_, name, parts) in enumerate(leaves):
+        namepath = ','.join(parts)
+        leaves[i] = (id_, name, namepath)
+        for depth in range(len(parts), 0, -1):
+            if namepath in nodes or namepath in missing[depth]:
+                break
+            parent = ','.join(parts[:depth-1])
+            missing[depth][namepath] = (parent, parts[depth-1])
+            namepath = parent
+
+    # create branches, from the root down
+    branches = []
+    for depth in sorted(missing):
+        level = sorted(missing[depth].items())
+        for chunk in _chunks(level, chunk_size):
+            TreeNode.objects.bulk_create([
+                TreeNode(name=name, namepath=namepath, depth=depth,
+                         parent_id=nodes.get(parent)) for
+                namepath, (parent, name) in chunk])
+            nodes.update(TreeNode.objects.filter(
+                namepath__in=[namepath for namepath, _ in chunk])
+                .values_list('namepath', 'id'))
+        branches.extend((namepath, parent) for
+                        namepath, (parent, _) in level)
+    # then the leaves
+    for chunk in _chunks(leaves, chunk_size):
+        TreeNode.objects.bulk_create([
+            TreeNode(name=name, channel_id=id_, parent_id=nodes[namepath],
+                     depth=namepath.count(',') + 2)
+            for id_, name, namepath in chunk])
+    return branches, leaves
+
+
+def _load_branches(names, chunk_size=BULK_CHUNK_SIZE):
+    """Load the existing branches above some channels
+
+    Returns
+    -------
+    nodes : `dict`
+        ``(namepath, id)`` of each branch
+    """
+    paths = set()
+    for parsed in parse_channel_names(names):
+        if parsed and parsed.parts and None not in parsed.parts:
+            parts = parsed.parts
+            paths.update(','.join(parts[:i]) for
+                         i in range(1, len(parts) + 1))
+    nodes = {}
+    for chunk in _chunks(list(paths), chunk_size):
+        nodes.update(TreeNode.objects.filter(namepath__in=chunk)
+                                     .values_list('namepath', 'id'))
+    return nodes
+
+
+class TreeChanges(object):
+    """Record of the channels added to or removed from the current set
+
+    This records changes in the same way as `RevisionHistory` and
+    `ChangeSetRecorder`, so that `update_tree` can apply them to the
+    `TreeNode` database at the end of an ingest run.
+    """
+    def __init__(self):
+        self.added = set()
+        self.removed = set()
+
+    def __len__(self):
+        return len(self.added) + len(self.removed)
+
+    def add(self, channel, delta, created=False, retired=False):
+        """Record a channel change, if it changes the current set
+        """
+        if retired:
+            current = False
+        elif 'is_current' in delta:
+            current = _to_python('is_current', delta['is_current'])
+        elif created:
+            current = channel.is_current
+        else:
+            return
+        if current:
+            self.added.add(channel.pk)
+            self.removed.discard(channel.pk)
+        else:
+            self.removed.add(channel.pk)
+            self.added.discard(channel.pk)
+
+
+class _Recorders(list):
+    """Send each change to a list of recorders
+    """
+    def add(self, *args, **kwargs):
+        for recorder in self:
+            recorder.add(*args, **kwargs)
+
+
+def update_tree(changes, verbose=False, chunk_size=BULK_CHUNK_SIZE):
+    """Update the `TreeNode` database for the channels in a `TreeChanges`
+
+    Leaves are added for new current channels, and removed for channels
+    that are no longer current, along with any branches left empty. All
+    queries are proportional to the number of changes, rather than the
+    size of the tree.
+
+    Parameters
+    ----------
+    changes : `TreeChanges`
+        the record of changed channels from an ingest run
+    chunk_size : `int`, optional
+        number of rows per query
+    """
+    channel_tree.ensure_counts()
+    with transaction.atomic():
+        removed, pruned = _remove_tree_leaves(changes.removed,
+                                              chunk_size=chunk_size)
+        # only add leaves that don't exist
+        ids = list(changes.added)
+        exists = set()
+        for chunk in _chunks(ids, chunk_size):
+            exists.update(TreeNode.objects.filter(channel_id__in=chunk)
+                                          .values_list('channel_id',
+                                                       flat=True))
+        channels = []
+        for chunk in _chunks([id_ for id_ in ids if id_ not in exists],
+                             chunk_size):
+            channels.extend(Channel.objects.filter(pk__in=chunk,
+                                                   is_current=True)
+                                           .values_list('id', 'name'))
+        nodes = _load_branches([name for _, name in channels],
+                               chunk_size=chunk_size)
+        branches, leaves = _add_tree_leaves(channels, nodes,
+                                            chunk_size=chunk_size)
+        # count the new nodes
+        nchildren = defaultdict(int)
+        nleaves = defaultdict(int)
+        for _, parent in branches:
+            if parent:
+                nchildren[nodes[parent]] += 1
+        for _, _, namepath in leaves:
+            parts = namepath.split(',')
+            nchildren[nodes[namepath]] += 1
+            for i in range(1, len(parts) + 1):
+                nleaves[nodes[','.join(parts[:i])]] += 1
+        _increment_counts(nchildren, nleaves, chunk_size=chunk_size)
+        if removed or leaves:
+            channel_tree.bump()
+    if verbose:
+        print("Tree updated: %d leaves added, %d removed, %d branches "
+              "added, %d removed"
+              % (len(leaves), removed, len(branches), pruned))
+
+
+def _remove_tree_leaves(channels, chunk_size=BULK_CHUNK_SIZE):
+    """Remove the leaf nodes for some channels, and any empty branches
+
+    Returns
+    -------
+    removed : `int`
+        the number of leaves removed
+    pruned : `int`
+        the number of empty branches removed
+    """
+    leaves = []
+    for chunk in _chunks(list(channels), chunk_size):
+        leaves.extend(TreeNode.objects.filter(channel_id__in=chunk)
+                                      .values_list('id', 'parent_id'))
+    if not leaves:
+        return 0, 0
+    for chunk in _chunks(leaves, chunk_size):
+        TreeNode.objects.filter(pk__in=[id_ for id_, _ in chunk]).delete()
+
+    # load the ancestors of every removed leaf, with their counts
+    parents = set(parent for _, parent in leaves if parent is not None)
+    paths = set()
+    for chunk in _chunks(list(parents), chunk_size):
+        for namepath in TreeNode.objects.filter(pk__in=chunk).values_list(
+                'namepath', flat=True):
+            parts = namepath.split(',')
+            paths.update(','.join(parts[:i]) for
+                         i in range(1, len(parts) + 1))
+    ancestors = {}
+    for chunk in _chunks(list(paths), chunk_size):
+        ancestors.update((row[0], list(row[1:])) for row in
+                         TreeNode.objects.filter(namepath__in=chunk)
+                         .values_list('namepath', 'id', 'parent_id',
+                                      'nchildren', 'nleaves'))
+    byid = dict((row[0], row) for row in ancestors.values())
+
+    nchildren = defaultdict(int)
+    nleaves = defaultdict(int)
+    for _, parent in leaves:
+        nchildren[parent] -= 1
+        while parent is not None:
+            nleaves[parent] -= 1
+            parent = byid[parent][1]
+    # prune empty branches, from the bottom up
+    pruned = []
+    for namepath in sorted(ancestors, key=lambda p: -p.count(',')):
+        id_, parent = ancestors[namepath][:2]
+        if byid[id_][2] + nchildren[id_] <= 0:
+            pruned.append(id_)
+            nchildren.pop(id_, None)
+            nleaves.pop(id_, None)
+            if parent is not None:
+                nchildren[parent] -= 1
+    for chunk in _chunks(pruned, chunk_size):
+        TreeNode.objects.filter(pk__in=chunk).delete()
+    _increment_counts(nchildren, nleaves, chunk_size=chunk_size)
+    return len(leaves), len(pruned)
+
+
+def _increment_counts(nchildren, nleaves, chunk_size=BULK_CHUNK_SIZE):
+    """Add to the ``nchildren`` and ``nleaves`` of some nodes
+
+    Parameters
+    ----------
+    nchildren : `dict`
+        change in ``nchildren`` keyed by node ID
+    nleaves : `dict`
+        change in ``nleaves`` keyed by node ID
+    """
+    # group by the increments, to write with few queries
+    groups = defaultdict(list)
+    for id_ in set(nchildren) | set(nleaves):
+        groups[(nchildren.get(id_, 0), nleaves.get(id_, 0))].append(id_)
+    groups.pop((0, 0), None)
+    for (children, leaves), ids in groups.items():
+        for chunk in _chunks(ids, chunk_size):
+            TreeNode.objects.filter(pk__in=chunk).update(
+                nchildren=F('nchildren') + children,
+                nleaves=F('nleaves') + leaves)
 
 
 reini = re.compile('ini\Z')
 
-def iterate_daq_ini_files(url):
-    """Iterator over DAQ INI files
+def list_daq_ini_files(url):
+    """List the DAQ INI files available at the given URL
 
-    Yeilds
-    ------
-    (`str`, `file`)
-        the name and contents of each INI file found at the URL
+    Returns
+    -------
+    files : `list` of `tuple`
+        ``(name, url)`` pairs for each INI file linked from the URL
     """
     try:
         f = ligo.org.request(url)
     except HTTPError as e:
-        e.args = ('%s: %r' % str(e), url,)
+        e.args = ('%s: %r' % (str(e), url),)
         raise
     soup = BeautifulSoup(f, "html.parser")
-    for a in soup.find_all('a', text=reini):
-        ini = a.attrs['href']
-        content = ligo.org.request(join(url, ini))
+    return [(a.attrs['href'], join(url, a.attrs['href'])) for
+            a in soup.find_all('a', text=reini)]
+
+
+class DaqFileCache(object):
+    """Cache of previous DAQ INI file downloads, keyed by URL
+
+    The cache stores the ``ETag`` and ``Last-Modified`` headers, and a
+    digest of the content, for each file that was processed successfully,
+    so that files that are unchanged since the last update can be skipped
+    before they are parsed. A file is unchanged only if every validator
+    known for both the old and new versions matches.
+
+    Parameters
+    ----------
+    force : `bool`, optional, default: `False`
+        never report a file as unchanged, but still record new downloads
+    """
+    def __init__(self, force=False):
+        self.force = force
+        self.entries = dict((f.url, f) for f in DaqFile.objects.all())
+        #: new headers for files whose content is unchanged, to be saved
+        #: by the main thread
+        self.pending = {}
+        self.fetched = 0
+        self.skipped = 0
+
+    def is_unchanged(self, url, etag=None, last_modified=None, digest=None):
+        """Returns `True` if the given file matches the cached record
+
+        Validators that are missing for either version are ignored, and
+        if none can be compared the file is not unchanged.
+        This method doesn't query the database, so is safe to call from
+        the download threads.
+        """
+        entry = self.entries.get(url)
+        if self.force or entry is None:
+            return False
+        compared = False
+        for new, old in ((etag, entry.etag),
+                         (last_modified, entry.last_modified),
+                         (digest, entry.digest)):
+            if new is None or old is None:
+                continue
+            if new != old:
+                return False
+            compared = True
+        return compared
+
+    def save(self, url, etag=None, last_modified=None, digest=None):
+        """Record a new download of the given URL in the database
+        """
+        entry = self.entries.get(url) or DaqFile(url=url)
+        entry.etag = etag
+        entry.last_modified = last_modified
+        entry.digest = digest
+        entry.save()
+        self.entries[url] = entry
+
+    def summary(self):
+        """Returns a `str` summary of the cache hits for this run
+        """
+        return ("%d files downloaded, %d unchanged files skipped"
+                % (self.fetched, self.skipped))
+
+
+def iterate_daq_ini_files(url, nthreads=1, max_per_host=None, select=None,
+                          cache=None):
+    """Iterator over DAQ INI files
+
+    Parameters
+    ----------
+    url : `str`, `list` of `str`
+        one or more URLs to query for INI files, local directories, or
+        tar or zip archives of INI files, the local sources are read
+        after all downloads
+    nthreads : `int`, optional, default: `1`
+        number of files to download in parallel, the default downloads
+        each file only when the previous one has been consumed
+    max_per_host : `int`, optional
+        maximum number of parallel downloads from any one host,
+        defaults to ``nthreads``
+    select : `callable`, optional
+        function that takes an INI file name and returns `True` if that
+        file should be downloaded, defaults to all files
+    cache : `DaqFileCache`, optional
+        record of previous downloads, files that haven't changed are
+        not yielded. Each yielded file is recorded in the cache when the
+        next file is requested, i.e. once it has been processed without
+        error
+
+    Yeilds
+    ------
+    (`str`, `file`)
+        the name and contents of each INI file found at the URL(s),
+        in the order that the downloads complete if ``nthreads > 1``,
+        files in a local directory are given by their path instead
+    """
+    for ini, u, content, headers in _iter_downloads(
+            url, nthreads=nthreads, max_per_host=max_per_host, select=select,
+            cache=cache):
         yield ini, content
+        if cache is not None:
+            cache.save(u, **headers)
+
+
+def _iter_downloads(url, nthreads=1, max_per_host=None, select=None,
+                    cache=None):
+    """Iterate over the downloaded content of the DAQ INI files at the URL(s)
+
+    See `iterate_daq_ini_files` for details, the cache is not updated.
+
+    Yields
+    ------
+    (`str`, `str`, `file`, `dict`)
+        the name, URL, contents, and cache headers of each INI file
+    """
+    if isinstance(url, str):
+        url = [url]
+    files = [(ini, u) for base in url if is_remote(base) for
+             ini, u in list_daq_ini_files(base)
+             if select is None or select(ini)]
+    if nthreads > 1:
+        downloads = _fetch_concurrently(files, nthreads,
+                                        max_per_host or nthreads, cache)
+    else:
+        downloads = ((ini, u, _download(u, cache)) for ini, u in files)
+    # then read from local directories and archives
+    downloads = chain(downloads, *(_iter_local(base, select=select,
+                                               cache=cache) for
+                                   base in url if not is_remote(base)))
+    for ini, u, result in downloads:
+        if result is None:
+            cache.skipped += 1
+            # the headers changed, but not the content
+            if u in cache.pending:
+                cache.save(u, **cache.pending.pop(u))
+            continue
+        content, headers = result
+        if cache is not None:
+            cache.fetched += 1
+        yield ini, u, content, headers
+
+
+class ParsedModel(namedtuple('ParsedModel', ('modelname', 'names',
+                                             'channels'))):
+    """The channels parsed from one INI file by a worker process
+
+    ``names`` lists every channel in the file, while ``channels`` holds the
+    ``(name, params)`` pairs only for those channels that differ from the
+    database.
+    """
+    __slots__ = ()
+
+
+def iterate_parsed_daq_ini_files(url, workers, nthreads=1, max_per_host=None,
+                                 select=None, cache=None, created_by=None):
+    """Iterate over DAQ INI files, parsing them in a pool of processes
+
+    Before the pool is started, the current state of every `Channel` is
+    loaded into memory. Each worker parses a whole INI file and compares
+    the channels against this read-only snapshot, so only the new and
+    changed channels are sent back, ready for `update_ligo_model`.
+
+    Parameters
+    ----------
+    url : `str`, `list` of `str`
+        one or more URLs to query for INI files
+    workers : `int`
+        number of processes to use to parse the files
+    created_by : `str`, optional
+        the `Channel.createdby` value to apply to each channel
+
+    See `iterate_daq_ini_files` for the other parameters.
+
+    Yields
+    ------
+    (`str`, `file`, `ParsedModel`)
+        the name, contents, and parsed channels of each INI file, in
+        the same order as `iterate_daq_ini_files`
+    """
+    snapshot = _load_snapshot()
+    # forked workers must not share the database connections
+    for conn in connections.all():
+        conn.close()
+    pool = Pool(workers, initializer=_init_parser, initargs=(snapshot,))
+    del snapshot
+    downloads = _iter_downloads(url, nthreads=nthreads,
+                                max_per_host=max_per_host, select=select,
+                                cache=cache)
+    jobs = deque()
+    try:
+        while True:
+            # keep every worker busy, with one more file waiting for each
+            for ini, u, content, headers in downloads:
+                # workers read files on disk for themselves
+                if isinstance(content, string_types):
+                    kwargs = {'path': content}
+                else:
+                    kwargs = {'text': content.getvalue()}
+                jobs.append((ini, u, content, headers, pool.apply_async(
+                    _parse_model, (ini,), dict(created_by=created_by,
+                                               **kwargs))))
+                if len(jobs) >= 2 * workers:
+                    break
+            if not jobs:
+                break
+            ini, u, content, headers, job = jobs.popleft()
+            yield ini, content, job.get()
+            if cache is not None:
+                cache.save(u, **headers)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+#: `Channel` fields compared by the worker processes
+SNAPSHOT_FIELDS = ('ifo_id', 'subsystem', 'gain', 'slope', 'offset',
+                   'datatype', 'ifoid', 'acquire', 'units', 'dcuid',
+                   'datarate', 'chnnum', 'createdby', 'source', 'is_current',
+                   'is_testpoint')
+_SNAPSHOT_INDEX = dict((attr, i) for i, attr in enumerate(SNAPSHOT_FIELDS))
+_snapshot = {}
+
+
+def _load_snapshot():
+    """Load the current state of all channels as a `dict` of `tuple`
+    """
+    return dict((row[0], row[1:]) for row in Channel.objects.values_list(
+        'name', *SNAPSHOT_FIELDS).iterator())
+
+
+def _init_parser(snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+
+def _parse_model(inifile, path=None, text=None, created_by=None):
+    """Parse an INI file in a worker process, from a path or its contents
+
+    Returns
+    -------
+    parsed : `ParsedModel`
+        the names of all channels, and the parameters of the new and
+        changed channels
+    """
+    modelname = _model_name(inifile)
+    names = []
+    channels = [(name, params) for name, params in
+                _iter_params(path or StringIO(text), modelname,
+                             created_by=created_by, names=names)
+                if not _is_unchanged(name, params)]
+    return ParsedModel(modelname, names, channels)
+
+
+def _is_unchanged(name, params, index=_SNAPSHOT_INDEX):
+    """Returns `True` if the snapshot shows that a channel doesn't need
+    updating with the given parameters
+    """
+    try:
+        row = _snapshot[name]
+    except KeyError:
+        return False
+    if row[0] is None or not row[1]:  # needs ifo or subsystem
+        return False
+    try:
+        return all(_to_python(attr, value) == row[index[attr]] for
+                   attr, value in params.items())
+    except KeyError:  # not a field we know about
+        return False
+
+
+def _download(url, cache=None):
+    """Download the full content of the given URL into memory
+
+    Returns
+    -------
+    result : `tuple`, `None`
+        the content of the URL as a `file`, and a `dict` of the cache
+        headers and digest, or `None` if the ``cache`` shows that the file
+        is unchanged
+    """
+    response = ligo.org.request(url)
+    # ligo.org.request doesn't allow setting request headers, so check
+    # the validators in the response headers before reading the body
+    info = response.info()
+    headers = {'etag': info.get('ETag'),
+               'last_modified': info.get('Last-Modified')}
+    if cache is not None and cache.is_unchanged(url, **headers):
+        response.close()
+        return None
+    return _read_content(url, response.read(), headers, cache=cache)
+
+
+def _read_content(key, content, headers, cache=None):
+    """Check the digest of some new content against the cache
+
+    Returns
+    -------
+    result : `tuple`, `None`
+        the content as a `file`, and the ``headers`` with the digest
+        added, or `None` if the ``cache`` shows that the content is
+        unchanged
+    """
+    headers['digest'] = hashlib.sha1(content).hexdigest()
+    if cache is not None and cache.is_unchanged(key, digest=headers['digest']):
+        # record the new headers, so the file isn't downloaded next time
+        cache.pending[key] = headers
+        return None
+    if not isinstance(content, str):  # python3 returns bytes
+        content = content.decode('utf-8')
+    return StringIO(content), headers
+
+
+def is_remote(source):
+    """Returns `True` if the given DAQ INI file source is an HTTP(S) URL
+    """
+    return urlparse(source).scheme in ('http', 'https')
+
+
+def _iter_local(source, select=None, cache=None):
+    """Read DAQ INI files from a local directory, or tar or zip archive
+
+    Files in a directory are not read here, their paths are returned so
+    that they can be memory-mapped by the parser. Archive members are
+    streamed, one at a time.
+
+    Each file is keyed in the cache by its absolute path, or by the path
+    of the archive joined with the member name, using the modification
+    time in place of the ``Last-Modified`` header.
+
+    Yields
+    ------
+    (`str`, `str`, `tuple`)
+        the name, cache key, and the `_download`-like result for each file
+    """
+    def _wanted(name):
+        name = basename(name)
+        return reini.search(name) and (select is None or select(name))
+
+    source = os.path.abspath(source)
+    if os.path.isdir(source):
+        for name in sorted(filter(_wanted, os.listdir(source))):
+            path = os.path.join(source, name)
+            headers = {'etag': None,
+                       'last_modified': str(os.stat(path).st_mtime)}
+            if cache is not None and cache.is_unchanged(path, **headers):
+                yield name, path, None
+                continue
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+            headers['digest'] = digest = sha1.hexdigest()
+            if cache is not None and cache.is_unchanged(path, digest=digest):
+                cache.pending[path] = headers
+                yield name, path, None
+            else:
+                yield name, path, (path, headers)
+    elif tarfile.is_tarfile(source):
+        # stream the archive, so compressed archives are read only once
+        with tarfile.open(source, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile() or not _wanted(member.name):
+                    continue
+                key = '%s/%s' % (source, member.name)
+                headers = {'etag': None, 'last_modified': str(member.mtime)}
+                if cache is not None and cache.is_unchanged(key, **headers):
+                    yield basename(member.name), key, None
+                    continue
+                content = tar.extractfile(member).read()
+                yield basename(member.name), key, _read_content(
+                    key, content, headers, cache=cache)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zip_:
+            for info in zip_.infolist():
+                if info.filename.endswith('/') or not _wanted(info.filename):
+                    continue
+                key = '%s/%s' % (source, info.filename)
+                headers = {'etag': '%08x' % (info.CRC & 0xffffffff),
+                           'last_modified': '%04d-%02d-%02d %02d:%02d:%02d'
+                                            % info.date_time}
+                if cache is not None and cache.is_unchanged(key, **headers):
+                    yield basename(info.filename), key, None
+                    continue
+                yield basename(info.filename), key, _read_content(
+                    key, zip_.read(info), headers, cache=cache)
+    else:
+        raise IOError("Cannot read DAQ INI files from %r, not a URL, "
+                      "directory, or tar or zip archive" % source)
+
+
+def _interleave_by_host(files):
+    """Reorder ``(name, url)`` pairs to take one file from each host in turn
+
+    The order of the files from each host is kept.
+    """
+    hosts = OrderedDict()
+    for ini, url in files:
+        hosts.setdefault(urlparse(url).netloc, deque()).append((ini, url))
+    queues = list(hosts.values())
+    while queues:
+        for queue in queues:
+            yield queue.popleft()
+        queues = [queue for queue in queues if queue]
+
+
+def _fetch_concurrently(files, nthreads, max_per_host, cache=None):
+    """Download files in a pool of threads, yielding them as they complete
+
+    At most ``nthreads`` downloads are active at any time, with at most
+    ``max_per_host`` of those targeting any single host. Files are
+    queued in turn from each host, so that the workers blocked waiting
+    for a busy host don't hold up downloads from the others. Completed
+    downloads are held in a bounded queue so that the consumer (the
+    database writer) is never more than a few files behind.
+    """
+    tasks = Queue()
+    for ini, url in _interleave_by_host(files):
+        tasks.put((ini, url))
+    results = Queue(maxsize=2 * nthreads)
+    limits = dict((urlparse(url).netloc, BoundedSemaphore(max_per_host))
+                  for _, url in files)
+    stop = Event()
+
+    def _worker():
+        while not stop.is_set():
+            try:
+                ini, url = tasks.get_nowait()
+            except Empty:
+                return
+            with limits[urlparse(url).netloc]:
+                try:
+                    result = (ini, url, _download(url, cache))
+                except Exception as e:
+                    e.args = ('%s: %r' % (str(e), url),)
+                    result = (ini, url, e)
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=1)
+                except Full:
+                    continue
+                break
+
+    threads = [Thread(target=_worker) for _ in range(min(nthreads, len(files)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for _ in range(len(files)):
+            ini, url, content = results.get()
+            if isinstance(content, Exception):
+                raise content
+            yield ini, url, content
+    finally:
+        stop.set()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 21:13
+from __future__ import unicode_literals
+
+# This is the schema from before migrations were added. Databases that
+# were created with syncdb should be upgraded with
+# ``manage.py migrate cis --fake-initial``, which records this migration
+# as applied, and then applies the rest.
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Channel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subsystem', models.CharField(max_length=10)),
+                ('name', models.CharField(db_index=True, max_length=70, unique=True)),
+                ('gain', models.FloatField()),
+                ('slope', models.FloatField()),
+                ('offset', models.IntegerField()),
+                ('datatype', models.IntegerField()),
+                ('ifoid', models.IntegerField()),
+                ('acquire', models.IntegerField()),
+                ('units', models.CharField(max_length=10)),
+                ('dcuid', models.IntegerField()),
+                ('datarate', models.IntegerField()),
+                ('chnnum', models.IntegerField(null=True)),
+                ('created', models.DateTimeField(auto_now=True)),
+                ('createdby', models.CharField(max_length=30)),
+                ('source', models.CharField(db_index=True, max_length=30)),
+                ('is_current', models.BooleanField(default=False)),
+                ('is_testpoint', models.BooleanField(default=False)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ChannelDescription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=60, unique=True)),
+                ('desc', models.CharField(max_length=100)),
+                ('text', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('editor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Description',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=60)),
+                ('fullname', models.CharField(db_index=True, max_length=60, null=True)),
+                ('shortdesc', models.CharField(db_index=True, max_length=60, null=True)),
+                ('text', models.TextField(null=True)),
+                ('parent', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='cis.Description')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Ifo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=10, unique=True)),
+                ('label', models.CharField(max_length=5)),
+                ('description', models.TextField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='PemSensor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=70, unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Subsystem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=10, unique=True)),
+                ('label', models.CharField(max_length=5)),
+                ('description', models.TextField()),
+            ],
+            options={
+                'ordering': ['name'],
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='TreeNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=70)),
+                ('namepath', models.CharField(db_index=True, max_length=60, null=True)),
+                ('channel', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='cis.Channel')),
+                ('parent', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='cis.TreeNode')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='ifo',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cis.Ifo'),
+        ),
+    ]
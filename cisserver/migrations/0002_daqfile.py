@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 21:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cis', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DaqFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=255, unique=True)),
+                ('etag', models.CharField(max_length=100, null=True)),
+                ('last_modified', models.CharField(max_length=40, null=True)),
+                ('digest', models.CharField(max_length=40)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 21:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cis', '0002_daqfile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('comment', models.CharField(max_length=100)),
+                ('createdby', models.CharField(max_length=30)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ChannelChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[(b'C', b'created'), (b'U', b'updated'), (b'R', b'retired')], max_length=1)),
+                ('fields', models.TextField()),
+                ('changeset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cis.ChangeSet')),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cis.Channel')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='channelchange',
+            index_together=set([('channel', 'changeset')]),
+        ),
+    ]
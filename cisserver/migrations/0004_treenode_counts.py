@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 21:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cis', '0003_changeset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treenode',
+            name='nchildren',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='treenode',
+            name='nleaves',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='treenode',
+            index_together=set([('parent', 'name')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 21:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cis', '0004_treenode_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treenode',
+            name='depth',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 21:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cis', '0006_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cis.Channel')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='channeltrigram',
+            index_together=set([('trigram', 'channel')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 21:13
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cis', '0009_channel_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='channel',
+            index_together=set([('is_current', 'source', 'datatype'), ('is_current', 'subsystem', 'name'), ('is_current', 'is_testpoint', 'datarate'), ('is_current', 'created', 'name'), ('is_current', 'dcuid', 'datarate'), ('is_current', 'name'), ('is_current', 'source', 'name'), ('is_current', 'datatype', 'datarate'), ('is_current', 'datarate', 'name')]),
+        ),
+    ]
@@ -16,18 +16,30 @@
 # You should have received a copy of the GNU General Public License
 # along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import re
+from collections import defaultdict
 
+from django.db import (connection, transaction)
 from django.db.models import (Model, CharField, ForeignKey, FloatField,
                               IntegerField, TextField, DateTimeField,
-                              BooleanField, Q)
+                              BooleanField, Count, F, Q)
+from django.db.models.signals import post_save
+from django.dispatch import Signal
 from django.conf import settings
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 from reversion import revisions as reversion
 
 from rest_framework.reverse import reverse
 
+from .names import (RE_NAME, parse_channel_name)
+
+#: sent for each `Channel` written by a bulk query, which doesn't send
+#: `post_save`, so that `reversion` adds it to the active revision
+bulk_saved = Signal(providing_args=['instance'])
+
 
 class CisModel(Model):
     class Meta:
@@ -59,13 +71,7 @@ class Channel(CisModel):
 
     A `Channel` is a single, recorded data stream read out from an `Ifo`.
     """
-    re_name = re.compile(
-        r'((?:(?P<ifo>[A-Z]\d))?|[\w-]+):'  # match IFO prefix
-         '(?:(?P<subsystem>[a-zA-Z0-9]+))?'  # match subsystem
-         '(?:[-_](?P<signal>[a-zA-Z0-9_-]+))?'  # match signal
-         '(?:\.(?P<trend>[a-z]+))?'  # match trend type
-         '(?:,(?P<type>([a-z]-)?[a-z]+))?'  # match channel type
-    )
+    re_name = RE_NAME
     DATATYPE = {
         0: "Undefined",
         1: "16-bit Integer",
@@ -99,6 +105,50 @@ class Channel(CisModel):
     # is this a test-point (unrecorded channel)
     is_testpoint = BooleanField(default=False, null=False)
 
+    #: fields that channel lists can be sorted by, see `ChannelList`
+    SORT_FIELDS = ('name', 'ifo', 'subsystem', 'datarate', 'units',
+                   'acquire', 'offset', 'slope', 'source', 'created', 'id')
+
+    #: fields that channel lists can be filtered on, with the lookup
+    #: and value type, see `field_query`
+    FILTER_FIELDS = {
+        'datarate': ('datarate', int),
+        'datatype': ('datatype', int),
+        'dcuid': ('dcuid', int),
+        'source': ('source', str),
+        'ifo': ('ifo__name', str),
+        'subsystem': ('subsystem', str),
+        'is_testpoint': ('is_testpoint', bool),
+    }
+
+    #: comparisons allowed on numeric filter fields
+    FILTER_RANGES = ('gt', 'gte', 'lt', 'lte')
+
+    class Meta(CisModel.Meta):
+        # channel lists are filtered on is_current, then sorted, with
+        # ties broken by name
+        index_together = [
+            ('is_current', 'name'),
+            ('is_current', 'subsystem', 'name'),
+            ('is_current', 'source', 'name'),
+            ('is_current', 'datarate', 'name'),
+            ('is_current', 'created', 'name'),
+            # field filters, see field_query: equality on the first
+            # column, then a range on the second
+            ('is_current', 'dcuid', 'datarate'),
+            ('is_current', 'datatype', 'datarate'),
+            ('is_current', 'source', 'datatype'),
+            ('is_current', 'is_testpoint', 'datarate'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        new = super(Channel, cls).from_db(db, field_names, values)
+        # remember the name, so the search indexes are only updated
+        # when a channel is renamed
+        new._indexed_name = new.name
+        return new
+
     def get_datatype_display(self):
         """String display of data type
         """
@@ -170,11 +220,8 @@ class Channel(CisModel):
         names : `list` of `str`
             a list of component sub-strings for this `Channel`
         """
-        match = self.re_name.match(self.name)
-        if match:
-            names = [match.group(3)] + match.group(4).split('_')
-        else:
-            names = []
+        parsed = parse_channel_name(self.name)
+        names = list(parsed.parts) if parsed else []
         if include_self:
             names.append(self.name.split(':')[1])
         return names
@@ -203,17 +250,94 @@ class Channel(CisModel):
             #  eg. H1: pem | H2: PSL
             #   is (*H1:* & *pem*) | (*H2:* | *PSL*)
 
+            # Terms starting with 'tok:' match whole name components,
+            # as given by `Channel.sub_names`, using the token index
+            #  eg. tok:DARM tok:OUT_DQ
+            #   is (DARM component & OUT,DQ components & *OUT_DQ*)
+
+            # When the trigram index is available, the candidates for each
+            # alternative are found from the index, and the query is run
+            # on those alone, so the database doesn't scan every channel
+            # name; this only helps if every alternative has candidates.
+            candidates = set() if ChannelTrigram.is_available() else None
             ors = []
             for term in query.split('|'):
-                ands = [Q(name__icontains=aterm.strip()) for
-                        aterm in term.split()]
+                aterms = []
+                ands = []
+                for aterm in term.split():
+                    if aterm[:4].lower() == ChannelToken.PREFIX:
+                        ands.extend(ChannelToken.query(aterm[4:]))
+                    else:
+                        aterms.append(aterm)
+                if candidates is not None:
+                    ids = ChannelTrigram.candidates(aterms)
+                    if ids is None:
+                        candidates = None
+                    else:
+                        candidates.update(ids)
+                ands.extend(Q(name__icontains=aterm) for aterm in aterms)
                 ors.append(reduce(Q.__and__, ands, Q()))
             q = reduce(Q.__or__, ors, Q())
+            if (candidates is not None and
+                    len(candidates) <= ChannelTrigram.MAX_CANDIDATES):
+                q = Q(pk__in=sorted(candidates)) & q
         else:
             q = Q()
 
         return q
 
+    @classmethod
+    def field_query(cls, filters):
+        """Build a `Q` from structured field filters
+
+        Parameters
+        ----------
+        filters : `list` of `tuple`
+            ``(key, value)`` pairs, where ``key`` is one of
+            `FILTER_FIELDS`, optionally followed by ``__`` and one of
+            `FILTER_RANGES` for numeric fields, eg. ``datarate__gte``.
+            A plain key matches any of its comma-separated values,
+            eg. ``('datatype', '4,5')``; all filters are ANDed.
+
+        Returns
+        -------
+        q : `~django.db.models.Q`
+            the query
+
+        Raises
+        ------
+        ValueError
+            if a key or value is not valid
+        """
+        q = Q()
+        for key, value in filters:
+            field, _, op = key.partition('__')
+            try:
+                lookup, type_ = cls.FILTER_FIELDS[field]
+            except KeyError:
+                raise ValueError("Cannot filter on %r, choose from: %s" % (
+                    field, ', '.join(sorted(cls.FILTER_FIELDS))))
+            if op and (type_ is not int or op not in cls.FILTER_RANGES):
+                raise ValueError("Cannot filter on %r" % key)
+            values = [v.strip() for v in value.split(',') if v.strip()]
+            if not values or (op and len(values) > 1):
+                raise ValueError("Invalid value for %s: %r" % (key, value))
+            try:
+                if type_ is bool:
+                    values = [{'1': True, 'true': True, '0': False,
+                               'false': False}[v.lower()] for v in values]
+                elif type_ is int:
+                    values = [int(v) for v in values]
+            except (KeyError, ValueError):
+                raise ValueError("Invalid value for %s: %r" % (key, value))
+            if op:
+                q &= Q(**{'%s__%s' % (lookup, op): values[0]})
+            elif len(values) == 1:
+                q &= Q(**{lookup: values[0]})
+            else:
+                q &= Q(**{'%s__in' % lookup: values})
+        return q
+
     def simulink_model_link(self):
         """Return the URL of the webview for this channels Simulink model
         """
@@ -237,10 +361,326 @@ class Channel(CisModel):
     def revisions(self):
         return [v.field_dict for v in reversion.get_unique_for_object(self)]
 
+    def history(self):
+        """The `ChannelChange` records for this `Channel`, newest first
+        """
+        return self.channelchange_set.select_related('changeset').order_by(
+            '-changeset')
+
     def __unicode__(self):
         return self.name
 
-reversion.register(Channel)
+reversion.register(Channel, signals=[post_save, bulk_saved])
+
+
+class ChangeSet(CisModel):
+    """A set of changes made to the `Channel` table by one ingest run
+
+    This is a compact alternative to full revisions, only the fields that
+    changed for each channel are stored, as `ChannelChange` records.
+    """
+    comment = CharField(max_length=100)
+    createdby = CharField(max_length=30, null=False)
+    created = DateTimeField(auto_now_add=True, null=False)
+
+    def __unicode__(self):
+        return '%d: %s' % (self.id, self.comment)
+
+
+class ChannelChange(CisModel):
+    """The fields of one `Channel` that changed in a `ChangeSet`
+    """
+    CREATED = 'C'
+    UPDATED = 'U'
+    RETIRED = 'R'
+    ACTIONS = (
+        (CREATED, 'created'),
+        (UPDATED, 'updated'),
+        (RETIRED, 'retired'),
+    )
+    changeset = ForeignKey(ChangeSet)
+    channel = ForeignKey(Channel)
+    action = CharField(max_length=1, choices=ACTIONS)
+    # JSON-encoded dict of new field values
+    fields = TextField(null=False)
+
+    class Meta(CisModel.Meta):
+        index_together = [('channel', 'changeset')]
+
+    def field_dict(self):
+        """The `dict` of changed fields and their new values
+        """
+        return json.loads(self.fields)
+
+    def __unicode__(self):
+        return '%s %s' % (self.channel_id, self.get_action_display())
+
+
+def trigrams(text, step=1):
+    """Returns the `set` of lower-case, three-character substrings of
+    some text
+
+    Parameters
+    ----------
+    text : `str`
+        the text to split
+    step : `int`, optional, default: `1`
+        the spacing of the trigrams, use ``step=3`` to get
+        non-overlapping trigrams (plus the last) for queries, which are
+        enough to select candidates, and much cheaper to look up
+    """
+    text = text.lower()
+    last = len(text) - 3
+    if last < 0:
+        return set()
+    grams = set(text[i:i+3] for i in range(0, last + 1, step))
+    grams.add(text[last:])
+    return grams
+
+
+class ChannelTrigram(CisModel):
+    """Inverted index of the trigrams in each `Channel` name
+
+    Each trigram has a posting list, the channels whose names contain
+    it, which is read from the ``(trigram, channel)`` index. This is
+    used to find the candidates for ``name__icontains`` searches without
+    scanning the whole channel table, see `candidates`. On PostgreSQL,
+    a native ``pg_trgm`` index is used instead (see the
+    ``build_search_index`` command), so this table isn't built.
+    """
+    trigram = CharField(max_length=3, null=False)
+    channel = ForeignKey(Channel)
+
+    #: name of the `Generation` that records when the index was built
+    GENERATION = 'trigram'
+
+    #: longest posting list to read, commoner trigrams are left to
+    #: the check against the terms
+    MAX_POSTINGS = 2000
+
+    #: most candidates to select from the index, more are left to the
+    #: database scan; this keeps within SQLite's 999 query parameters
+    MAX_CANDIDATES = 900
+
+    # set once the index has been seen to be built, as it is never
+    # removed, so this doesn't need checking for every query
+    _available = False
+
+    class Meta(CisModel.Meta):
+        index_together = [('trigram', 'channel')]
+
+    @classmethod
+    def is_native(cls):
+        """Returns `True` if the database can index substrings itself
+        """
+        return connection.vendor == 'postgresql'
+
+    @classmethod
+    def is_available(cls):
+        """Returns `True` if this table has been built, and should be used
+        """
+        if not cls._available:
+            cls._available = (not cls.is_native() and
+                              Generation.current(cls.GENERATION) > 0)
+        return cls._available
+
+    @classmethod
+    def candidates(cls, terms):
+        """Find the channels whose names contain every trigram of
+        some terms
+
+        The posting lists are read from the index, shortest first, and
+        intersected in memory, stopping if no candidates are left. Lists
+        longer than `MAX_POSTINGS` are skipped, as they would cost more
+        to read than they remove. The candidates must still be checked
+        against the terms themselves, as having every trigram of a term
+        doesn't mean containing it.
+
+        Parameters
+        ----------
+        terms : `list` of `str`
+            the search terms
+
+        Returns
+        -------
+        ids : `list` of `int`, `None`
+            the sorted IDs of the candidate channels, or `None` if the
+            terms are too short, or too common, to select fewer than
+            `MAX_CANDIDATES` candidates
+        """
+        grams = set()
+        for term in terms:
+            grams.update(trigrams(term, step=3))
+        postings = cls.objects.values_list('channel_id', flat=True)
+        # counting a slice reads no more than MAX_POSTINGS + 1 entries
+        sizes = sorted(
+            (postings.filter(trigram=gram)[:cls.MAX_POSTINGS + 1].count(),
+             gram) for gram in grams)
+        candidates = None
+        for size, gram in sizes:
+            if size > cls.MAX_POSTINGS:
+                break
+            ids = postings.filter(trigram=gram)
+            if candidates is None:
+                candidates = set(ids)
+            else:
+                candidates.intersection_update(ids)
+            if not candidates:
+                return []
+        if candidates is None or len(candidates) > cls.MAX_CANDIDATES:
+            return None
+        return sorted(candidates)
+
+    @classmethod
+    def add_channels(cls, channels, chunk_size=500):
+        """Add the trigrams for some channels to the index
+
+        Parameters
+        ----------
+        channels : `iterable` of `tuple`
+            ``(id, name)`` of each channel to add, any existing entries
+            for these channels are replaced
+        """
+        channels = list(channels)
+        for i in range(0, len(channels), chunk_size):
+            chunk = channels[i:i+chunk_size]
+            cls.objects.filter(channel_id__in=[
+                id_ for id_, _ in chunk]).delete()
+            cls.objects.bulk_create([
+                cls(trigram=gram, channel_id=id_) for
+                id_, name in chunk for gram in trigrams(name)])
+
+    @classmethod
+    def build_index(cls, chunk_size=500):
+        """Rebuild the index for all channels
+
+        This does nothing on PostgreSQL, which indexes the names
+        itself.
+        """
+        if cls.is_native():
+            return
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.add_channels(
+                Channel.objects.values_list('id', 'name').iterator(),
+                chunk_size=chunk_size)
+            Generation.bump(cls.GENERATION)
+
+    def __unicode__(self):
+        return '%s %s' % (self.trigram, self.channel_id)
+
+
+def tokens(name):
+    """Returns the `set` of upper-case name components of a channel name
+
+    These are the components given by `Channel.sub_names`.
+    """
+    parsed = parse_channel_name(name)
+    if parsed is None:
+        return set()
+    return set(part.upper() for part in parsed.parts if part)
+
+
+class ChannelToken(CisModel):
+    """Index of the name components of each `Channel`
+
+    This is used to answer ``tok:`` search terms, which match whole name
+    components, without scanning the channel table. The index is filled
+    during ingest, existing databases can be indexed using the
+    ``build_search_index`` command.
+    """
+    token = CharField(max_length=100, null=False)
+    channel = ForeignKey(Channel)
+
+    #: search term prefix for token queries
+    PREFIX = 'tok:'
+
+    class Meta(CisModel.Meta):
+        index_together = [('token', 'channel')]
+
+    @classmethod
+    def matching(cls, toks):
+        """Returns a query for the IDs of channels with all of the
+        given tokens
+        """
+        toks = list(toks)
+        if len(toks) == 1:
+            return cls.objects.filter(token=toks[0]).values('channel_id')
+        return (cls.objects.filter(token__in=toks)
+                           .values('channel_id')
+                           .annotate(n=Count('token'))
+                           .filter(n=len(toks))
+                           .values('channel_id'))
+
+    @classmethod
+    def query(cls, value):
+        """Returns the `list` of `Q` filters for a ``tok:`` search term
+
+        Parameters
+        ----------
+        value : `str`
+            the term, without the prefix, either a single component
+            (e.g. ``DARM``) or several joined by underscores
+            (e.g. ``OUT_DQ``), which must also appear in that order
+
+        Returns
+        -------
+        filters : `list` of `Q`
+            the filters to AND together, empty if ``value`` is empty
+        """
+        toks = set(tok.upper() for tok in value.split('_') if tok)
+        if not toks:
+            return []
+        filters = [Q(pk__in=cls.matching(toks))]
+        if len(toks) > 1 or '_' in value:
+            filters.append(Q(name__icontains=value))
+        return filters
+
+    @classmethod
+    def add_channels(cls, channels, chunk_size=500):
+        """Add the tokens for some channels to the index
+
+        Parameters
+        ----------
+        channels : `iterable` of `tuple`
+            ``(id, name)`` of each channel to add, any existing entries
+            for these channels are replaced
+        """
+        channels = list(channels)
+        for i in range(0, len(channels), chunk_size):
+            chunk = channels[i:i+chunk_size]
+            cls.objects.filter(channel_id__in=[
+                id_ for id_, _ in chunk]).delete()
+            cls.objects.bulk_create([
+                cls(token=tok, channel_id=id_) for
+                id_, name in chunk for tok in tokens(name)])
+
+    @classmethod
+    def build_index(cls, chunk_size=500):
+        """Rebuild the index for all channels
+        """
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.add_channels(
+                Channel.objects.values_list('id', 'name').iterator(),
+                chunk_size=chunk_size)
+
+    def __unicode__(self):
+        return '%s %s' % (self.token, self.channel_id)
+
+
+def _index_channel(sender, instance, created=False, raw=False, **kwargs):
+    """Keep the search indexes up to date when a channel is saved
+    """
+    if raw or not (created or
+                   instance.name != getattr(instance, '_indexed_name', None)):
+        return
+    ChannelToken.add_channels([(instance.pk, instance.name)])
+    if ChannelTrigram.is_available():
+        ChannelTrigram.add_channels([(instance.pk, instance.name)])
+    instance._indexed_name = instance.name
+
+post_save.connect(_index_channel, sender=Channel)
 
 
 class Subsystem(CisModel):
@@ -282,6 +722,61 @@ class ChannelDescription(CisModel):
 reversion.register(ChannelDescription)
 
 
+class DaqFile(CisModel):
+    """Record of the last processed download of a DAQ INI file
+
+    This is used to skip downloading and parsing model files that have not
+    changed since the last update.
+    """
+    url = CharField(max_length=255, null=False, unique=True)
+    etag = CharField(max_length=100, null=True)
+    last_modified = CharField(max_length=40, null=True)
+    digest = CharField(max_length=40, null=False)  # SHA-1 of contents
+    updated = DateTimeField(auto_now=True, null=False)
+
+    def __unicode__(self):
+        return self.url
+
+
+class Generation(CisModel):
+    """A counter that changes whenever some derived content changes
+
+    Content derived from the database, such as the channel tree, can be
+    cached and served with an ``ETag`` for as long as its generation
+    stays the same.
+    """
+    name = CharField(max_length=30, null=False, unique=True)
+    value = IntegerField(default=0, null=False)
+    updated = DateTimeField(auto_now=True, null=False)
+
+    def __unicode__(self):
+        return '%s:%d' % (self.name, self.value)
+
+    @classmethod
+    def current(cls, name):
+        """Returns the current generation number for the given content
+        """
+        try:
+            return cls.objects.values_list('value', flat=True).get(name=name)
+        except cls.DoesNotExist:
+            return 0
+
+    @classmethod
+    def bump(cls, name):
+        """Start a new generation for the given content
+
+        Returns
+        -------
+        value : `int`
+            the new generation number
+        """
+        with transaction.atomic():
+            if not cls.objects.filter(name=name).update(
+                    value=F('value') + 1, updated=timezone.now()):
+                cls.objects.create(name=name, value=1)
+        return cls.current(name)
+
+
 class TreeNode(CisModel):
     # name -- sub-string of full channel name.
     # Unless this is a leaf node, then it is the full channel name.
@@ -297,6 +792,31 @@ class TreeNode(CisModel):
     #   eg PSL,ODC,CHANNEL
     namepath = CharField(max_length=60, db_index=True, null=True)
 
+    # number of ancestors, and of direct children, and of leaf nodes below
+    # this node (redundant, kept up to date by add_channel and update_counts)
+    # nodes stored before these were added have a depth of 0, see has_counts
+    depth = IntegerField(default=0, db_index=True)
+    nchildren = IntegerField(default=0)
+    nleaves = IntegerField(default=0)
+
+    class Meta(CisModel.Meta):
+        index_together = [('parent', 'name')]
+
+    # set once every node is known to have its counts
+    _counted = False
+
+    @classmethod
+    def has_counts(cls):
+        """Returns `True` if the depth and counts of every node are stored
+
+        Nodes stored before the ``depth``, ``nchildren`` and ``nleaves``
+        fields were added have a depth of 0 (and no counts) until
+        `update_counts` is run.
+        """
+        if not cls._counted:
+            cls._counted = not cls.objects.filter(depth=0).exists()
+        return cls._counted
+
     @classmethod
     def add_channel(cls, channel):
         """Add a copy of a channel to the database
@@ -309,9 +829,14 @@ class TreeNode(CisModel):
             # recognizable sub-names.  Like a vacuum channel.
             # Ignore it.
             return
-        node = cls(name=channel.name, channel=channel)
+        node = cls(name=channel.name, channel=channel, depth=len(names) + 1)
         node.parent = cls.node_with_path(names, create=True)
         node.save()
+        cls.objects.filter(pk=node.parent_id).update(
+            nchildren=F('nchildren') + 1)
+        cls.objects.filter(namepath__in=[
+            ','.join(names[:i]) for i in range(1, len(names) + 1)]).update(
+            nleaves=F('nleaves') + 1)
 
     @classmethod
     def node_with_path(cls, path, create=False):
@@ -325,11 +850,91 @@ class TreeNode(CisModel):
         if not path:
             return None
 
-        node = cls(name=path[-1], namepath=namepath)
+        node = cls(name=path[-1], namepath=namepath, depth=len(path))
         node.parent = cls.node_with_path(path[0:-1], create)
         node.save()
+        if node.parent_id is not None:
+            cls.objects.filter(pk=node.parent_id).update(
+                nchildren=F('nchildren') + 1)
         return node
 
+    @classmethod
+    def subtree(cls, nodes, depth=1):
+        """Find the descendants of some nodes, to a maximum depth
+
+        All descendants are found with a single query, using the
+        ``namepath`` of the branches, and the ``depth`` of each node,
+        so this needs the stored counts, see `has_counts`.
+
+        Parameters
+        ----------
+        nodes : `list` of `TreeNode`
+            the nodes to search under, a new `TreeNode` without an ``id``
+            represents the root of the tree
+        depth : `int`, optional, default: `1`
+            the number of levels to return, the default returns the
+            children only
+
+        Returns
+        -------
+        descendants : `~django.db.models.query.QuerySet`
+            the descendants of all ``nodes``, ordered by name
+        """
+        query = Q(pk__in=[])
+        for node in nodes:
+            maxdepth = node.depth + depth
+            if node.id is None:
+                query |= Q(depth__lte=maxdepth)
+            elif node.namepath:
+                prefix = node.namepath + ','
+                query |= Q(parent=node.id) | (
+                    Q(depth__lte=maxdepth) &
+                    (Q(namepath__startswith=prefix) |
+                     Q(parent__namepath__startswith=prefix)))
+        return cls.objects.filter(query).order_by('name')
+
+    @classmethod
+    def update_counts(cls, chunk_size=500):
+        """Recount the depth, children, and leaves of every node
+
+        The whole tree is counted in memory, and only nodes whose counts
+        have changed are updated.
+
+        Returns
+        -------
+        n : `int`
+            the number of nodes that were updated
+        """
+        nodes = dict((id_, row) for id_, row in (
+            (row[0], row[1:]) for row in cls.objects.values_list(
+                'id', 'parent_id', 'channel_id', 'depth', 'nchildren',
+                'nleaves').iterator()))
+        depths = {}
+        nchildren = defaultdict(int)
+        nleaves = defaultdict(int)
+        for id_, (parent, channel, _, _, _) in nodes.items():
+            depth = 1
+            if parent is not None:
+                nchildren[parent] += 1
+            while parent is not None:
+                depth += 1
+                if channel is not None:
+                    nleaves[parent] += 1
+                parent = nodes[parent][0]
+            depths[id_] = depth
+        # group changes by the new counts, to write with few queries
+        changed = defaultdict(list)
+        for id_, (_, _, olddepth, oldchildren, oldleaves) in nodes.items():
+            counts = (depths[id_], nchildren.get(id_, 0), nleaves.get(id_, 0))
+            if counts != (olddepth, oldchildren, oldleaves):
+                changed[counts].append(id_)
+        with transaction.atomic():
+            for (depth, children, leaves), ids in changed.items():
+                for i in range(0, len(ids), chunk_size):
+                    cls.objects.filter(pk__in=ids[i:i+chunk_size]).update(
+                        depth=depth, nchildren=children, nleaves=leaves)
+        return sum(map(len, changed.values()))
+
 
 # Deprecated. TreeNode is a more descriptive name. Descriptions no longer used.
 class Description(CisModel):
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Brian Moe (2013-2014), Duncan Macleod (2014-)
+#
+# This file is part of LIGO CIS Core.
+#
+# LIGO CIS Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LIGO CIS Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parsing of LIGO channel names
+
+Channel names are parsed many times over in a single request or ingest
+run, so parsed names are kept in a bounded least-recently-used cache.
+"""
+
+import re
+from collections import namedtuple
+
+from . import version
+
+__version__ = version.version
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__credits__ = 'Brian Moe'
+
+#: regular expression for a channel name, see `Channel.re_name`
+RE_NAME = re.compile(
+    r'((?:(?P<ifo>[A-Z]\d))?|[\w-]+):'  # match IFO prefix
+     '(?:(?P<subsystem>[a-zA-Z0-9]+))?'  # match subsystem
+     '(?:[-_](?P<signal>[a-zA-Z0-9_-]+))?'  # match signal
+     '(?:\.(?P<trend>[a-z]+))?'  # match trend type
+     '(?:,(?P<type>([a-z]-)?[a-z]+))?'  # match channel type
+)
+
+#: maximum number of parsed names to keep in memory
+CACHE_SIZE = 2 ** 17
+
+
+class ChannelName(namedtuple('ChannelName', ('ifo', 'subsystem', 'signal',
+                                             'trend', 'type', 'parts'))):
+    """A parsed channel name
+
+    The ``parts`` attribute is a `tuple` of the subsystem, and each
+    underscore-separated part of the signal name, these are the component
+    names used for descriptions and the channel tree.
+    """
+    __slots__ = ()
+
+
+class LRUCache(object):
+    """A bounded cache that drops the least-recently-used items first
+
+    This is an approximate LRU, holding two generations of items in plain
+    `dict` objects. Lookups go to the current generation first, then the
+    previous one, promoting any hits. When the current generation is full,
+    the previous generation (everything not used since) is dropped. This
+    keeps cache hits as cheap as a single `dict` lookup, while holding at
+    most ``maxsize`` items.
+
+    Parameters
+    ----------
+    maxsize : `int`
+        the maximum number of items to store
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def get(self, key, default=None):
+        """Return the value for ``key``, marking it as recently used
+        """
+        value = self._current.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = self._previous.pop(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """Store a new value, dropping the least recently used if full
+        """
+        if len(self._current) >= self.maxsize // 2:
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = value
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+
+_MISSING = object()
+_cache = LRUCache(CACHE_SIZE)
+_new = tuple.__new__
+
+
+def _parse(name, match=RE_NAME.match):
+    match = match(name)
+    if match is None:
+        return None
+    _, ifo, subsystem, signal, trend, type_, _ = match.groups()
+    if signal is not None:
+        parts = (subsystem,) + tuple(signal.split('_'))
+    elif subsystem is not None:
+        parts = (subsystem,)
+    else:
+        parts = ()
+    return _new(ChannelName, (ifo, subsystem, signal, trend, type_, parts))
+
+
+def parse_channel_name(name):
+    """Parse a channel name
+
+    Parameters
+    ----------
+    name : `str`
+        the name to parse
+
+    Returns
+    -------
+    parsed : `ChannelName`
+        the parsed name, or `None` if ``name`` doesn't match `RE_NAME`
+    """
+    # this is the hot path, so look in the cache generations directly
+    parsed = _cache._current.get(name, _MISSING)
+    if parsed is _MISSING:
+        parsed = _cache._previous.pop(name, _MISSING)
+        if parsed is _MISSING:
+            parsed = _parse(name)
+        _cache.set(name, parsed)
+    return parsed
+
+
+def parse_channel_names(names):
+    """Parse a list of channel names in one call
+
+    Parameters
+    ----------
+    names : `iterable` of `str`
+        the names to parse
+
+    Returns
+    -------
+    parsed : `list` of `ChannelName`
+        the parsed names, in the same order as the input, with `None`
+        for any names that don't match `RE_NAME`
+    """
+    get = _cache.get
+    parse = _parse
+    out = []
+    missing = []
+    for name in names:
+        parsed = get(name, _MISSING)
+        if parsed is _MISSING:
+            parsed = parse(name)
+            missing.append((name, parsed))
+        out.append(parsed)
+    # only cache as many as we can hold
+    for name, parsed in missing[-(_cache.maxsize // 2):]:
+        _cache.set(name, parsed)
+    return out
@@ -19,4 +19,1052 @@
 """Tests for the CIS Core
 """
 
-# TODO: No tests have been defined
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from threading import (Lock, Thread)
+from unittest import skipUnless
+
+try:
+    from BaseHTTPServer import (HTTPServer, BaseHTTPRequestHandler)
+except ImportError:
+    from http.server import (HTTPServer, BaseHTTPRequestHandler)
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import (RequestFactory, SimpleTestCase, TestCase)
+from django.test.utils import CaptureQueriesContext
+
+from reversion import revisions as reversion
+
+from . import (catalogue, tree as channel_tree)
+from .api.views import (ChannelFacets, ChannelList)
+from .catalogue import (Catalogue, SearchResult)
+from .management import functions
+from .management.daqini import (InterpolationMissingOptionError,
+                                iter_daq_ini, read_daq_ini_configparser)
+from .management.functions import update_ligo_model
+from .models import (ChangeSet, Channel, ChannelChange, ChannelToken,
+                     ChannelTrigram, DaqFile, Ifo, Subsystem, TreeNode,
+                     tokens)
+from .names import (LRUCache, parse_channel_name, parse_channel_names)
+
+DEFAULT_SECTION = """[default]
+gain=1.00
+acquire=3
+dcuid=10
+ifoid=0
+datatype=4
+datarate=16384
+offset=0
+slope=1.0
+units=V
+"""
+
+
+def daq_ini(channels):
+    """Returns the text of a DAQ INI file for the given channels
+
+    Parameters
+    ----------
+    channels : `dict`
+        the parameters (beyond the ``[default]`` section) of each channel,
+        keyed by name
+    """
+    sections = [DEFAULT_SECTION]
+    for name in sorted(channels):
+        sections.append('[%s]\n%s\n' % (name, ''.join(
+            '%s=%s\n' % item for item in sorted(channels[name].items()))))
+    return '\n'.join(sections)
+
+
+class ChannelNameTestCase(SimpleTestCase):
+    """Tests for channel name parsing
+    """
+    NAMES = ['H1:SUS-ETMX_L2_OUT_DQ', 'L1:PEM', 'H1:GDS-CALIB_STRAIN.mean',
+             'H1:SYS-TEST_OUT,m-trend', 'X1-ADC:TEST_1', 'not a channel']
+
+    def test_parse(self):
+        for name in self.NAMES:
+            match = Channel.re_name.match(name)
+            parsed = parse_channel_name(name)
+            if match is None:
+                self.assertIsNone(parsed)
+                continue
+            self.assertEqual(
+                parsed[:5], tuple(match.group('ifo', 'subsystem', 'signal',
+                                              'trend', 'type')))
+            # cached names are the same object
+            self.assertIs(parse_channel_name(name), parsed)
+        self.assertEqual(parse_channel_name(self.NAMES[0]).parts,
+                         ('SUS', 'ETMX', 'L2', 'OUT', 'DQ'))
+        self.assertEqual(parse_channel_names(self.NAMES + self.NAMES[:2]),
+                         [parse_channel_name(name) for
+                          name in self.NAMES + self.NAMES[:2]])
+
+    def test_lru_cache(self):
+        cache_ = LRUCache(4)
+        for i in range(3):
+            cache_.set(i, str(i))
+        # reading 0 keeps it in, while 1 is dropped
+        self.assertEqual(cache_.get(0), '0')
+        for i in range(3, 5):
+            cache_.set(i, str(i))
+        self.assertLessEqual(len(cache_), 4)
+        self.assertEqual(cache_.get(0), '0')
+        self.assertIsNone(cache_.get(1))
+        self.assertEqual(cache_.get(4), '4')
+
+
+class UpdateLigoModelTestCase(TestCase):
+    """Tests for `update_ligo_model`
+    """
+    def _update(self, channels, **kwargs):
+        update_ligo_model(StringIO(daq_ini(channels)), modelname='h1test',
+                          **kwargs)
+
+    def _test_update(self, bulk):
+        channels = dict(('H1:SYS-TEST_%d_OUT_DQ' % i, {'chnnum': i}) for
+                        i in range(20))
+        self._update(channels, bulk=bulk)
+        # change every datarate, to one of two values, and a few units
+        for i, name in enumerate(sorted(channels)):
+            channels[name]['datarate'] = 256 * (1 + i % 2)
+            if i < 3:
+                channels[name]['units'] = 'm'
+        with CaptureQueriesContext(connection) as queries:
+            self._update(channels, bulk=bulk)
+
+        for name, params in channels.items():
+            channel = Channel.objects.get(name=name)
+            self.assertEqual(channel.datarate, params['datarate'])
+            self.assertEqual(channel.units, params.get('units', 'V'))
+            self.assertTrue(channel.is_current)
+            # one version when created, one when updated
+            self.assertEqual(len(reversion.get_for_object(channel)), 2)
+        update = 'UPDATE %s ' % connection.ops.quote_name(
+            Channel._meta.db_table)
+        return [q['sql'] for q in queries if update in q['sql']]
+
+    def test_update(self):
+        self.assertEqual(len(self._test_update(bulk=False)), 20)
+
+    def test_update_bulk(self):
+        # one UPDATE for each set of changed fields
+        self.assertEqual(len(self._test_update(bulk=True)), 2)
+
+    def test_retire(self):
+        channels = dict(('H1:SYS-TEST_%d_OUT_DQ' % i, {}) for i in range(10))
+        self._update(channels)
+        update_ligo_model(StringIO(daq_ini({'H1:SYS-OTHER_OUT_DQ': {}})),
+                          modelname='h1other')
+        for name in sorted(channels)[:4]:
+            channels.pop(name)
+        with CaptureQueriesContext(connection) as queries:
+            self._update(channels, bulk=True, chunk_size=3)
+        # one UPDATE for each chunk of retired channels
+        retire = 'SET %s ' % connection.ops.quote_name('is_current')
+        self.assertEqual(len([q for q in queries if retire in q['sql']]), 2)
+        self.assertEqual(
+            sorted(Channel.objects.filter(is_current=False).values_list(
+                'name', flat=True)),
+            ['H1:SYS-TEST_%d_OUT_DQ' % i for i in (0, 1, 2, 3)])
+        for channel in Channel.objects.filter(is_current=False):
+            self.assertEqual(len(reversion.get_for_object(channel)), 2)
+        # other models, and empty files, don't retire anything
+        update_ligo_model(StringIO(DEFAULT_SECTION), modelname='h1test')
+        self.assertEqual(Channel.objects.filter(is_current=True).count(), 7)
+
+
+    def test_registry(self):
+        self._update({'H1:SYS-TEST_OUT_DQ': {}})
+        registry = functions.IfoSubsystemRegistry()
+        # known records are found without a query
+        channel = Channel(name='H1:SYS-TEST_IN1_DQ')
+        with self.assertNumQueries(0):
+            self.assertTrue(functions.create_ifo_and_subsystem(
+                channel, 'h1test', registry=registry))
+        self.assertEqual((channel.ifo.name, channel.subsystem), ('H1', 'SYS'))
+        # new ones are created once
+        for name in ('L1:PEM-EX_OUT_DQ', 'L1:PEM-EY_OUT_DQ'):
+            functions.create_ifo_and_subsystem(Channel(name=name), 'l1test',
+                                               registry=registry)
+        self.assertEqual(Ifo.objects.filter(name='L1').count(), 1)
+        self.assertEqual(Subsystem.objects.filter(name='PEM').count(), 1)
+        # names without an IFO use the model name
+        channel = Channel(name=':PEM-EX_OUT_DQ')
+        functions.create_ifo_and_subsystem(channel, 'l1test',
+                                           registry=registry)
+        self.assertEqual(channel.ifo.name, 'l1')
+
+
+    def test_changeset(self):
+        for bulk in (False, True):
+            ChangeSet.objects.all().delete()
+            Channel.objects.all().delete()
+            channels = dict(('H1:SYS-TEST_%d_OUT_DQ' % i, {}) for
+                            i in range(4))
+            recorder = functions.ChangeSetRecorder(comment='test',
+                                                   chunk_size=3)
+            self._update(channels, bulk=bulk, changeset=recorder)
+            channels.pop('H1:SYS-TEST_0_OUT_DQ')
+            channels['H1:SYS-TEST_1_OUT_DQ']['units'] = 'm'
+            self._update(channels, bulk=bulk, changeset=recorder)
+            recorder.flush()
+            self.assertEqual(recorder.count, 6)
+            self.assertEqual(ChangeSet.objects.count(), 1)
+            changes = dict(((change.channel.name, change.action),
+                            change.field_dict()) for
+                           change in ChannelChange.objects.all())
+            self.assertEqual(len(changes), 6)
+            self.assertEqual(
+                changes['H1:SYS-TEST_1_OUT_DQ', ChannelChange.UPDATED],
+                {'units': 'm'})
+            self.assertEqual(
+                changes['H1:SYS-TEST_0_OUT_DQ', ChannelChange.RETIRED],
+                {'is_current': False})
+            self.assertEqual(changes['H1:SYS-TEST_2_OUT_DQ',
+                                     ChannelChange.CREATED]['datarate'],
+                             16384)
+            # no full revisions
+            for channel in Channel.objects.all():
+                self.assertEqual(len(reversion.get_for_object(channel)), 0)
+
+
+    @skipUnless(connection.vendor == 'sqlite',
+                "only SQLite limits the number of query parameters")
+    def test_bulk_update_parameters(self):
+        self._update(dict(('H1:SYS-TEST_%d_OUT_DQ' % i, {'chnnum': i}) for
+                          i in range(500)), bulk=True)
+        channels = list(Channel.objects.all())
+        for i, channel in enumerate(channels):
+            channel.datarate = 256 * (1 + i % 2)
+            channel.units = 'm' if i % 2 else 's'
+        with CaptureQueriesContext(connection) as queries:
+            functions._bulk_update(Channel, channels, ['datarate', 'units'])
+        updates = [q['sql'] for q in queries if 'UPDATE' in q['sql']]
+        self.assertTrue(updates)
+        for sql in updates:
+            # two parameters for each WHEN, and one for each pk
+            nwhen = sql.count(' WHEN ')
+            self.assertLessEqual(2 * nwhen + nwhen // 2, 999)
+        self.assertEqual(Channel.objects.filter(units='m').count(), 250)
+
+
+class FetchConcurrentlyTestCase(TestCase):
+    """Tests for `_fetch_concurrently`
+    """
+    def setUp(self):
+        self._download = functions._download
+        self.started = []
+        lock = Lock()
+
+        def _download(url, cache=None):
+            with lock:
+                self.started.append(url)
+            time.sleep(.05)
+            return StringIO(url), {}
+
+        functions._download = _download
+
+    def tearDown(self):
+        functions._download = self._download
+
+    def test_hosts_in_turn(self):
+        files = [('%s.ini' % i, 'http://%s/%s%d.ini' % (host, host, i)) for
+                 host in ('a', 'b') for i in range(6)]
+        fetched = list(functions._fetch_concurrently(files, 4, 2))
+        self.assertEqual(sorted(url for _, url, _ in fetched),
+                         sorted(url for _, url in files))
+        # both hosts are used from the start
+        self.assertEqual(sorted(url[7] for url in self.started[:4]),
+                         ['a', 'a', 'b', 'b'])
+
+
+class _DaqIniHandler(BaseHTTPRequestHandler):
+    """Serve the files of a `DaqIniServer`, and a page linking to them
+    """
+    def do_GET(self):
+        files = self.server.files
+        name = self.path.lstrip('/')
+        if not name:
+            body = ''.join('<a href="%s">%s</a>\n' % (name, name) for
+                           name in sorted(files))
+            headers = {}
+        elif name in files:
+            body, headers = files[name]
+        else:
+            return self.send_error(404)
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DaqIniServer(HTTPServer):
+    """Local stand-in for a server of DAQ INI files
+
+    ``files`` holds the ``(body, headers)`` of each file, keyed by name.
+    """
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _DaqIniHandler)
+        self.files = {}
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class DaqFileCacheTestCase(TestCase):
+    """Tests for downloading DAQ INI files with a `DaqFileCache`
+    """
+    def setUp(self):
+        self.server = DaqIniServer()
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.server.files.update({
+            'h1a.ini': ('a1', {'ETag': '"a1"',
+                               'Last-Modified': 'Mon, 01 Jan 2018 00:00:00'}),
+            'h1b.ini': ('b1', {'Last-Modified': 'Mon, 01 Jan 2018 00:00:00'}),
+            'h1c.ini': ('c1', {}),
+        })
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _fetch(self, **kwargs):
+        """Run one update, returning the names and contents of the new files
+        """
+        cache = functions.DaqFileCache()
+        return dict((ini, content.read()) for ini, content in
+                    functions.iterate_daq_ini_files(
+                        self.server.url, cache=cache, **kwargs))
+
+    def test_cache(self):
+        # the first update downloads everything
+        self.assertEqual(self._fetch(), {'h1a.ini': 'a1', 'h1b.ini': 'b1',
+                                         'h1c.ini': 'c1'})
+        # and the next skips everything
+        self.assertEqual(self._fetch(), {})
+
+        # a new ETag, with the same Last-Modified, is a new file
+        self.server.files['h1a.ini'] = ('a2', {
+            'ETag': '"a2"', 'Last-Modified': 'Mon, 01 Jan 2018 00:00:00'})
+        # a new body without new validators is only found by its digest
+        self.server.files['h1c.ini'] = ('c2', {})
+        self.assertEqual(self._fetch(nthreads=2), {'h1a.ini': 'a2',
+                                                   'h1c.ini': 'c2'})
+        self.assertEqual(self._fetch(nthreads=2), {})
+
+    def test_new_headers(self):
+        self._fetch()
+        # new headers, but the same content, isn't a new file, but the
+        # headers are stored
+        self.server.files['h1b.ini'] = ('b1', {
+            'Last-Modified': 'Tue, 02 Jan 2018 00:00:00'})
+        self.assertEqual(self._fetch(), {})
+        self.assertEqual(DaqFile.objects.get(
+            url=self.server.url + 'h1b.ini').last_modified,
+            'Tue, 02 Jan 2018 00:00:00')
+
+
+class LocalDaqFileTestCase(TestCase):
+    """Tests for reading DAQ INI files from a directory or archive
+    """
+    FILES = {'h1a.ini': 'a1', 'h1b.ini': 'b1'}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'chans')
+        os.mkdir(self.source)
+        for name, content in list(self.FILES.items()) + [('README', 'x')]:
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fetch(self, source, **kwargs):
+        """Run one update, returning the names and contents of the new files
+        """
+        cache = functions.DaqFileCache()
+        files = {}
+        for ini, content in functions.iterate_daq_ini_files(
+                source, cache=cache, **kwargs):
+            if isinstance(content, str):  # a path
+                with open(content) as f:
+                    content = f.read()
+            else:
+                content = content.read()
+            files[ini] = content
+        return files
+
+    def test_directory(self):
+        self.assertEqual(self._fetch(self.source), self.FILES)
+        self.assertEqual(self._fetch(self.source), {})
+        path = os.path.join(self.source, 'h1b.ini')
+        with open(path, 'w') as f:
+            f.write('b2')
+        os.utime(path, (0, 0))
+        self.assertEqual(self._fetch(self.source), {'h1b.ini': 'b2'})
+        self.assertEqual(self._fetch(
+            self.source, select=lambda name: name == 'h1a.ini'), {})
+
+    def test_archives(self):
+        tar = os.path.join(self.tmpdir, 'chans.tar.gz')
+        with tarfile.open(tar, 'w:gz') as archive:
+            archive.add(self.source, arcname='chans')
+        zip_ = os.path.join(self.tmpdir, 'chans.zip')
+        with zipfile.ZipFile(zip_, 'w') as archive:
+            for name in os.listdir(self.source):
+                archive.write(os.path.join(self.source, name),
+                              arcname='chans/%s' % name)
+        for source in (tar, zip_):
+            self.assertEqual(self._fetch(source), self.FILES)
+            self.assertEqual(self._fetch(source), {})
+        self.assertRaises(IOError, self._fetch,
+                          os.path.join(self.source, 'README'))
+
+
+DAQ_INI_SAMPLES = {
+    'simple': DEFAULT_SECTION + """
+# a comment
+[H1:SYS-TEST_A_OUT_DQ]
+datarate=256
+; another comment
+[H1:SYS-TEST_B_OUT_DQ]
+Units=m
+chnnum=2
+
+[H1:SYS-TEST_C_OUT_DQ]
+units=multi
+  line
+chnnum=%(dcuid)s0
+""",
+    'repeated': DEFAULT_SECTION + """
+[H1:SYS-TEST_A_OUT_DQ]
+datarate=256
+chnnum=1
+[H1:SYS-TEST_B_OUT_DQ]
+chnnum=2
+[H1:SYS-TEST_A_OUT_DQ]
+datarate=512
+""",
+    'late-default': """
+[H1:SYS-TEST_A_OUT_DQ]
+datarate=256
+""" + DEFAULT_SECTION,
+}
+
+
+class DaqIniTestCase(SimpleTestCase):
+    """Tests for `iter_daq_ini`, against `read_daq_ini_configparser`
+    """
+    def _compare(self, text, extra=None):
+        ref = read_daq_ini_configparser(StringIO(text), extra=extra)
+        self.assertEqual(list(iter_daq_ini(StringIO(text), extra=extra)),
+                         ref)
+        # and from a memory-mapped file
+        fd, path = tempfile.mkstemp(suffix='.ini')
+        try:
+            with os.fdopen(fd, 'w') as fobj:
+                fobj.write(text)
+            self.assertEqual(list(iter_daq_ini(path, extra=extra)), ref)
+        finally:
+            os.unlink(path)
+        return ref
+
+    def test_samples(self):
+        for name, text in sorted(DAQ_INI_SAMPLES.items()):
+            ref = self._compare(text, extra={'source': 'H1TEST'})
+            self.assertTrue(ref, msg=name)
+
+    def test_repeated(self):
+        # repeated sections are merged, in the first position
+        ref = self._compare(DAQ_INI_SAMPLES['repeated'])
+        self.assertEqual([name for name, _ in ref],
+                         ['H1:SYS-TEST_A_OUT_DQ', 'H1:SYS-TEST_B_OUT_DQ'])
+        self.assertEqual(ref[0][1]['datarate'], '512')
+        self.assertEqual(ref[0][1]['chnnum'], '1')
+
+    def test_missing_interpolation(self):
+        text = DEFAULT_SECTION + "[H1:SYS-TEST_A_OUT_DQ]\nchnnum=%(nope)s\n"
+        with self.assertRaises(InterpolationMissingOptionError):
+            read_daq_ini_configparser(StringIO(text))
+        with self.assertRaises(InterpolationMissingOptionError):
+            list(iter_daq_ini(StringIO(text)))
+
+
+class UserQueryTestCase(TestCase):
+    """Tests for `Channel.user_query`
+    """
+    NAMES = [
+        'H1:SUS-ETMX_L2_OUT_DQ',
+        'H1:SUS-ETMY_L2_COIL_OUT_DQ',
+        'H1:LSC-DARM_IN1_DQ',
+        'H1:LSC-DARM_OUT16',
+        'L1:LSC-DARM_OUT_DQ',
+        'L1:PEM-EX_MIC_OUT_DQ',
+    ]
+
+    def setUp(self):
+        update_ligo_model(StringIO(daq_ini(dict(
+            (name, {}) for name in self.NAMES))), modelname='h1test')
+
+    def _match(self, query, name):
+        """Reference implementation of a query for one channel name
+        """
+        def match(aterm):
+            if aterm[:4].lower() == ChannelToken.PREFIX:
+                value = aterm[4:]
+                toks = set(t.upper() for t in value.split('_') if t)
+                return (toks <= tokens(name) and
+                        value.lower() in name.lower())
+            return aterm.lower() in name.lower()
+        return any(all(match(aterm) for aterm in term.split()) for
+                   term in query.split('|'))
+
+    QUERIES = ['darm', 'DARM out', 'l1: | etmx', 'ou', 'xyz',
+               'H1:SUS-ETMX_L2_OUT_DQ', 'tok:darm', 'tok:OUT_DQ',
+               'tok:out_dq l1:', 'tok:OUT tok:DQ | coil', 'tok:ETM',
+               'sus tok:L2', 'etmx_l2 | mic_out', 'pem-ex | darm_in1',
+               'lsc darm_out | mic']
+
+    def tearDown(self):
+        ChannelTrigram._available = False
+
+    def _test_user_query(self):
+        for query in self.QUERIES:
+            self.assertEqual(
+                set(Channel.objects.filter(Channel.user_query(query))
+                    .values_list('name', flat=True)),
+                set(name for name in self.NAMES if self._match(query, name)),
+                msg=query)
+        self.assertEqual(Channel.objects.filter(Channel.user_query(' '))
+                         .count(), len(self.NAMES))
+
+    def test_user_query(self):
+        self.assertFalse(ChannelTrigram.is_available())
+        self._test_user_query()
+
+    def test_user_query_indexed(self):
+        ChannelTrigram.build_index()
+        self.assertTrue(ChannelTrigram.is_available())
+        # renamed channels are indexed again
+        channel = Channel.objects.get(name=self.NAMES[0])
+        channel.name = 'H1:SUS-ETMX_L3_OUT_DQ'
+        channel.save()
+        self.assertEqual(ChannelTrigram.candidates(['etmx_l3']),
+                         [channel.pk])
+        self.assertEqual(ChannelTrigram.candidates(['etmx_l2']), [])
+        channel.name = self.NAMES[0]
+        channel.save()
+        self.assertEqual(ChannelTrigram.candidates(['etmx_l2']),
+                         [channel.pk])
+        self.assertEqual(ChannelTrigram.candidates(['nope']), [])
+        self.assertIsNone(ChannelTrigram.candidates(['ou']))
+        self._test_user_query()
+        # skip common trigrams, and give up if too many candidates
+        postings, ncand = (ChannelTrigram.MAX_POSTINGS,
+                           ChannelTrigram.MAX_CANDIDATES)
+        try:
+            ChannelTrigram.MAX_POSTINGS = 3
+            self._test_user_query()
+            ChannelTrigram.MAX_POSTINGS = postings
+            ChannelTrigram.MAX_CANDIDATES = 1
+            self._test_user_query()
+        finally:
+            ChannelTrigram.MAX_POSTINGS = postings
+            ChannelTrigram.MAX_CANDIDATES = ncand
+
+    def test_token_index(self):
+        def find(query):
+            return sorted(Channel.objects.filter(Channel.user_query(query))
+                          .values_list('name', flat=True))
+
+        self.assertEqual(find('tok:ETMX'), ['H1:SUS-ETMX_L2_OUT_DQ'])
+        # renamed channels are indexed again
+        channel = Channel.objects.get(name='H1:SUS-ETMX_L2_OUT_DQ')
+        channel.name = 'H1:SUS-ETMZ_L2_OUT_DQ'
+        channel.save()
+        self.assertEqual(find('tok:ETMX'), [])
+        self.assertEqual(find('tok:etmz'), ['H1:SUS-ETMZ_L2_OUT_DQ'])
+        # as are channels added in bulk
+        update_ligo_model(StringIO(daq_ini({'H1:SUS-ETMX_M0_OUT_DQ': {}})),
+                          modelname='h1new', bulk=True)
+        self.assertEqual(find('tok:ETMX'), ['H1:SUS-ETMX_M0_OUT_DQ'])
+        # and a rebuild gives the same index
+        rows = sorted(ChannelToken.objects.values_list('token',
+                                                       'channel_id'))
+        ChannelToken.build_index()
+        self.assertEqual(sorted(ChannelToken.objects.values_list(
+            'token', 'channel_id')), rows)
+
+
+class CatalogueTestCase(SimpleTestCase):
+    """Tests for `Catalogue` and `SearchResult`
+    """
+    ROWS = [(i, 'H1:SYS-TEST_%02d_%s' % (i, 'OUT_DQ' if i % 3 else 'IN1'),
+             i % 2) for i in range(1, 41)]
+
+    def _test_ranges(self, pattern, current_only=False):
+        catalogue = Catalogue(self.ROWS)
+        regex = re.compile(pattern, re.I)
+        expected = [id_ for id_, name, current in self.ROWS if
+                    regex.search(name) and (current or not current_only)]
+        for start, stop in [(0, 2), (0, 5), (3, 9), (4, 100), (0, None),
+                            (6, None)]:
+            result = SearchResult(catalogue, regex,
+                                  current_only=current_only, keep=4)
+            self.assertEqual(result.ids(start, stop), expected[start:stop])
+            self.assertLessEqual(len(result._found), 4)
+            self.assertEqual(result.count(), len(expected))
+            self.assertEqual(result.ids(start, stop), expected[start:stop])
+        return expected
+
+    def test_ids(self):
+        self.assertEqual(len(self._test_ranges('out_dq$')), 27)
+        # full scans read the names in blocks
+        block = catalogue.SCAN_BLOCK
+        try:
+            catalogue.SCAN_BLOCK = 7
+            self.assertEqual(len(self._test_ranges('out_dq$')), 27)
+            self.assertTrue(self._test_ranges('[0-9]1_', True))
+        finally:
+            catalogue.SCAN_BLOCK = block
+        self.assertEqual(len(self._test_ranges('out_dq$', True)), 13)
+        self.assertEqual(len(self._test_ranges('_0[12]_')), 2)
+        self.assertEqual(self._test_ranges('nope'), [])
+
+    def test_estimate_count(self):
+        # only the IN1 channels are current
+        catalogue = Catalogue((id_, name, name.endswith('IN1')) for
+                              id_, name, _ in self.ROWS)
+        self.assertEqual(catalogue.estimate_count('in1'), 13)
+        self.assertEqual(catalogue.estimate_count('in1', True), 13)
+        self.assertEqual(catalogue.estimate_count('test', True), 13)
+        self.assertEqual(catalogue.estimate_count('out_dq | in1'), 40)
+
+
+class RegexSearchTestCase(TestCase):
+    """Tests for ``/RE/`` channel searches
+    """
+    def setUp(self):
+        self.channels = dict(
+            ('H1:SYS-TEST_%02d_%s' % (i, 'OUT_DQ' if i % 3 else 'IN1'),
+             {'datarate': 2 ** (i % 5 + 8)}) for i in range(30))
+        update_ligo_model(StringIO(daq_ini(self.channels)),
+                          modelname='h1test')
+        catalogue._catalogue = None
+
+    def tearDown(self):
+        catalogue._catalogue = None
+
+    def _view(self, view, **params):
+        view = view()
+        view.request = RequestFactory().get('/', params)
+        return view
+
+    def test_sort(self):
+        pattern = r'(?<!_0)\d_out'
+        regex = re.compile(pattern, re.I)
+        # ties are broken by name, in the direction of the sort
+        expected = sorted(((params['datarate'], name) for
+                           name, params in self.channels.items() if
+                           regex.search(name)), reverse=True)
+        for sort in ('', '-datarate'):
+            view = self._view(ChannelList, q='/%s/' % pattern, sort=sort)
+            result = view.filter_queryset(Channel.objects.all())
+            names = [channel.name for channel in result]
+            if sort:
+                self.assertEqual(names, [name for _, name in expected])
+            else:
+                self.assertEqual(names, sorted(names))
+            self.assertEqual(set(names), set(name for _, name in expected))
+        # large results are matched by the database
+        size = catalogue.FILTER_SIZE
+        try:
+            catalogue.FILTER_SIZE = 4
+            result = catalogue.get_catalogue().search(regex).filter(
+                Channel.objects.all())
+            self.assertEqual(set(result.values_list('name', flat=True)),
+                             set(name for _, name in expected))
+            self.assertNotIn(' IN (', str(result.query))
+        finally:
+            catalogue.FILTER_SIZE = size
+
+    def test_facets(self):
+        view = self._view(ChannelFacets, q='/_in1$/')
+        data = view.get_facets('/_in1$/', True)
+        self.assertEqual(data['count'], 10)
+        self.assertEqual(view.get_facets('/.*/', True)['count'], 30)
+        self.assertEqual(view.get_facets('/nope/', True)['count'], 0)
+
+
+class ChannelApiTestCase(TestCase):
+    """Tests for the channel API
+    """
+    def setUp(self):
+        cache.clear()
+        self.channels = dict(
+            ('H1:SYS-TEST_%02d_%s' % (i, 'OUT_DQ' if i % 3 else 'IN1'),
+             {'datarate': 2 ** (i % 5 + 8)}) for i in range(30))
+        update_ligo_model(StringIO(daq_ini(self.channels)),
+                          modelname='h1test')
+        catalogue._catalogue = None
+
+    def tearDown(self):
+        catalogue._catalogue = None
+
+    def _get(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_cursor(self):
+        # ties are broken by name, in the direction of the sort
+        by_rate = [name for _, name in sorted(
+            ((params['datarate'], name) for
+             name, params in self.channels.items()), reverse=True)]
+        for sort, expected in (('-datarate', by_rate),
+                               ('name', sorted(self.channels))):
+            url, names = '/api/channel/', []
+            params = {'cursor': '', 'sort': sort, 'page_size': 7}
+            while url is not None:
+                data = json.loads(self._get(url, **params).content.decode())
+                self.assertLessEqual(len(data['results']), 7)
+                names.extend(item['name'] for item in data['results'])
+                url, params = data['next'], {}
+            self.assertEqual(names, expected)
+        # regular expression results are skipped through in memory
+        data = json.loads(self._get(
+            '/api/channel/', cursor='', q='/_in1$/',
+            page_size=4).content.decode())
+        page = json.loads(self.client.get(data['next']).content.decode())
+        self.assertEqual(
+            [item['name'] for item in data['results'] + page['results']],
+            sorted(name for name in self.channels if name.endswith('IN1'))[
+                :8])
+        response = self.client.get('/api/channel/', {'cursor': 'junk'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_result_cache(self):
+        def get(query, range_):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/channel/', {'q': query},
+                                           HTTP_RANGE=range_)
+            return response, [q['sql'] for q in queries]
+
+        response, queries = get('sys test_0', 'items=0-4')
+        self.assertEqual(response['Content-Range'], 'items 0-4/10')
+        # later ranges of the same, normalised, query don't search again
+        response, queries = get(' SYS   Test_0 ', 'items=5-9')
+        self.assertEqual(response['Content-Range'], 'items 5-9/10')
+        self.assertFalse([sql for sql in queries if
+                          'COUNT(' in sql or ' LIKE ' in sql])
+        # until the channels change
+        Channel.objects.filter(name='H1:SYS-TEST_08_OUT_DQ').update(
+            name='H1:SYS-TEST_80_OUT_DQ')
+        response, queries = get('sys test_0', 'items=5-9')
+        self.assertEqual(response['Content-Range'], 'items 5-9/10')
+        catalogue.bump()
+        response, queries = get('sys test_0', 'items=5-9')
+        self.assertEqual(response['Content-Range'], 'items 5-8/9')
+
+
+    def test_count_estimated(self):
+        size = ChannelList.result_cache_size
+        try:
+            ChannelList.result_cache_size = 5
+            response = self.client.get('/api/channel/', {'q': 'sys'},
+                                       HTTP_RANGE='items=0-9')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Count-Estimated'], 'true')
+            start, total = re.match(r'items 0-(\d+)/(\d+)',
+                                    response['Content-Range']).groups()
+            self.assertEqual(int(start), 9)
+            self.assertGreaterEqual(int(total), 30)
+            # the end of the results corrects the count
+            for range_ in ('items=25-39', 'items=0-9'):
+                response = self.client.get('/api/channel/', {'q': 'sys'},
+                                           HTTP_RANGE=range_)
+                self.assertNotIn('X-Count-Estimated', response)
+                self.assertTrue(response['Content-Range'].endswith('/30'))
+            # field filters are counted exactly
+            response = self.client.get('/api/channel/',
+                                       {'q': 'sys', 'datarate': 256},
+                                       HTTP_RANGE='items=0-1')
+            self.assertNotIn('X-Count-Estimated', response)
+            self.assertEqual(response['Content-Range'], 'items 0-1/6')
+        finally:
+            ChannelList.result_cache_size = size
+
+    def test_facets(self):
+        data = json.loads(self._get('/api/facets', q='sys').content.decode())
+        self.assertEqual(data['count'], 30)
+        self.assertEqual(data['facets']['datarate'], [
+            {'value': 2 ** (i + 8), 'count': 6} for i in range(5)])
+        self.assertEqual(data['facets']['ifo'],
+                         [{'value': 'H1', 'count': 30}])
+        data = json.loads(self._get(
+            '/api/facets', q='/_in1$/', datarate__lt=1024).content.decode())
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(sum(item['count'] for
+                             item in data['facets']['datarate']), 4)
+
+    def test_filters(self):
+        def names(**params):
+            response = self.client.get('/api/channel/', params,
+                                       HTTP_RANGE='items=0-99')
+            self.assertEqual(response.status_code, 200)
+            return sorted(item['name'] for
+                          item in json.loads(response.content.decode()))
+
+        def expected(match):
+            return sorted(name for name, params in self.channels.items() if
+                          match(params['datarate']))
+
+        self.assertEqual(names(datarate__gte=2048),
+                         expected(lambda rate: rate >= 2048))
+        self.assertEqual(names(datarate__gt=256, datarate__lt=4096),
+                         expected(lambda rate: 256 < rate < 4096))
+        self.assertEqual(names(datarate='256,4096', sort='-datarate'),
+                         expected(lambda rate: rate in (256, 4096)))
+        self.assertEqual(names(q='_out', datarate__lte=256),
+                         [name for name in expected(lambda rate: rate <= 256)
+                          if name.endswith('OUT_DQ')])
+        self.assertEqual(names(ifo='L1'), [])
+        for params in ({'datarate__gte': 'fast'}, {'datarate__gte': '1,2'},
+                       {'subsystem__gt': 'a'}, {'is_testpoint': 'maybe'}):
+            response = self.client.get('/api/channel/', params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_complete(self):
+        data = json.loads(self._get(
+            '/api/complete', prefix='h1:sys-test_0', limit=3).content.decode())
+        self.assertEqual(data['count'], 10)
+        self.assertEqual(data['completions'],
+                         sorted(name for name in self.channels if
+                                name.startswith('H1:SYS-TEST_0'))[:3])
+        self.assertEqual([item['prefix'] for item in data['branches']],
+                         ['H1:SYS-TEST_0%d' % i for i in range(10)])
+        self.assertEqual(set(item['count'] for item in data['branches']),
+                         set([1]))
+        data = json.loads(self._get(
+            '/api/complete', prefix='h1:sys-test_').content.decode())
+        self.assertEqual(data['count'], 30)
+        self.assertEqual(data['branches'], [
+            {'prefix': 'H1:SYS-TEST_%d' % i, 'count': 10} for i in range(3)])
+        data = json.loads(self._get(
+            '/api/complete', prefix='l1:').content.decode())
+        self.assertEqual((data['count'], data['completions']), (0, []))
+
+
+class TreeRenderTestCase(TestCase):
+    """Tests for `tree.render`
+    """
+    def setUp(self):
+        cache.clear()
+        self.channels = dict(('H1:SYS-TEST_%s_%s_DQ' % (x, y), {}) for
+                             x in 'ABCD' for y in ('OUT', 'IN1', 'ERR'))
+        self.channels.update(('L1:PEM-EX_%s_OUT_DQ' % x, {}) for x in 'AB')
+        update_ligo_model(StringIO(daq_ini(self.channels)),
+                          modelname='h1test')
+        functions.update_tree_nodes(bulk=True)
+
+    def _shape(self, node):
+        """Returns the names, counts and children of a rendered node
+        """
+        children = node.get('children')
+        if isinstance(children, list):
+            children = sorted(self._shape(child) for child in children)
+        return node['name'], node.get('nleaves'), children
+
+    @staticmethod
+    def _nleaves(shape):
+        return sum(nleaves for _, nleaves, _ in shape[2])
+
+    def _rebuilt(self):
+        """Returns the shape of the whole tree, rebuilt from scratch
+        """
+        TreeNode.objects.all().delete()
+        functions.update_tree_nodes()
+        return self._shape(channel_tree.render(depth=channel_tree.MAX_DEPTH))
+
+    def _walk(self, node):
+        """Check each expanded node is complete, and count the nodes
+        """
+        if not isinstance(node.get('children'), list):
+            return 1
+        if node['id']:
+            self.assertEqual(len(node['children']),
+                             TreeNode.objects.get(id=node['id']).nchildren)
+        return 1 + sum(self._walk(child) for child in node['children'])
+
+    def test_max_nodes(self):
+        full = channel_tree.render(depth=channel_tree.MAX_DEPTH)
+        total = self._walk(full)
+        self.assertEqual(total, TreeNode.objects.count() + 1)
+        maxnodes = channel_tree.MAX_NODES
+        try:
+            for n in (total, 6, 3, 1):
+                channel_tree.MAX_NODES = n
+                root = channel_tree.render(depth=channel_tree.MAX_DEPTH)
+                self.assertLessEqual(self._walk(root), max(
+                    n + 1, len(root['children']) + 1))
+                self.assertEqual([child['name'] for child in
+                                  root['children']],
+                                 [child['name'] for child in
+                                  full['children']])
+                nodes = channel_tree.render(
+                    depth=3, ids=[child['id'] for child in full['children']])
+                for node in nodes:
+                    self._walk(node)
+                    self.assertIsInstance(node['children'], list)
+        finally:
+            channel_tree.MAX_NODES = maxnodes
+
+    def test_bulk(self):
+        bulk = self._shape(channel_tree.render(depth=channel_tree.MAX_DEPTH))
+        self.assertEqual(self._nleaves(bulk), len(self.channels))
+        # a second run adds nothing
+        with CaptureQueriesContext(connection) as queries:
+            functions.update_tree_nodes(bulk=True)
+        self.assertFalse([q for q in queries if 'INSERT' in q['sql']])
+        self.assertEqual(self._rebuilt(), bulk)
+        # and the bulk build drops retired channels
+        Channel.objects.filter(name__startswith='L1:').update(
+            is_current=False)
+        functions.update_tree_nodes(bulk=True)
+        bulk = self._shape(channel_tree.render(depth=channel_tree.MAX_DEPTH))
+        self.assertEqual(self._nleaves(bulk), len(self.channels) - 2)
+        self.assertEqual(self._rebuilt(), bulk)
+
+    def test_update_tree(self):
+        # add some channels, and retire others, including a whole branch
+        channels = dict((name, params) for name, params in
+                        self.channels.items() if '_A_' not in name and
+                        not name.startswith('L1:'))
+        channels.update(('H1:SYS-TEST_%s_OUT_DQ' % x, {}) for x in 'EF')
+        channels['H1:SYS-NEW_OUT_DQ'] = {}
+        tree = functions.TreeChanges()
+        update_ligo_model(StringIO(daq_ini(channels)), modelname='h1test',
+                          tree=tree)
+        self.assertEqual(len(tree), 8)
+        gen = channel_tree.generation()
+        functions.update_tree(tree)
+        self.assertGreater(channel_tree.generation(), gen)
+        updated = self._shape(channel_tree.render(
+            depth=channel_tree.MAX_DEPTH))
+        self.assertEqual(self._nleaves(updated), len(channels))
+        self.assertEqual(self._rebuilt(), updated)
+
+
+    def test_etag(self):
+        response = self.client.get('/tree/data/', {'depth': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        etag = response['ETag']
+        self.assertEqual(json.loads(response.content.decode()),
+                         channel_tree.render(depth=2))
+        response = self.client.get('/tree/data/', {'depth': 2},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        # each request has its own tag
+        response = self.client.get('/tree/data/', {'depth': 3},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # and a change to the tree makes a new one
+        tree = functions.TreeChanges()
+        update_ligo_model(StringIO(daq_ini({'H1:SYS-TEST_E_OUT_DQ': {}})),
+                          modelname='h1new', tree=tree)
+        functions.update_tree(tree)
+        response = self.client.get('/tree/data/', {'depth': 2},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content.decode())['children'][
+            1]['nleaves'], 13)
+        # too many ids
+        response = self.client.get('/tree/data/', {'ids': ','.join(
+            map(str, range(1, channel_tree.MAX_IDS + 2)))})
+        self.assertEqual(response.status_code, 400)
+
+
+class TreeCountsTestCase(TestCase):
+    """Tests for trees stored before the `TreeNode` counts were added
+    """
+    def setUp(self):
+        # generations restart with each test
+        cache.clear()
+        channels = dict(('H1:SYS-TEST_%s_OUT_DQ' % x, {}) for x in 'ABC')
+        channels.update(('H1:PEM-EX_%s_OUT_DQ' % x, {}) for x in 'AB')
+        update_ligo_model(StringIO(daq_ini(channels)), modelname='h1test')
+        functions.update_tree_nodes(bulk=True)
+        self.counted = channel_tree.render()
+        # forget the counts
+        TreeNode.objects.update(depth=0, nchildren=0, nleaves=0)
+        TreeNode._counted = False
+
+    def tearDown(self):
+        TreeNode._counted = False
+
+    def _add(self, name):
+        tree = functions.TreeChanges()
+        update_ligo_model(StringIO(daq_ini({name: {}})), modelname='h1new',
+                          tree=tree)
+        return tree
+
+    def _strip(self, node):
+        """Remove the counts from a rendered node, and its children
+        """
+        node = dict((key, value) for key, value in node.items() if
+                    key != 'nleaves')
+        if isinstance(node.get('children'), list):
+            node['children'] = [self._strip(child) for
+                                child in node['children']]
+        return node
+
+    def test_render(self):
+        self.assertFalse(TreeNode.has_counts())
+        self.assertEqual(channel_tree.render(), self._strip(self.counted))
+        self.assertEqual(channel_tree.render(depth=3),
+                         self._strip(self.counted))
+
+    def test_update_tree(self):
+        gen = channel_tree.generation()
+        functions.update_tree(self._add('H1:SYS-TEST_D_OUT_DQ'))
+        self.assertTrue(TreeNode.has_counts())
+        self.assertGreater(channel_tree.generation(), gen)
+        # nothing left to recount
+        self.assertEqual(TreeNode.update_counts(), 0)
+
+    def test_update_tree_nodes(self):
+        self._add('H1:SYS-TEST_D_OUT_DQ')
+        functions.update_tree_nodes()
+        self.assertEqual(TreeNode.update_counts(), 0)
+        self.assertEqual(TreeNode.objects.filter(
+            channel__name='H1:SYS-TEST_D_OUT_DQ').count(), 1)
+
+    def test_precompute(self):
+        gen = channel_tree.generation()
+        self.assertEqual(channel_tree.precompute(), 3)
+        self.assertGreater(channel_tree.generation(), gen)
+        self.assertEqual(json.loads(channel_tree.get_json(
+            channel_tree.generation())), self.counted)
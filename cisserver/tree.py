@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Brian Moe (2013-2014), Duncan Macleod (2014-)
+#
+# This file is part of LIGO CIS Core.
+#
+# LIGO CIS Core is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LIGO CIS Core is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
+
+"""JSON views of the channel tree
+
+The tree only changes when it is updated after an ingest, which starts a
+new `Generation` of the tree. The JSON for each node is cached for each
+generation, so that it is only rendered once, and the generation is
+used to build the ``ETag`` for each response.
+"""
+
+import json
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from . import version
+from .models import (Generation, TreeNode)
+
+__version__ = version.version
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__credits__ = 'Brian Moe'
+
+#: name of the `Generation` of the channel tree
+GENERATION = 'tree'
+
+#: maximum number of levels returned by a single request
+MAX_DEPTH = 10
+
+#: maximum number of descendants returned by a single request, deeper
+#: levels are left out if they would pass this, but all children of the
+#: requested nodes are always returned
+MAX_NODES = 5000
+
+#: maximum number of nodes that can be requested together
+MAX_IDS = 100
+
+#: time (seconds) to cache the JSON for each request, so that entries
+#: from old generations expire, rather than filling the cache
+CACHE_TIMEOUT = 86400
+
+
+def generation():
+    """Returns the current generation number of the tree
+    """
+    return Generation.current(GENERATION)
+
+
+def bump():
+    """Start a new generation of the tree, call after any change
+    """
+    return Generation.bump(GENERATION)
+
+
+def ensure_counts():
+    """Store the depth and counts of every node, if they aren't stored
+
+    Trees stored before the counts were added are counted in full, and
+    a new generation is started, so that nothing rendered without the
+    counts is served again. This must be run before the counts are
+    updated incrementally.
+
+    Returns
+    -------
+    n : `int`
+        the number of nodes that were updated
+    """
+    if TreeNode.has_counts():
+        return 0
+    n = TreeNode.update_counts()
+    TreeNode._counted = True
+    bump()
+    return n
+
+
+def etag(gen, pk=None, depth=1, ids=None):
+    """Returns the (unquoted) ``ETag`` for a tree request
+    """
+    if ids:
+        return 'tree-%d-%s-%d' % (gen, '.'.join(map(str, ids)), depth)
+    return 'tree-%d-%s-%d' % (gen, pk or 0, depth)
+
+
+def get_json(gen, pk=None, depth=1, ids=None):
+    """Returns the JSON for a tree request, from the cache if possible
+
+    Parameters
+    ----------
+    gen : `int`
+        the generation of the tree
+    pk : `int`, optional
+        the ID of the node to return, defaults to the root of the tree
+    depth : `int`, optional, default: `1`
+        the number of levels of children to include
+    ids : `list` of `int`, optional
+        return a list of nodes, rather than a single node
+
+    Returns
+    -------
+    json : `str`
+        the JSON content for the response
+
+    Raises
+    ------
+    TreeNode.DoesNotExist
+        if ``pk`` is not a valid node ID
+    """
+    key = etag(gen, pk=pk, depth=depth, ids=ids)
+    content = cache.get(key)
+    if content is None:
+        content = json.dumps(render(pk=pk, depth=depth, ids=ids))
+        cache.set(key, content, CACHE_TIMEOUT)
+    return content
+
+
+def render(pk=None, depth=1, ids=None):
+    """Build the `dict` for a tree request
+
+    See `get_json` for details of the arguments.
+    """
+    if ids:
+        nodes = list(TreeNode.objects.filter(id__in=ids))
+        nodes.sort(key=lambda node: ids.index(node.id))
+    elif pk:
+        nodes = [TreeNode.objects.get(id=pk)]
+    else:
+        # Fake root object.  DO NOT save() IT!
+        nodes = [TreeNode(name="root")]
+
+    if not TreeNode.has_counts():
+        rv = _render_uncounted(nodes)
+        return rv if ids else rv[0]
+
+    # get all descendants in one query, and link them to their parents
+    descendants = TreeNode.subtree(nodes, depth=depth)
+    maxlevel = None
+    if depth > 1:
+        # a level at a time, stopping at the last level that fits
+        descendants = list(descendants.order_by('depth', 'name')[
+            :MAX_NODES + 1])
+        if len(descendants) > MAX_NODES:
+            maxlevel = descendants[-1].depth - 1
+            descendants = [node for node in descendants if
+                           node.depth <= maxlevel]
+            # but always return the children of the requested nodes
+            short = [node for node in nodes if node.depth >= maxlevel]
+            if short:
+                descendants.extend(TreeNode.subtree(short, depth=1))
+    children = defaultdict(list)
+    for node in descendants:
+        children[node.parent_id].append(node)
+
+    def dictify(node, maxdepth, expand=False):
+        d = {
+            "name": node.name,
+            "id": node.id or 0,
+            "parentid": node.parent_id,
+            }
+        if expand or (node.nchildren and node.depth < maxdepth):
+            d['children'] = [dictify(child, maxdepth) for
+                             child in children[node.id]]
+            d['nleaves'] = node.nleaves
+        elif node.nchildren:
+            d['children'] = True
+            d['nleaves'] = node.nleaves
+        else:
+            d['cid'] = node.channel_id
+        return d
+
+    def limit(node):
+        if maxlevel is None:
+            return node.depth + depth
+        return min(node.depth + depth, maxlevel)
+
+    rv = [dictify(node, limit(node), expand=True) for node in nodes]
+    if ids:
+        return rv
+    return rv[0]
+
+
+def _render_uncounted(nodes):
+    """Build the `dict` for each node, without the stored counts
+
+    Until the tree is counted (see `ensure_counts`) only one level of
+    children can be returned, with the branches among them found by a
+    second query.
+    """
+    ids = [node.id for node in nodes if node.id is not None]
+    query = Q(parent__in=ids)
+    below = Q(parent__parent__in=ids)
+    if len(ids) < len(nodes):  # root
+        query |= Q(parent__isnull=True)
+        below |= Q(parent__isnull=False, parent__parent__isnull=True)
+    children = defaultdict(list)
+    for node in TreeNode.objects.filter(query).order_by('name'):
+        children[node.parent_id].append(node)
+    branches = set(TreeNode.objects.filter(below).values_list(
+        'parent_id', flat=True).distinct())
+
+    def dictify(node):
+        d = {
+            "name": node.name,
+            "id": node.id,
+            "parentid": node.parent_id,
+            }
+        if node.id in branches:
+            d['children'] = True
+        else:
+            d['cid'] = node.channel_id
+        return d
+
+    return [{"name": node.name,
+             "id": node.id or 0,
+             "parentid": node.parent_id,
+             "children": [dictify(child) for child in children[node.id]]}
+            for node in nodes]
+
+
+def precompute(maxdepth=1):
+    """Render and cache the default JSON for the top of the tree
+
+    This renders the root and every branch node down to ``maxdepth``
+    in the current generation, so that the first requests after an
+    update don't have to wait. This is only useful when the Django cache
+    backend is shared between processes. A tree without stored counts
+    is counted first (see `ensure_counts`), so that the rendered JSON
+    includes them.
+
+    Returns
+    -------
+    n : `int`
+        the number of nodes rendered
+    """
+    ensure_counts()
+    gen = generation()
+    get_json(gen)
+    pks = TreeNode.objects.filter(depth__lte=maxdepth, nchildren__gt=0
+                                  ).values_list('id', flat=True)
+    n = 1
+    for pk in pks.iterator():
+        get_json(gen, pk=pk)
+        n += 1
+    return n
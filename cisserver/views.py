@@ -16,7 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with LIGO CIS Core.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.http import (HttpResponse, HttpResponseRedirect)
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotModified, HttpResponseRedirect)
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
 from django.shortcuts import render_to_response
@@ -29,9 +30,11 @@ from django.conf import settings
 
 from django import forms
 from django.utils import dateformat
+from django.utils.http import (parse_etags, quote_etag)
 
 from .models import (Channel, Ifo, Subsystem, TreeNode, ChannelDescription,
                      PemSensor)
+from . import tree as channel_tree
 
 import json
 
@@ -219,34 +222,52 @@ def tree(request, selection=None):
 
 
 def tree_data(request, pk=None):
-    if pk:
-        obj = TreeNode.objects.get(id=pk)
-    else:
-        # Fake root object.  DO NOT save() IT!
-        obj = TreeNode(name="root")
-
-    def dictify(node):
-        d = {
-            "name": node.name,
-            "id": node.id or 0,
-            "parentid": node.parent_id,
-            }
-        if TreeNode.objects.filter(parent_id=node.id).exists():
-            d['children'] = True
-        else:
-            d['cid'] = node.channel_id
-        return d
+    """Return the children of a tree node, or the whole tree as JSON
 
-    children = [dictify(child) for child in
-                TreeNode.objects.filter(parent=obj.id).order_by("name").all()]
+    The following query parameters are supported
 
-    rv = {
-        "name": obj.name,
-        "id": obj.id or 0,
-        "children": children,
-        "parentid": obj.parent_id,
-    }
-    return HttpResponse(json.dumps(rv), content_type="application/json")
+    - ``depth``: number of levels to return, nodes in the last level
+      have ``"children": true`` if they have children of their own
+    - ``ids``: comma-separated list of node ids, to return a list of
+      subtrees rather than a single node
+
+    Levels below the children of the requested nodes are left out if
+    they would take the response past ``tree.MAX_NODES`` nodes.
+
+    Responses carry an ``ETag`` for the current generation of the tree,
+    and are cached on the server until the tree changes.
+    """
+    try:
+        depth = min(max(int(request.GET.get('depth', 1)), 1),
+                    channel_tree.MAX_DEPTH)
+    except ValueError:
+        depth = 1
+    ids = request.GET.get('ids')
+    if ids:
+        try:
+            ids = [int(id_) for id_ in ids.split(',') if id_]
+        except ValueError:
+            return HttpResponseBadRequest("Cannot parse ids=%r" % ids)
+        if len(ids) > channel_tree.MAX_IDS:
+            return HttpResponseBadRequest(
+                "Cannot request more than %d ids" % channel_tree.MAX_IDS)
+    pk = int(pk) if pk and pk != 'null' else None
+
+    gen = channel_tree.generation()
+    etag = channel_tree.etag(gen, pk=pk, depth=depth, ids=ids)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            content = channel_tree.get_json(gen, pk=pk, depth=depth,
+                                            ids=ids)
+        except TreeNode.DoesNotExist:
+            raise Http404("No tree node with id %d" % pk)
+        response = HttpResponse(content, content_type="application/json")
+    response['ETag'] = quote_etag(etag)
+    # always check the ETag, the tree may change at any time
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
 def channelByName(request, name):
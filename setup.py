@@ -132,7 +132,7 @@ setup(
         'jinja2',
     ],
     install_requires=[
-        'django >= 1.7',
+        'django >= 1.8',
         'django-reversion',
         'mysql-python'
     ],